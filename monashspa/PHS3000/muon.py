@@ -51,7 +51,6 @@ def histc(x, bins):
 
     """
     indicies = np.digitize(x,bins)
-    counts = np.zeros(bins.shape)
-    for i in indicies:
-        counts[i-1] += 1
+    # values below bins[0] (index 0) are counted in the last element, like those at or above bins[-1]
+    counts = np.bincount((np.ravel(indicies)-1) % len(bins), minlength=len(bins)).astype(float)
     return counts
\ No newline at end of file
@@ -0,0 +1,52 @@
+# Copyright 2019 School of Physics & Astronomy, Monash University
+#
+# This file is part of monashspa.
+#
+# monashspa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# monashspa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with monashspa.  If not, see <http://www.gnu.org/licenses/>.
+'''Command line interface for the calorimeter simulation, see monashspa.PHS3302.calorimeter.campaign.
+
+Usage::
+
+    python -m monashspa.PHS3302.calorimeter run config.yaml [--resume | --overwrite] [--processes N]
+'''
+
+import argparse
+import sys
+
+from .campaign import load_config, run_campaign
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m monashspa.PHS3302.calorimeter',
+                                     description='Run calorimeter simulation campaigns.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the jobs of a campaign configuration file')
+    run_parser.add_argument('config', help='YAML or JSON configuration file')
+    group = run_parser.add_mutually_exclusive_group()
+    group.add_argument('--resume', action='store_true', help='continue an existing output file')
+    group.add_argument('--overwrite', action='store_true', help='replace an existing output file')
+    run_parser.add_argument('--processes', type=int, default=None,
+                            help='number of worker processes (default: from the configuration or all CPU cores)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        config = load_config(args.config)
+        completed = run_campaign(config, resume=args.resume, overwrite=args.overwrite, processes=args.processes)
+        return 0 if completed else 130
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+# Copyright 2019 School of Physics & Astronomy, Monash University
+#
+# This file is part of monashspa.
+#
+# monashspa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# monashspa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with monashspa.  If not, see <http://www.gnu.org/licenses/>.
+'''Benchmarks of the calorimeter simulation on a set of fixed reference geometries.
+
+Run from a terminal with::
+
+    python -m monashspa.PHS3302.calorimeter.bench --output bench.json
+
+and compare with the results of an earlier run (for example on a different commit) with::
+
+    python -m monashspa.PHS3302.calorimeter.bench --output new.json --compare bench.json
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+import multiprocessing as mp
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # The resource module is not available on Windows
+    resource = None
+
+from .model import Calorimeter, Layer, Simulation, Electron
+from .model.simulation import _run_events, _run_range, _worker_pool
+
+
+def sampling_calorimeter():
+    '''The sampling calorimeter of the exercise: 40 times a layer of lead and scintillator.'''
+    cal = Calorimeter()
+    lead = Layer('lead', 2.0, 0.5, 0.0)
+    scintillator = Layer('Scin', 0.01, 0.5, 1.0)
+    for i in range(40):
+        cal.add_layers([lead, scintillator])
+    return cal
+
+
+def homogeneous_calorimeter():
+    '''A homogeneous calorimeter made from a single block of active material.'''
+    cal = Calorimeter()
+    cal.add_layer(Layer('crystal', 1.0, 25.0, 1.0))
+    return cal
+
+
+def fine_calorimeter():
+    '''A finely segmented sampling calorimeter with 400 layers and the same
+    total thickness and amount of lead and scintillator as the sampling calorimeter.'''
+    cal = Calorimeter()
+    lead = Layer('lead', 2.0, 0.1, 0.0)
+    scintillator = Layer('Scin', 0.01, 0.1, 1.0)
+    for i in range(200):
+        cal.add_layers([lead, scintillator])
+    return cal
+
+
+GEOMETRIES = {
+    'sampling': sampling_calorimeter,
+    'homogeneous': homogeneous_calorimeter,
+    'fine': fine_calorimeter,
+}
+
+
+def peak_rss():
+    '''Return the peak resident set size in MB of this process and of its
+    (finished) child processes, or (None, None) if it cannot be determined.'''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kB on Linux but in bytes on macOS
+    scale = 1024.0**2 if sys.platform == 'darwin' else 1024.0
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/scale)
+
+
+def process_counts(max_processes):
+    '''Return the number of processes to measure the scaling for: 1, 2, 4, ... up to max_processes.'''
+    counts = [1]
+    while counts[-1]*2 < max_processes:
+        counts.append(counts[-1]*2)
+    if counts[-1] != max_processes:
+        counts.append(max_processes)
+    return counts
+
+
+def dispatch_cost(geometry, tasks=1000, processes=2):
+    '''Measure the time it takes to send a task to a worker process and get the result back,
+    by simulating "tasks" single events that cost almost nothing (an electron below its
+    cutoff, which is absorbed within a few steps).
+
+    This is measured both for tasks that carry the simulation and particle (pickled for
+    every task) and for tasks that are just ranges of event indices, with the simulation
+    given to the workers once (as Simulation.simulate does). Returns a dictionary with
+    the time per task in microseconds and the multiprocessing start method.'''
+    sim = Simulation(GEOMETRIES[geometry]())
+    particle = Electron(0.0, 0.001)
+    event_ranges = [(i, i+1) for i in range(tasks)]
+
+    with Pool(processes) as pool:
+        # make sure the workers have started before timing
+        pool.map(abs, range(processes))
+        start = time.perf_counter()
+        for result in pool.imap(_run_events, [(sim, particle, 0.0, 1) + r for r in event_ranges]):
+            pass
+        pickled = time.perf_counter() - start
+
+    with _worker_pool(processes, (sim, particle, 0.0, 1)) as pool:
+        pool.map(abs, range(processes))
+        start = time.perf_counter()
+        for result in pool.imap(_run_range, event_ranges):
+            pass
+        ranges = time.perf_counter() - start
+
+    return {
+        'start_method': mp.get_start_method(),
+        'tasks': tasks,
+        'processes': processes,
+        'pickled_task_us': 1e6*pickled/tasks,
+        'range_task_us': 1e6*ranges/tasks,
+    }
+
+
+def benchmark(geometry, energy=10.0, number=50, seed=1, max_processes=None, batch_size=None):
+    '''Benchmark the simulation of "number" electrons with energy "energy" in one of the
+    reference geometries (see GEOMETRIES).
+
+    The events are first simulated serially in this process to count the steps taken.
+    They are then simulated again with Simulation.simulate for 1, 2, 4, ... up to
+    max_processes processes (default: all CPU cores). As the events are seeded with
+    "seed", every run simulates exactly the same showers. The cost of dispatching a task
+    to a worker is measured with dispatch_cost. With a batch_size, the batched engine is
+    benchmarked instead of the default one (see Simulation).
+
+    Returns a dictionary with the results.'''
+    cal = GEOMETRIES[geometry]()
+    particle = Electron(0.0, energy)
+    if max_processes is None:
+        max_processes = mp.cpu_count()
+
+    sim = Simulation(cal, batch_size=batch_size)
+    start = time.perf_counter()
+    ionisations, steps, observers, profiles = _run_events((sim, particle, 0.0, seed, 0, number))
+    serial_time = time.perf_counter() - start
+
+    scaling = []
+    for processes in process_counts(max_processes):
+        start = time.perf_counter()
+        sim.simulate(particle, number, seed=seed, processes=processes)
+        elapsed = time.perf_counter() - start
+        scaling.append({
+            'processes': processes,
+            'time': elapsed,
+            'particles_per_second': number/elapsed,
+            'steps_per_second': steps/elapsed,
+        })
+    for result in scaling:
+        result['efficiency'] = (result['particles_per_second']
+                                / (result['processes']*scaling[0]['particles_per_second']))
+
+    rss_self, rss_children = peak_rss()
+    return {
+        'geometry': geometry,
+        'layers': len(cal._layers),
+        'energy': energy,
+        'number': number,
+        'seed': seed,
+        'batch_size': batch_size,
+        'steps': steps,
+        'steps_per_particle': steps/number,
+        'mean_energy_sum': float(np.mean(np.sum(ionisations, axis=1))),
+        'serial': {
+            'time': serial_time,
+            'particles_per_second': number/serial_time,
+            'steps_per_second': steps/serial_time,
+        },
+        'scaling': scaling,
+        'dispatch': dispatch_cost(geometry, processes=max(2, min(max_processes, 4))),
+        'peak_rss_mb': rss_self,
+        'peak_rss_children_mb': rss_children,
+    }
+
+
+def _git_commit():
+    '''Return the git commit of the monashspa source tree, if there is one.'''
+    try:
+        source = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=source, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def metadata():
+    '''Return a dictionary describing the machine and software the benchmark ran with.'''
+    import monashspa
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'monashspa_version': monashspa.__version__,
+        'python_version': platform.python_version(),
+        'numpy_version': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': mp.cpu_count(),
+    }
+
+
+def run(geometries=None, energy=10.0, number=50, seed=1, max_processes=None, batch_size=None):
+    '''Run the benchmark for a list of geometries (default: all of them) and
+    return the results as a dictionary that can be written as JSON.'''
+    if geometries is None:
+        geometries = list(GEOMETRIES)
+    return {
+        'metadata': metadata(),
+        'results': {g: benchmark(g, energy, number, seed, max_processes, batch_size) for g in geometries},
+    }
+
+
+def compare(old, new):
+    '''Print the ratio of the throughput of two benchmark runs (as returned by run).'''
+    print('{:12} {:>9} {:>14} {:>14} {:>8}'.format('geometry', 'processes', 'old particle/s', 'new particle/s', 'ratio'))
+    for geometry, result in new['results'].items():
+        if geometry not in old['results']:
+            continue
+        old_scaling = {r['processes']: r for r in old['results'][geometry]['scaling']}
+        for r in result['scaling']:
+            if r['processes'] not in old_scaling:
+                continue
+            o = old_scaling[r['processes']]['particles_per_second']
+            n = r['particles_per_second']
+            print(f'{geometry:12} {r["processes"]:9d} {o:14.2f} {n:14.2f} {n/o:8.2f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the calorimeter simulation.')
+    parser.add_argument('--geometry', action='append', choices=list(GEOMETRIES),
+                        help='reference geometry to benchmark (can be repeated, default: all)')
+    parser.add_argument('--energy', type=float, default=10.0, help='energy of the ingoing electrons')
+    parser.add_argument('--number', type=int, default=50, help='number of electrons to simulate')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the simulation')
+    parser.add_argument('--max-processes', type=int, default=None,
+                        help='largest number of processes to measure the scaling for (default: all CPU cores)')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='benchmark the batched engine with this batch size (default: the default engine)')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    results = run(args.geometry, args.energy, args.number, args.seed, args.max_processes, args.batch_size)
+
+    for geometry, result in results['results'].items():
+        print(f'{geometry}: {result["serial"]["particles_per_second"]:.2f} particles/s, '
+              f'{result["serial"]["steps_per_second"]:.0f} steps/s (serial)')
+        for r in result['scaling']:
+            print(f'    {r["processes"]:3d} processes: {r["particles_per_second"]:.2f} particles/s, '
+                  f'efficiency {r["efficiency"]:.2f}')
+        d = result['dispatch']
+        print(f'    dispatch ({d["start_method"]}): {d["pickled_task_us"]:.0f} us per task with the simulation pickled, '
+              f'{d["range_task_us"]:.0f} us per task with an event range')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
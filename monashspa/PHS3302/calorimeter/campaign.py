@@ -0,0 +1,185 @@
+# Copyright 2019 School of Physics & Astronomy, Monash University
+#
+# This file is part of monashspa.
+#
+# monashspa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# monashspa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with monashspa.  If not, see <http://www.gnu.org/licenses/>.
+'''Batch running of calorimeter simulation campaigns, writing the results to an HDF5 file.
+
+A campaign is described by a configuration file in YAML (or JSON) format, for example::
+
+    output: campaign.h5
+    processes: 8
+    chunk: 100
+    geometry:
+      - repeat: 40
+        layers:
+          - {name: lead, material: 2.0, thickness: 0.5, response: 0.0}
+          - {name: Scin, material: 0.01, thickness: 0.5, response: 1.0}
+    jobs:
+      - {particle: electron, energy: 10.0, number: 1000, seed: 1}
+      - {particle: muon, energy: 10.0, number: 1000, seed: 2, deadcellfraction: 0.05}
+
+and is run from a terminal with::
+
+    python -m monashspa.PHS3302.calorimeter run config.yaml
+
+The ionisations of each job are stored in the dataset "jobs/<name>" of the output file (the
+name defaults to "<particle>_<energy>_<seed>"), with one row per event and one column per active
+layer. Events are simulated and appended in chunks of "chunk" events, so an interrupted campaign
+keeps all completed chunks and can be continued with the "--resume" option.
+'''
+
+import json
+import os
+import signal
+from multiprocessing import Pool
+import multiprocessing as mp
+
+import h5py
+import numpy as np
+
+from .model.calorimeter import Calorimeter
+from .model.layer import Layer
+from .model.particle import Electron, Photon, Muon
+from .model.simulation import Simulation, _run_events
+
+PARTICLES = {
+    'electron': Electron,
+    'photon': Photon,
+    'muon': Muon,
+}
+
+
+class CampaignException(Exception):
+    pass
+
+
+def load_config(filename):
+    '''Read a campaign configuration from a YAML or JSON file.'''
+    with open(filename) as f:
+        if os.path.splitext(filename)[1].lower() == '.json':
+            config = json.load(f)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise CampaignException('Reading a YAML configuration requires the PyYAML package (pip install pyyaml). Alternatively, write the configuration in JSON format.')
+            config = yaml.safe_load(f)
+
+    for key in ('output', 'geometry', 'jobs'):
+        if key not in config:
+            raise CampaignException('The configuration in {} has no "{}" entry.'.format(filename, key))
+
+    for job in config['jobs']:
+        if job['particle'] not in PARTICLES:
+            raise CampaignException('Unknown particle "{}". Use one of: {}'.format(job['particle'], ', '.join(PARTICLES)))
+        job.setdefault('deadcellfraction', 0.0)
+        job.setdefault('name', '{particle}_{energy}_{seed}'.format(**job))
+    names = [job['name'] for job in config['jobs']]
+    if len(set(names)) != len(names):
+        raise CampaignException('The names of the jobs are not unique.')
+
+    return config
+
+
+def build_calorimeter(geometry):
+    '''Build a calorimeter from the "geometry" entry of a campaign configuration:
+    a list of blocks, each a list of "layers" that is repeated "repeat" times.'''
+    cal = Calorimeter()
+    for block in geometry:
+        layers = [Layer(l['name'], l['material'], l['thickness'], l.get('response', 1.0))
+                  for l in block['layers']]
+        for i in range(block.get('repeat', 1)):
+            cal.add_layers(layers)
+    return cal
+
+
+def _init_worker():
+    '''Let the parent process handle Ctrl-C, so the workers don't all print a traceback.'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _open_job(f, job, nlayers, chunk):
+    '''Return the dataset of a job, creating it if needed. Rows beyond the number of
+    completed events (left by an interruption during a write) are discarded.'''
+    name = 'jobs/' + job['name']
+    if name not in f:
+        dataset = f.create_dataset(name, shape=(0, nlayers), maxshape=(None, nlayers),
+                                   chunks=(min(chunk, max(job['number'], 1)), nlayers),
+                                   dtype='f8', compression='gzip', shuffle=True)
+        for key in ('particle', 'energy', 'number', 'seed', 'deadcellfraction'):
+            dataset.attrs[key] = job[key]
+        dataset.attrs['events'] = 0
+        return dataset
+
+    dataset = f[name]
+    for key in ('particle', 'energy', 'number', 'seed', 'deadcellfraction'):
+        if dataset.attrs[key] != job[key]:
+            raise CampaignException('The job "{}" in the output file has {}={}, but the configuration has {}={}.'.format(
+                job['name'], key, dataset.attrs[key], key, job[key]))
+    dataset.resize(dataset.attrs['events'], axis=0)
+    return dataset
+
+
+def run_campaign(config, resume=False, overwrite=False, processes=None, verbose=True):
+    '''Run all jobs of a campaign configuration (as returned by load_config) and
+    write the results to the HDF5 output file.
+
+    An existing output file is only continued if resume=True, and only replaced if
+    overwrite=True. Returns True if all jobs completed and False if the campaign was interrupted.'''
+    output = config['output']
+    if os.path.exists(output) and not (resume or overwrite):
+        raise CampaignException('The output file {} already exists. Use resume to continue it or overwrite to replace it.'.format(output))
+
+    cal = build_calorimeter(config['geometry'])
+    sim = Simulation(cal)
+    nlayers = len(cal.positions())
+    chunk = config.get('chunk', 100)
+    if processes is None:
+        processes = config.get('processes', mp.cpu_count())
+    geometry = json.dumps(config['geometry'], sort_keys=True)
+
+    with h5py.File(output, 'w' if overwrite else 'a') as f:
+        if 'geometry' in f.attrs and f.attrs['geometry'] != geometry:
+            raise CampaignException('The output file {} was written with a different geometry.'.format(output))
+        f.attrs['geometry'] = geometry
+        f.attrs['positions'] = cal.positions()
+
+        with Pool(processes, initializer=_init_worker) as pool:
+            try:
+                for job in config['jobs']:
+                    dataset = _open_job(f, job, nlayers, chunk)
+                    done = int(dataset.attrs['events'])
+                    if done >= job['number']:
+                        continue
+
+                    particle = PARTICLES[job['particle']](0.0, job['energy'])
+                    args_list = [(sim, particle, job['deadcellfraction'], job['seed'], start, min(start+chunk, job['number']))
+                                 for start in range(done, job['number'], chunk)]
+                    for ionisations, steps, observers, profiles in pool.imap(_run_events, args_list):
+                        dataset.resize(done+len(ionisations), axis=0)
+                        dataset[done:] = ionisations
+                        done += len(ionisations)
+                        # only count the events once they are written
+                        dataset.attrs['events'] = done
+                        f.flush()
+                    if verbose:
+                        print('Completed job {} ({} events)'.format(job['name'], done))
+            except KeyboardInterrupt:
+                pool.terminate()
+                if verbose:
+                    print('Interrupted. The completed events are saved, continue with --resume.')
+                return False
+
+    return True
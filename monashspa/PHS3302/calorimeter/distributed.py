@@ -0,0 +1,271 @@
+# Copyright 2019 School of Physics & Astronomy, Monash University
+#
+# This file is part of monashspa.
+#
+# monashspa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# monashspa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with monashspa.  If not, see <http://www.gnu.org/licenses/>.
+'''Distributed calorimeter simulation over several machines.
+
+A coordinator splits a simulation into tasks (ranges of events) and serves them from a
+work queue. Worker processes, on the same or on other machines, connect to the coordinator,
+pull tasks, simulate them and send back the ionisations. Workers send heartbeats while they
+simulate; the tasks of a worker that stops sending heartbeats are put back in the queue for
+another worker. As every event is seeded from the seed of the run and its index, the result
+is identical to Simulation.simulate with the same seed.
+
+On the coordinating machine::
+
+    import monashspa.PHS3302.calorimeter.model as model
+    from monashspa.PHS3302.calorimeter.distributed import run_coordinator
+
+    ionisations = run_coordinator(model.Simulation(mycal), model.Electron(0.0, 10.0), 10000,
+                                  seed=1, address=('', 50000), authkey=b'a secret key')
+
+and on every machine that should do the work::
+
+    python -m monashspa.PHS3302.calorimeter.distributed coordinator-host:50000 --authkey "a secret key"
+'''
+
+import argparse
+import threading
+import time
+import uuid
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+import multiprocessing as mp
+
+import numpy as np
+
+from .model.simulation import _run_events, _event_ranges
+
+# Returned by TaskBoard.get_task when there is no task right now, but there may be one later
+WAIT = 'wait'
+
+# Seconds between the heartbeats of a worker
+_HEARTBEAT_INTERVAL = 5.0
+
+
+class TaskBoard:
+    '''The work queue of the coordinator. Its methods are called by the workers through
+    a manager proxy, from several threads at once.'''
+
+    def __init__(self, configuration, ranges, timeout):
+        self._configuration = configuration
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._queue = list(enumerate(ranges))
+        self._queue.reverse()
+        self._assigned = {}
+        self._last_seen = {}
+        self._results = {}
+        self._ntasks = len(ranges)
+        self._finished = threading.Event()
+
+    def configuration(self):
+        '''Return (simulation, particle, deadcellfraction, seed) of the simulation.'''
+        return self._configuration
+
+    def get_task(self, worker):
+        '''Return the next (task, start, stop) for a worker, WAIT if all remaining
+        tasks are being worked on, or None if the simulation is finished.'''
+        with self._lock:
+            self._last_seen[worker] = time.monotonic()
+            if self._finished.is_set():
+                return None
+            if not self._queue:
+                return WAIT
+            task, (start, stop) = self._queue.pop()
+            self._assigned[task] = (worker, start, stop)
+            return task, start, stop
+
+    def heartbeat(self, worker):
+        with self._lock:
+            self._last_seen[worker] = time.monotonic()
+
+    def put_result(self, worker, task, ionisations):
+        with self._lock:
+            self._last_seen[worker] = time.monotonic()
+            self._assigned.pop(task, None)
+            # A task that was requeued may be completed twice; the results are identical
+            self._results.setdefault(task, ionisations)
+            if len(self._results) == self._ntasks:
+                self._finished.set()
+
+    def requeue_lost_tasks(self):
+        '''Put the tasks of workers that have not been seen for longer than the timeout
+        back in the queue. Returns the number of requeued tasks.'''
+        now = time.monotonic()
+        with self._lock:
+            lost = [task for task, (worker, start, stop) in self._assigned.items()
+                    if now - self._last_seen.get(worker, 0) > self._timeout and task not in self._results]
+            for task in lost:
+                worker, start, stop = self._assigned.pop(task)
+                self._queue.append((task, (start, stop)))
+            return len(lost)
+
+    def progress(self):
+        with self._lock:
+            return len(self._results), self._ntasks
+
+    def wait(self, timeout):
+        return self._finished.wait(timeout)
+
+    def results(self):
+        return [self._results[task] for task in range(self._ntasks)]
+
+
+# The task board lives in the server process of the coordinator's manager
+_board = None
+
+
+def _create_board(configuration, ranges, timeout):
+    global _board
+    _board = TaskBoard(configuration, ranges, timeout)
+
+
+def _get_board():
+    return _board
+
+
+class _BoardManager(BaseManager):
+    pass
+
+
+_BoardManager.register('board', callable=_get_board)
+
+
+def run_coordinator(simulation, particle, number, deadcellfraction=0.0, seed=None,
+                    address=('', 50000), authkey=None, task_size=10, timeout=60,
+                    local_workers=0, verbose=False):
+    '''Serve the simulation of "number" particles through the calorimeter of "simulation"
+    to workers (see run_worker) connecting to "address" with the shared "authkey" (bytes), and
+    return the ionisations in the same form as Simulation.simulate.
+
+    The events are split into tasks of "task_size" events. The tasks of a worker that has not sent
+    a heartbeat for "timeout" seconds are given to another worker. "local_workers" worker processes
+    are started on this machine in addition to the workers on other machines.'''
+    if authkey is None:
+        raise ValueError('An authkey shared with the workers is required.')
+    if number < 0:
+        raise ValueError('The number of particles cannot be negative.')
+    if number == 0:
+        # there are no tasks, so the workers would never be told that the simulation is finished
+        return np.zeros((0, len(simulation._calorimeter.positions())))
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    ranges = _event_ranges(number, int(np.ceil(number/task_size)))
+    configuration = (simulation, particle, deadcellfraction, seed)
+
+    manager = _BoardManager(address=address, authkey=authkey)
+    manager.start(initializer=_create_board, initargs=(configuration, ranges, timeout))
+    try:
+        board = manager.board()
+        if verbose:
+            print('Coordinator listening on {}:{}'.format(*manager.address))
+
+        workers = [Process(target=run_worker, args=(manager.address, authkey)) for i in range(local_workers)]
+        for worker in workers:
+            worker.start()
+
+        while not board.wait(1.0):
+            requeued = board.requeue_lost_tasks()
+            if verbose:
+                completed, total = board.progress()
+                print('Completed {} of {} tasks'.format(completed, total) +
+                      (', requeued {} lost tasks'.format(requeued) if requeued else ''))
+        results = board.results()
+
+        # give the local workers a moment to learn that the simulation is finished
+        for worker in workers:
+            worker.join(timeout=2*_HEARTBEAT_INTERVAL)
+            if worker.is_alive():
+                worker.terminate()
+    finally:
+        manager.shutdown()
+
+    return np.concatenate(results, axis=0)
+
+
+def _heartbeat(board, worker, stopped, interval):
+    while not stopped.wait(interval):
+        try:
+            board.heartbeat(worker)
+        except Exception:
+            return
+
+
+def run_worker(address, authkey, heartbeat_interval=_HEARTBEAT_INTERVAL):
+    '''Connect to the coordinator at "address" (a (host, port) tuple), and simulate
+    tasks until the coordinator has no more work. Returns the number of tasks completed.'''
+    manager = _BoardManager(address=tuple(address), authkey=authkey)
+    manager.connect()
+    board = manager.board()
+    worker = uuid.uuid4().hex
+    simulation, particle, deadcellfraction, seed = board.configuration()
+
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(board, worker, stopped, heartbeat_interval), daemon=True)
+    heartbeat.start()
+
+    completed = 0
+    try:
+        while True:
+            try:
+                task = board.get_task(worker)
+            except (EOFError, ConnectionError):
+                # The coordinator has finished and shut down
+                break
+            if task is None:
+                break
+            if task == WAIT:
+                time.sleep(heartbeat_interval/5)
+                continue
+            task, start, stop = task
+            ionisations, steps, observers, profiles = _run_events((simulation, particle, deadcellfraction, seed, start, stop))
+            try:
+                board.put_result(worker, task, ionisations)
+            except (EOFError, ConnectionError):
+                break
+            completed += 1
+    finally:
+        stopped.set()
+
+    return completed
+
+
+def run_workers(address, authkey, processes=None):
+    '''Start "processes" (default: all CPU cores) workers on this machine and wait for them to finish.'''
+    if processes is None:
+        processes = mp.cpu_count()
+    workers = [Process(target=run_worker, args=(address, authkey)) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m monashspa.PHS3302.calorimeter.distributed',
+                                     description='Run calorimeter simulation workers for a coordinator.')
+    parser.add_argument('address', help='host:port of the coordinator')
+    parser.add_argument('--authkey', required=True, help='key shared with the coordinator')
+    parser.add_argument('--processes', type=int, default=None, help='number of workers (default: all CPU cores)')
+    args = parser.parse_args(argv)
+
+    host, port = args.address.rsplit(':', 1)
+    run_workers((host, int(port)), args.authkey.encode(), args.processes)
+
+
+if __name__ == '__main__':
+    main()
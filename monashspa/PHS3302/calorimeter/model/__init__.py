@@ -2,4 +2,11 @@ from .calorimeter import Calorimeter
 from .layer import Layer
 from .simulation import Simulation
 from .particle import Electron, Photon, Muon
+from .variance_reduction import VarianceReduction
+from .observers import Observer, Counters
+from .composer import compose_events
+from .analysis import energy_sums, resolution, readout, resolution_with_uncertainty
+from .output import OutputSpec
+from .traces import save_traces, TraceFile
 
+from .sensitivity import InteractionHistory, SensitivityScan
@@ -0,0 +1,126 @@
+import numpy as np
+
+
+def energy_sums(ionisations, chunk_size=65536):
+    '''Return the total ionisation of each event (the sum over the layers) as a float64 array.
+    The ionisations are read chunk_size events at a time, so a memory-mapped sample
+    (see OutputSpec) is never loaded whole.'''
+    energies = np.empty(len(ionisations))
+    for first in range(0, len(ionisations), chunk_size):
+        energies[first:first+chunk_size] = np.sum(ionisations[first:first+chunk_size], axis=1, dtype=np.float64)
+    return energies
+
+
+def resolution(ionisations, chunk_size=65536):
+    '''Return the relative energy resolution std(E)/mean(E) of a sample of events,
+    where E is the total ionisation of an event. Works chunk-wise like energy_sums.'''
+    return float(_resolution(energy_sums(ionisations, chunk_size)))
+
+
+def readout(ionisations, noise=0.0, gain=1.0, seed=None, out=None, chunk_size=65536):
+    '''Simulate the readout of the layers: the ionisation of each layer is multiplied by its
+    gain (a number, or an array with one calibration factor per layer) and Gaussian noise
+    with standard deviation "noise" is added.
+
+    The result is written to "out" if given (for example a numpy.memmap from
+    numpy.lib.format.open_memmap, to keep a large sample on disk), and otherwise to a new
+    array with the dtype of the ionisations. Events are processed chunk_size at a time and the
+    noise is drawn in the same order for any chunk_size, so the result only depends on the seed.'''
+    rng = np.random.default_rng(seed)
+    if out is None:
+        out = np.empty(ionisations.shape, dtype=ionisations.dtype if ionisations.dtype.kind == 'f' else np.float64)
+    elif out.shape != ionisations.shape:
+        raise ValueError('The output has shape {}, but the ionisations have shape {}.'.format(out.shape, ionisations.shape))
+    gain = np.asarray(gain, dtype=np.float64)
+    for first in range(0, len(ionisations), chunk_size):
+        chunk = ionisations[first:first+chunk_size]*gain
+        if noise:
+            chunk += rng.normal(0.0, noise, chunk.shape)
+        out[first:first+chunk_size] = chunk
+    return out
+
+
+def _resolution(energies):
+    '''Relative resolution std/mean along the last axis.'''
+    return np.std(energies, axis=-1)/np.mean(energies, axis=-1)
+
+
+def _analytic_uncertainty(energies):
+    '''Large-N (delta method) uncertainty of std/mean along the last axis, from the
+    sample moments, so it also holds for energy distributions that are not Gaussian.'''
+    n = energies.shape[-1]
+    mean = np.mean(energies, axis=-1, keepdims=True)
+    d = energies - mean
+    m2 = np.mean(d**2, axis=-1)
+    m3 = np.mean(d**3, axis=-1)
+    m4 = np.mean(d**4, axis=-1)
+    mean = mean[..., 0]
+    r = np.sqrt(m2)/mean
+    variance = ((m4/m2**2 - 1)/4 + r**2 - m3/(m2*mean))/n
+    return r*np.sqrt(np.maximum(variance, 0))
+
+
+def _bootstrap_uncertainty(energies, n_boot, rng, block_size=2**22):
+    '''Bootstrap uncertainty of std/mean along the last axis.
+
+    The replicates are drawn as an (n_boot, n) index matrix and turned into how often each
+    event is picked, so the means and variances of all replicates, and of all rows of an
+    energy scan, follow from two matrix products. Replicates are processed in blocks of at
+    most block_size indices to limit the memory used.'''
+    n = energies.shape[-1]
+    mean = np.mean(energies, axis=-1, keepdims=True)
+    # centre the data so the variance does not suffer from cancellation
+    d = energies - mean
+    replicates = []
+    per_block = max(1, block_size//n)
+    for first in range(0, n_boot, per_block):
+        k = min(per_block, n_boot - first)
+        index = rng.integers(0, n, (k, n)) + n*np.arange(k)[:, None]
+        weights = np.bincount(index.ravel(), minlength=k*n).reshape(k, n)/n
+        m1 = d @ weights.T
+        m2 = (d**2) @ weights.T
+        replicates.append(np.sqrt(np.maximum(m2 - m1**2, 0))/(m1 + mean))
+    return np.std(np.concatenate(replicates, axis=-1), axis=-1, ddof=1)
+
+
+def resolution_with_uncertainty(energies, n_boot=1000, seed=None, method='auto', max_bootstrap_events=100000):
+    '''Estimate the relative energy resolution std(E)/mean(E) and its uncertainty.
+
+    Arguments:
+        energies: a 1D array of the measured energies of the events, or a 2D array
+                  with one row per point of an energy scan (all with the same number
+                  of events), or a list of 1D arrays (which may differ in length).
+
+    Keyword Arguments:
+        n_boot: number of bootstrap replicates.
+        seed: seed for the bootstrap, to make the result reproducible.
+        method: "bootstrap", "analytic" (the large-N approximation from the sample moments),
+                or "auto" (the default) to use the bootstrap unless there are more than
+                max_bootstrap_events events.
+
+    Returns:
+        A tuple (resolution, u_resolution). These are floats for a 1D input and
+        arrays with one value per row or list entry otherwise.
+    '''
+    if method not in ('auto', 'bootstrap', 'analytic'):
+        raise ValueError('Unknown method "{}". Use "auto", "bootstrap" or "analytic".'.format(method))
+    rng = np.random.default_rng(seed)
+
+    if isinstance(energies, (list, tuple)) and len({len(e) for e in energies}) > 1:
+        # a scan with a different number of events per point
+        results = [resolution_with_uncertainty(e, n_boot, rng, method, max_bootstrap_events) for e in energies]
+        return np.array([r for r, u in results]), np.array([u for r, u in results])
+
+    energies = np.asarray(energies, dtype=float)
+    if method == 'auto':
+        method = 'bootstrap' if energies.shape[-1] <= max_bootstrap_events else 'analytic'
+
+    resolution = _resolution(energies)
+    if method == 'bootstrap':
+        u_resolution = _bootstrap_uncertainty(energies, n_boot, rng)
+    else:
+        u_resolution = _analytic_uncertainty(energies)
+
+    if energies.ndim == 1:
+        return float(resolution), float(u_resolution)
+    return resolution, u_resolution
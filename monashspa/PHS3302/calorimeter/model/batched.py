@@ -0,0 +1,124 @@
+import numpy as np
+
+# The kinds of particles the batched engine follows
+_ELECTRON = 0
+_PHOTON = 1
+_MUON = 2
+_KINDS = {'elec': _ELECTRON, 'phot': _PHOTON, 'muon': _MUON}
+# The energy cutoff of electrons and photons, below which they are absorbed
+_CUTOFF = 0.01
+
+# The hazard of a step that always interacts (material*step >= 1). Finite, so that
+# cumulative hazards after such a step can still be compared.
+_MAX_HAZARD = 50.0
+
+
+class _StepGrid:
+    '''The steps an ingoing particle and all its daughters can take through a calorimeter.
+
+    All particles of a shower start from the z of the ingoing particle and move by step_size,
+    so they are always at one of the positions z[0], z[1], ..., z[K], where z[K] is the first
+    position at or beyond the back of the calorimeter. The positions are added up one step at
+    a time, exactly as the particles do in the object engine, and the layer of each step is
+    looked up with Calorimeter.volume in the same way.
+
+    hazard[j] = -log(1 - material*step_size) is the hazard of an interaction in step j, and H
+    its cumulative sum (H[j] is the hazard of the steps before j), so a particle at z[g] with an
+    exponentially distributed threshold u interacts in the step that takes H above H[g] + u.'''
+
+    def __init__(self, calorimeter, z0, step_size):
+        self.step_size = step_size
+        n = max(int(np.ceil((calorimeter._zend - z0)/step_size)), 0) + 2
+        z = np.add.accumulate(np.concatenate([[z0], np.full(n, step_size)]))
+        self.K = int(np.argmax(z >= calorimeter._zend)) if z0 < calorimeter._zend else 0
+        self.z = z[:self.K+1]
+
+        self.layer = np.full(self.K, -1, dtype=np.int64)
+        for j in range(self.K):
+            volume = calorimeter.volume(self.z[j])
+            if volume is not None:
+                self.layer[j] = calorimeter._layers.index(volume)
+        inside = self.layer >= 0
+        material = np.array([v.layer._material for v in calorimeter._layers] + [0.0])[self.layer]
+        yields = np.array([v.layer._yield for v in calorimeter._layers] + [0.0])[self.layer]
+        p = np.where(inside, material*step_size, 0.0)
+        with np.errstate(divide='ignore'):
+            self.hazard = np.minimum(-np.log1p(-np.minimum(p, 1.0)), _MAX_HAZARD)
+        self.H = np.concatenate([[0.0], np.cumsum(self.hazard)])
+        # ionisation per unit weight of an ionising particle in each step
+        self.deposit = np.where(inside, yields*step_size, 0.0)
+
+
+def _shower_batched(calorimeter, grid, particle, batch_size, rng, observers=()):
+    '''Follow a single ingoing particle and all the particles it creates through the
+    calorimeter, with the particles processed in batches of at most batch_size.
+
+    Every particle of a batch is moved to its next interaction (or out of the calorimeter)
+    in one vectorised pass, and the daughters are put back on the work queue as arrays.
+    The most recently created daughters are processed first, which keeps the queue small
+    also for very energetic showers. The transverse positions are not followed, as they
+    do not change the ionisation.
+
+    The ionisation is written to the layers of the calorimeter (and to its longitudinal
+    profile, if enabled). Returns the number of steps taken.'''
+    if particle.type not in _KINDS:
+        raise ValueError('The batched engine can only simulate electrons, photons and muons.')
+    K = grid.K
+    occupancy = np.zeros(K+1)
+    steps = 0
+
+    queue = []
+    if K > 0:
+        queue.append((np.zeros(1, dtype=np.int64), np.array([float(particle.energy)]),
+                      np.array([_KINDS[particle.type]]), np.array([float(particle.weight)])))
+
+    while queue:
+        # Take the most recent blocks of particles from the end of the queue, up to batch_size
+        blocks = []
+        size = 0
+        while queue and size < batch_size:
+            block = queue.pop()
+            take = min(batch_size - size, len(block[0]))
+            if take < len(block[0]):
+                queue.append(tuple(a[:-take] for a in block))
+                block = tuple(a[-take:] for a in block)
+            blocks.append(block)
+            size += take
+        g, energy, kind, weight = (np.concatenate(a) for a in zip(*blocks))
+        for o in observers:
+            o.on_batch(size)
+
+        # The position after the step in which each particle interacts. Muons do not interact.
+        m = np.searchsorted(grid.H, grid.H[g] + rng.exponential(size=size), side='right')
+        m[kind == _MUON] = K+1
+        end = np.minimum(m, K)
+        steps += int(np.sum(end - g))
+
+        # Ionising particles deposit in the steps g to end-1
+        ionising = kind != _PHOTON
+        occupancy += np.bincount(g[ionising], weight[ionising], minlength=K+1)
+        occupancy -= np.bincount(end[ionising], weight[ionising], minlength=K+1)
+
+        # Interacting particles above the cutoff split into two daughters, those below are absorbed.
+        # Daughters created in the last step are already out of the calorimeter.
+        split = (m < K) & (energy > _CUTOFF)
+        if np.any(split):
+            ms, es, ks, ws = m[split], energy[split], kind[split], weight[split]
+            fraction = rng.random(len(ms))
+            queue.append((np.concatenate([ms, ms]),
+                          np.concatenate([fraction*es, (1.0-fraction)*es]),
+                          np.concatenate([np.full(len(ms), _ELECTRON), np.where(ks == _ELECTRON, _PHOTON, _ELECTRON)]),
+                          np.concatenate([ws, ws])))
+
+    deposits = np.cumsum(occupancy)[:K]*grid.deposit
+    inside = grid.layer >= 0
+    ionisations = np.bincount(grid.layer[inside], deposits[inside], minlength=len(calorimeter._layers))
+    for volume, ionisation in zip(calorimeter._layers, ionisations):
+        volume.layer._ionisation = ionisation
+    if calorimeter._profile_bin_width is not None:
+        # the deposit of a step is recorded at the middle of the step, as in Calorimeter.step
+        nonzero = deposits > 0
+        calorimeter._profile_z.extend(grid.z[1:][nonzero] - 0.5*grid.step_size)
+        calorimeter._profile_deposits.extend(deposits[nonzero])
+
+    return steps
@@ -1,8 +1,7 @@
 import copy
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from matplotlib.lines import Line2D
+
+from .traces import save_traces, TraceFile
 
 class Calorimeter:
     '''This defines the calorimeter. The model is a strict one dimensinal model,
@@ -21,6 +20,9 @@ class Calorimeter:
         self._zend = 0
         self._trace_enabled = False
         self._particle_traces = []
+        self._profile_bin_width = None
+        self._profile_z = []
+        self._profile_deposits = []
 
     def add_layer(self, layer):
         '''Add a single layer to the back of the calorimeter.'''
@@ -32,25 +34,34 @@ class Calorimeter:
         for l in layers:
             self.add_layer(l)
 
-    def step(self, particle, step):
+    def volume(self, z):
+        '''Return the volume that contains the z position, or None if it is outside the layers.'''
+        for volume in self._layers:
+            if (z >= volume.z) and (z < volume.z + volume.layer._thickness):
+                return volume
+        return None
+
+    def step(self, particle, step, pool=None):
         '''Move a particle by the amount step forward in the calorimeter,
         Return a list of particles created during
         the step. If particle doesn't do anything it is just stepped forward.
-        If trace is enabled, records the particle trajectory.'''
+        If trace is enabled, records the particle trajectory.
+        With a ParticlePool "pool", an interacting particle is reused as one of the
+        particles created, so the particle can be in the returned list with new properties.'''
 
-        involume = False
-        for volume in self._layers:
-            if (particle.z >= volume.z) and (particle.z < volume.z + volume.layer._thickness):
-                involume = True
-                break
+        volume = self.volume(particle.z)
 
         particle.move(step)
 
         particles = [particle]
-        if involume:
+        if volume is not None:
             layer = volume.layer
             layer.ionise(particle, step)
-            particles = layer.interact(particle, step)
+            if self._profile_bin_width is not None and particle.ionise and layer._yield > 0:
+                # record the deposit at the middle of the step for the longitudinal profile
+                self._profile_z.append(particle.z - 0.5*step)
+                self._profile_deposits.append(layer._yield*step*particle.weight)
+            particles = layer.interact(particle, step, pool)
 
         return particles
 
@@ -63,10 +74,45 @@ class Calorimeter:
         return np.array([v.layer._ionisation for v in self._layers if not active or v.layer._yield>0])
 
     def reset(self):
-        '''Clears the recorded ionisation in each layer and particle traces'''
+        '''Clears the recorded ionisation in each layer, particle traces and the longitudinal profile'''
         for v in self._layers:
             v.layer._ionisation=0
         self._particle_traces = []
+        self._profile_z = []
+        self._profile_deposits = []
+
+    def enable_profile(self, bin_width):
+        '''Record the longitudinal profile of the ionisation along z in bins of
+        width bin_width, independent of the thickness of the layers.'''
+        self._profile_bin_width = bin_width
+        self._profile_z = []
+        self._profile_deposits = []
+
+    def disable_profile(self):
+        '''Stop recording the longitudinal profile.'''
+        self._profile_bin_width = None
+
+    def profile_edges(self, bin_width=None):
+        '''Provide an array of the z coordinates of the edges of the bins of the longitudinal
+        profile, for bins of width bin_width (default: the width the profile is recorded with).'''
+        if bin_width is None:
+            if self._profile_bin_width is None:
+                raise ValueError('The longitudinal profile is not enabled. Call enable_profile(bin_width) first, or give a bin_width.')
+            bin_width = self._profile_bin_width
+        nbins = int(np.ceil(self._zend/bin_width))
+        return np.arange(nbins+1)*bin_width
+
+    def profile(self):
+        '''Provide an array of the ionisation deposited in each bin of the longitudinal profile
+        since the last reset. The deposits are histogrammed in one go.
+        The middle of the last step of a particle leaving the back of the calorimeter can be
+        beyond its end, so such deposits are put in the last bin and the profile adds up to the
+        total ionisation.'''
+        if self._profile_bin_width is None:
+            raise ValueError('The longitudinal profile is not enabled. Call enable_profile(bin_width) first.')
+        nbins = int(np.ceil(self._zend/self._profile_bin_width))
+        bins = np.clip((np.array(self._profile_z)/self._profile_bin_width).astype(int), 0, nbins-1)
+        return np.bincount(bins, weights=self._profile_deposits, minlength=nbins)
 
     def __str__(self):
         txt = 'The layers of the calorimeter:\n'
@@ -95,7 +141,12 @@ class Calorimeter:
             final_trace = particle.trace + [(particle.z, particle.x, particle.y)]
             self._particle_traces.append((particle, final_trace))
 
-    def draw(self, ax=None, extend=15, show_traces=False):
+    def save_traces(self, filename):
+        '''Save the recorded particle traces to a compressed HDF5 file, see save_traces.
+        The file can be read with TraceFile and drawn with draw(traces=...).'''
+        save_traces(filename, self._particle_traces)
+
+    def draw(self, ax=None, extend=15, show_traces=False, traces=None, zlim=None):
         '''Draw the calorimeter design with z-axis horizontal.
         
         Parameters:
@@ -106,12 +157,22 @@ class Calorimeter:
             The perpendicular extent of the calorimeter (default: 10).
         show_traces : bool, optional
             If True, overlay recorded particle trajectories (default: False).
+        traces : TraceFile or list, optional
+            Traces to draw instead of the recorded ones, for example a TraceFile of traces
+            saved earlier. Only the traces inside the view are read from a TraceFile.
+        zlim : tuple, optional
+            The range of z to show (default: the whole calorimeter).
             
         Returns:
         --------
         matplotlib.axes.Axes
             The axes containing the drawing.
         '''
+        # matplotlib is only imported when drawing, so simulations can run without it
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as patches
+        from matplotlib.lines import Line2D
+
         if ax is None:
             fig, ax = plt.subplots(figsize=(12, 6))
         
@@ -144,22 +205,30 @@ class Calorimeter:
         muon_color = '#2ca02c'      # Green
         has_electron_trace = False
         has_muon_trace = False
-        if show_traces and self._particle_traces:
-            for particle, trace in self._particle_traces:
-                if particle.type not in ('elec', 'muon'):
+        if zlim is None:
+            zlim = (-0.5, self._zend + 0.5)
+        if traces is not None:
+            show_traces = True
+        elif show_traces:
+            traces = self._particle_traces
+        if show_traces and traces:
+            if isinstance(traces, TraceFile):
+                selected = traces.traces(zlim[0], zlim[1], ('elec', 'muon'))
+            else:
+                selected = ((particle.type, np.asarray(trace)) for particle, trace in traces)
+            for type, trace in selected:
+                if type not in ('elec', 'muon'):
                     continue
                 if len(trace) > 1:
-                    z_coords = [pos[0] for pos in trace]
-                    x_coords = [pos[1] for pos in trace]
-                    color = electron_color if particle.type == 'elec' else muon_color
-                    ax.plot(z_coords, x_coords, '-', color=color, linewidth=1.0, alpha=0.03)
-                    if particle.type == 'elec':
+                    color = electron_color if type == 'elec' else muon_color
+                    ax.plot(trace[:, 0], trace[:, 1], '-', color=color, linewidth=1.0, alpha=0.03)
+                    if type == 'elec':
                         has_electron_trace = True
                     else:
                         has_muon_trace = True
                     
         # Set axis properties
-        ax.set_xlim(-0.5, self._zend + 0.5)
+        ax.set_xlim(*zlim)
         ax.set_ylim(-extend/2 - 1, extend/2 + 3)
         ax.set_xlabel('z position (cm)', fontsize=12)
         ax.set_ylabel('Perpendicular extent (cm)', fontsize=12)
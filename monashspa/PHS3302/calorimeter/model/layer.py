@@ -14,17 +14,19 @@ class Layer:
         self._ionisation = 0
 
     def ionise(self, particle, step):
-        '''Records the ionisation in each layer from a particle going a certain length.'''
+        '''Records the ionisation in each layer from a particle going a certain length,
+        scaled by the statistical weight of the particle.'''
         if particle.ionise:
-            self._ionisation += self._yield*step
+            self._ionisation += self._yield*step*particle.weight
 
-    def interact(self, particle, step):
+    def interact(self, particle, step, pool=None):
         '''Let a particle interact (bremsstrahlung or pair production). The interaction
-        length is assumed to be the same for electrons and photons.'''
+        length is assumed to be the same for electrons and photons. The ParticlePool
+        "pool", if given, is passed on to Particle.interact.'''
         material = self._material*step
         particles = [particle]
         if random.random() < material:
-            particles = particle.interact()
+            particles = particle.interact(pool)
 
         return particles
 
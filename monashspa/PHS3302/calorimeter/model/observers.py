@@ -0,0 +1,132 @@
+from collections import Counter
+
+
+class Observer:
+    '''Base class for observers of a simulation, registered with Simulation.add_observer.
+    Override the hooks you are interested in. The hooks are:
+
+        on_event(index): an event (ingoing particle) starts
+        on_step(particle, layer, step): a particle moved by step (layer is None outside the layers)
+        on_interaction(particle, layer, daughters): a particle interacted and created the daughters
+        on_cutoff(particle, layer): a particle interacted below its energy cutoff and was absorbed
+        on_exit(particle): a particle left the back of the calorimeter
+        on_event_end(index): an event is complete
+        on_phase(name, seconds): wall time spent in a phase of the simulation
+        on_batch(size): the batched engine processes a batch of size particles
+
+    Observers are copied to the worker processes. Each copy starts from reset(), and the
+    copies are combined into the registered observer with merge() when the simulation returns.
+    When no observer is registered, the simulation uses a loop without any hooks.'''
+
+    def on_event(self, index):
+        pass
+
+    def on_step(self, particle, layer, step):
+        pass
+
+    def on_interaction(self, particle, layer, daughters):
+        pass
+
+    def on_cutoff(self, particle, layer):
+        pass
+
+    def on_exit(self, particle):
+        pass
+
+    def on_event_end(self, index):
+        pass
+
+    def on_phase(self, name, seconds):
+        pass
+
+    def on_batch(self, size):
+        pass
+
+    def reset(self):
+        '''Clear everything recorded so far.'''
+        pass
+
+    def merge(self, other):
+        '''Add what another copy of this observer recorded.'''
+        pass
+
+
+class Counters(Observer):
+    '''Profiling counters for a simulation:
+
+        steps: number of steps per layer name ("outside" for steps outside the layers)
+        interactions: number of interactions per particle type
+        cutoffs: number of particles absorbed below their cutoff per particle type
+        exits: number of particles leaving the calorimeter per particle type
+        particles_per_event: number of particles created in each event
+        phases: wall time in seconds per phase of the simulation
+        batch_sizes: number of batches per batch size (only for the batched engine)'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.steps = Counter()
+        self.interactions = Counter()
+        self.cutoffs = Counter()
+        self.exits = Counter()
+        self.particles_per_event = []
+        self.phases = Counter()
+        self.batch_sizes = Counter()
+        self._created = 0
+
+    def on_event(self, index):
+        self._created = 0
+
+    def on_step(self, particle, layer, step):
+        self.steps[layer._name if layer is not None else 'outside'] += 1
+
+    def on_interaction(self, particle, layer, daughters):
+        self.interactions[particle.type] += 1
+        self._created += len(daughters)
+
+    def on_cutoff(self, particle, layer):
+        self.cutoffs[particle.type] += 1
+
+    def on_exit(self, particle):
+        self.exits[particle.type] += 1
+
+    def on_event_end(self, index):
+        self.particles_per_event.append(self._created)
+
+    def on_phase(self, name, seconds):
+        self.phases[name] += seconds
+
+    def on_batch(self, size):
+        self.batch_sizes[size] += 1
+
+    def merge(self, other):
+        self.steps.update(other.steps)
+        self.interactions.update(other.interactions)
+        self.cutoffs.update(other.cutoffs)
+        self.exits.update(other.exits)
+        self.particles_per_event.extend(other.particles_per_event)
+        self.phases.update(other.phases)
+        self.batch_sizes.update(other.batch_sizes)
+
+    def __str__(self):
+        txt = ''
+        # the batched engine does not report steps and interactions
+        if self.steps:
+            txt += 'Steps per layer:\n'
+            for name, n in self.steps.most_common():
+                txt += f'    {name:10} {n}\n'
+        if self.interactions:
+            txt += 'Interactions per particle type:\n'
+            for name, n in self.interactions.most_common():
+                txt += f'    {name:10} {n}\n'
+        if self.particles_per_event and self.interactions:
+            txt += f'Particles created per event: {sum(self.particles_per_event)/len(self.particles_per_event):.1f}\n'
+        if self.batch_sizes:
+            batches = sum(self.batch_sizes.values())
+            particles = sum(size*n for size, n in self.batch_sizes.items())
+            txt += f'Batches: {batches}, mean size {particles/batches:.1f}, largest {max(self.batch_sizes)}\n'
+        txt += 'Wall time per phase:\n'
+        for name, t in self.phases.items():
+            txt += f'    {name:10} {t:.3f} s\n'
+        return txt
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+
+
+class OutputSpec:
+    '''Describes where Simulation.simulate stores the ionisations of the events.
+
+    Arguments:
+        dtype: the data type of the stored ionisations. float32 halves the memory (and disk
+               space) of float64, which is the default.
+        path: if given, the ionisations are written to a .npy file at this path as they are
+              simulated, and a numpy.memmap of the file is returned instead of an array in memory.
+              The file can be opened again later with numpy.load(path, mmap_mode='r').
+
+    The helpers in this package (energy_sums, resolution, readout) work chunk-wise, so they can be
+    used on a memory-mapped sample without loading it whole.'''
+
+    def __init__(self, dtype=np.float64, path=None):
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind != 'f':
+            raise ValueError('The dtype of the output must be a floating point type.')
+        self.path = None if path is None else os.fspath(path)
+
+    def allocate(self, shape, resume=False):
+        '''Return the array to store the ionisations in. With resume=True, an existing file at
+        path is opened (and checked against shape) instead of creating a new one.'''
+        if self.path is None:
+            return np.empty(shape, dtype=self.dtype)
+        if resume:
+            array = np.lib.format.open_memmap(self.path, mode='r+')
+            if array.shape != tuple(shape) or array.dtype != self.dtype:
+                raise ValueError('The output file {} has shape {} and dtype {}, but shape {} and dtype {} are needed.'.format(
+                    self.path, array.shape, array.dtype, tuple(shape), self.dtype))
+            return array
+        return np.lib.format.open_memmap(self.path, mode='w+', dtype=self.dtype, shape=tuple(shape))
+
+    def __repr__(self):
+        return 'OutputSpec(dtype={}, path={!r})'.format(self.dtype, self.path)
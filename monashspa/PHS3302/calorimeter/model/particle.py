@@ -1,9 +1,12 @@
 import random
 
 class Particle:
-    '''Base class for particles'''
+    '''Base class for particles. The trace of the particle (a list of (z, x, y) positions)
+    is only recorded if trace is a list, and not if it is None (the default).'''
 
-    def __init__(self, type, z, energy, ionise, cutoff, x=0, y=0, angle_x=0, angle_y=0, trace=None):
+    __slots__ = ('type', 'z', 'energy', 'ionise', 'cutoff', 'x', 'y', 'angle_x', 'angle_y', 'trace', 'weight')
+
+    def __init__(self, type, z, energy, ionise, cutoff, x=0, y=0, angle_x=0, angle_y=0, trace=None, weight=1.0):
         self.type = type
         self.z = z
         self.energy = energy
@@ -13,37 +16,47 @@ class Particle:
         self.y = y  # Transverse position (y-direction)
         self.angle_x = angle_x  # Angle with respect to z-axis in x-z plane
         self.angle_y = angle_y  # Angle with respect to z-axis in y-z plane
-        self.trace = trace if trace is not None else []  # List of (z, x, y) positions
+        self.trace = trace  # List of (z, x, y) positions, or None if the trace is not recorded
+        self.weight = weight  # Statistical weight when variance reduction is used
 
     def move(self, step):
         '''Move the particle forward by step, updating transverse position based on angle'''
         # Record current position before moving
-        self.trace.append((self.z, self.x, self.y))
-        
+        if self.trace is not None:
+            self.trace.append((self.z, self.x, self.y))
+
         # Update transverse positions based on angles
         self.x += step * self.angle_x
         self.y += step * self.angle_y
-        
+
         # Move forward in z
         self.z += step
 
-    def interact(self):
+    def interact(self, pool=None):
         '''This should implement the model for interaction.
         The base class particle doesn't interact at all'''
         return [self]
 
+    def _daughter_trace(self):
+        return self.trace.copy() if self.trace is not None else None
+
     def __str__(self):
         return f'{self.type:10} z:{self.z:.3f} E:{self.energy:.3f}'
 
 
 class Electron(Particle):
 
-    def __init__(self, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None):
-        super(Electron, self).__init__('elec', z, energy, True, 0.01, x, y, angle_x, angle_y, trace)
+    __slots__ = ()
+    _properties = ('elec', True, 0.01)
+
+    def __init__(self, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None, weight=1.0):
+        super(Electron, self).__init__('elec', z, energy, True, 0.01, x, y, angle_x, angle_y, trace, weight)
 
-    def interact(self):
+    def interact(self, pool=None):
         '''An electron radiates a photon. Make the energy split evenly.
-        New particles are created with a small random scattering angle.'''
+        New particles are created with a small random scattering angle.
+        With a ParticlePool, the electron itself becomes the outgoing electron and
+        the photon is taken from the pool, instead of creating two new particles.'''
         particles = []
         if self.energy > self.cutoff:
             split = random.random()
@@ -51,22 +64,35 @@ class Electron(Particle):
             angle_sigma = 0.02  # Standard deviation of scattering angle
             new_angle_x = self.angle_x + random.gauss(0, angle_sigma)
             new_angle_y = self.angle_y + random.gauss(0, angle_sigma)
-            
+
+            if pool is not None:
+                photon = pool.get(Photon, self.z, (1.0-split)*self.energy, self.x, self.y, new_angle_x, new_angle_y,
+                                  self._daughter_trace(), self.weight)
+                self.energy = split*self.energy
+                self.angle_x = new_angle_x
+                self.angle_y = new_angle_y
+                return [self, photon]
+
             particles = [
-                Electron(self.z, split*self.energy, self.x, self.y, new_angle_x, new_angle_y, self.trace.copy()),
-                Photon(self.z, (1.0-split)*self.energy, self.x, self.y, new_angle_x, new_angle_y, self.trace.copy())
+                Electron(self.z, split*self.energy, self.x, self.y, new_angle_x, new_angle_y, self._daughter_trace(), self.weight),
+                Photon(self.z, (1.0-split)*self.energy, self.x, self.y, new_angle_x, new_angle_y, self._daughter_trace(), self.weight)
             ]
         return particles
 
 
 class Photon(Particle):
 
-    def __init__(self, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None):
-        super(Photon, self).__init__('phot', z, energy, False, 0.01, x, y, angle_x, angle_y, trace)
+    __slots__ = ()
+    _properties = ('phot', False, 0.01)
+
+    def __init__(self, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None, weight=1.0):
+        super(Photon, self).__init__('phot', z, energy, False, 0.01, x, y, angle_x, angle_y, trace, weight)
 
-    def interact(self):
+    def interact(self, pool=None):
         '''A photon splits into an electron and a positron. Make the energy split evenly.
-        New particles are created with a small random scattering angle.'''
+        New particles are created with a small random scattering angle.
+        With a ParticlePool, the photon itself is turned into the first electron and
+        the second is taken from the pool, instead of creating two new particles.'''
         particles = []
         if self.energy > self.cutoff:
             split = random.random()
@@ -74,15 +100,73 @@ class Photon(Particle):
             angle_sigma = 0.05  # Standard deviation of scattering angle
             new_angle_x = self.angle_x + random.gauss(0, angle_sigma)
             new_angle_y = self.angle_y + random.gauss(0, angle_sigma)
-            
+
+            if pool is not None:
+                positron = pool.get(Electron, self.z, (1.0-split)*self.energy, self.x, self.y, new_angle_x, new_angle_y,
+                                    self._daughter_trace(), self.weight)
+                pool.recast(self, Electron)
+                self.energy = split*self.energy
+                self.angle_x = new_angle_x
+                self.angle_y = new_angle_y
+                return [self, positron]
+
             particles = [
-                Electron(self.z, split*self.energy, self.x, self.y, new_angle_x, new_angle_y, self.trace.copy()),
-                Electron(self.z, (1.0-split)*self.energy, self.x, self.y, new_angle_x, new_angle_y, self.trace.copy())
+                Electron(self.z, split*self.energy, self.x, self.y, new_angle_x, new_angle_y, self._daughter_trace(), self.weight),
+                Electron(self.z, (1.0-split)*self.energy, self.x, self.y, new_angle_x, new_angle_y, self._daughter_trace(), self.weight)
             ]
         return particles
 
 
 class Muon(Particle):
 
-    def __init__(self, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None):
-        super(Muon, self).__init__('muon', z, energy, True, 0.01, x, y, angle_x, angle_y, trace)
+    __slots__ = ()
+    _properties = ('muon', True, 0.01)
+
+    def __init__(self, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None, weight=1.0):
+        super(Muon, self).__init__('muon', z, energy, True, 0.01, x, y, angle_x, angle_y, trace, weight)
+
+
+class ParticlePool:
+    '''A free list of particle records, so that a shower reuses the particles that were
+    absorbed or left the calorimeter instead of creating new ones. At most "size" free
+    particles are kept. Only Electron, Photon and Muon (and subclasses that define
+    _properties) can be taken from the pool.
+
+    A particle given back with release() must not be used anymore by the caller.'''
+
+    def __init__(self, size=10000):
+        self._size = size
+        self._free = []
+
+    def get(self, cls, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None, weight=1.0):
+        '''Return a particle of class cls, reusing a free particle if there is one.'''
+        if self._free:
+            p = self._free.pop()
+        else:
+            p = object.__new__(cls)
+        self.recast(p, cls)
+        p.z = z
+        p.energy = energy
+        p.x = x
+        p.y = y
+        p.angle_x = angle_x
+        p.angle_y = angle_y
+        p.trace = trace
+        p.weight = weight
+        return p
+
+    @staticmethod
+    def recast(p, cls):
+        '''Turn the particle p into a particle of class cls in place.'''
+        p.__class__ = cls
+        p.type, p.ionise, p.cutoff = cls._properties
+
+    def release(self, p):
+        '''Give a particle that is no longer needed back to the pool.'''
+        if len(self._free) < self._size:
+            p.trace = None
+            self._free.append(p)
+
+    def __getstate__(self):
+        # The free particles are not worth sending to other processes
+        return {'_size': self._size, '_free': []}
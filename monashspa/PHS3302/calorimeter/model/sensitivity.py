@@ -0,0 +1,145 @@
+from collections import Counter
+
+import numpy as np
+
+from .observers import Observer
+
+
+class InteractionHistory(Observer):
+    '''Records for every event how many steps electrons and photons took in the layers with each
+    name, and in how many of those steps they interacted (including being absorbed below their
+    cutoff). Every step is a trial that interacts with probability material*step_size, so these
+    counts are all that is needed to reweight the event to a different material (see SensitivityScan).
+    Muons are not counted, as their interactions do not change the ionisation.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self._steps = Counter()
+        self._interactions = Counter()
+
+    def on_event(self, index):
+        self._steps = Counter()
+        self._interactions = Counter()
+
+    def on_step(self, particle, layer, step):
+        if layer is not None and particle.type != 'muon':
+            self._steps[layer._name] += 1
+
+    def on_interaction(self, particle, layer, daughters):
+        if layer is not None and particle.type != 'muon':
+            self._interactions[layer._name] += 1
+
+    def on_cutoff(self, particle, layer):
+        if layer is not None and particle.type != 'muon':
+            self._interactions[layer._name] += 1
+
+    def on_event_end(self, index):
+        self.events.append((index, self._steps, self._interactions))
+
+    def merge(self, other):
+        self.events.extend(other.events)
+
+    def counts(self, name):
+        '''Return two arrays with, per event (in the order of the event index), the number of
+        steps and the number of interactions in the layers called name.'''
+        events = sorted(self.events, key=lambda event: event[0])
+        steps = np.array([s[name] for index, s, i in events], dtype=np.int64)
+        interactions = np.array([i[name] for index, s, i in events], dtype=np.int64)
+        return steps, interactions
+
+
+class SensitivityScan:
+    '''Evaluate how the response of a calorimeter changes with the material (X0 per cm) and the
+    response (yield) of its layers, from a single simulated sample instead of a new simulation
+    for every variation.
+
+    The layers are identified by their name, so a variation applies to all layers with that name
+    (for example all lead layers). A change of the yield of an active layer scales its ionisation
+    exactly. A change of the material is evaluated by giving every event the likelihood ratio of
+    its interaction history under the changed and the simulated material as a weight::
+
+        scan = SensitivityScan(sim)
+        scan.run(Electron(0.0, 10.0), 1000, seed=1)
+        for material in (1.9, 2.0, 2.1):
+            print(material, scan.resolution(material={'lead': material}))
+
+    The weights work well for changes of a few percent. For large changes a few events get very
+    large weights; effective_size() shows how many events the weighted sample is worth.
+    The batched engine does not record the interaction history, so the simulation must use the
+    default engine.'''
+
+    def __init__(self, simulation):
+        if simulation._batch_size is not None:
+            raise ValueError('The sensitivity scan needs the default engine, the batched engine does not record the interaction history.')
+        self._simulation = simulation
+        self.ionisations = None
+        self.history = None
+
+    def _layers(self, name):
+        layers = [v.layer for v in self._simulation._calorimeter._layers if v.layer._name == name]
+        if not layers:
+            raise ValueError('The calorimeter has no layer called "{}".'.format(name))
+        return layers
+
+    def run(self, particle, number, deadcellfraction=0.0, seed=None, processes=None):
+        '''Simulate the sample that all variations are evaluated with. Returns the ionisations.'''
+        history = InteractionHistory()
+        self._simulation.add_observer(history)
+        try:
+            self.ionisations = self._simulation.simulate(particle, number, deadcellfraction, seed, processes)
+        finally:
+            self._simulation.remove_observer(history)
+        self.history = history
+        return self.ionisations
+
+    def weights(self, material=None):
+        '''Return the weight of every event for the materials in the dictionary
+        {layer name: X0 per cm}. Layers that are not given keep the simulated material.'''
+        if self.history is None:
+            raise ValueError('Run the simulation of the sample first with run().')
+        log_weights = np.zeros(len(self.ionisations))
+        step_size = self._simulation._step_size
+        for name, value in (material or {}).items():
+            p = self._layers(name)[0]._material*step_size
+            q = value*step_size
+            if not (0 < p < 1 and 0 <= q < 1):
+                raise ValueError('The probability to interact in a step must be below 1 for the material of "{}".'.format(name))
+            steps, interactions = self.history.counts(name)
+            # with q=0 (no material), events that interacted get weight 0 and the others weight (1-q)/(1-p) per step,
+            # so the interaction term is only added for the events that interacted
+            interacted = interactions > 0
+            with np.errstate(divide='ignore'):
+                log_weights[interacted] += interactions[interacted]*np.log(q/p)
+            log_weights += (steps - interactions)*np.log((1-q)/(1-p))
+        return np.exp(log_weights)
+
+    def scaled_ionisations(self, yields=None):
+        '''Return the ionisations of the sample for the responses in the dictionary
+        {layer name: response}. Layers that are not given keep the simulated response.'''
+        if self.ionisations is None:
+            raise ValueError('Run the simulation of the sample first with run().')
+        active = [v.layer for v in self._simulation._calorimeter._layers if v.layer._yield > 0]
+        scale = np.ones(len(active))
+        for name, value in (yields or {}).items():
+            nominal = self._layers(name)[0]._yield
+            if nominal <= 0:
+                raise ValueError('The layers called "{}" are not active, so their response cannot be scaled.'.format(name))
+            scale[[layer._name == name for layer in active]] = value/nominal
+        return self.ionisations*scale
+
+    def resolution(self, material=None, yields=None):
+        '''Return the weighted mean of the total ionisation and the relative resolution std(E)/mean(E)
+        for the given variation of the material and the yields.'''
+        energies = np.sum(self.scaled_ionisations(yields), axis=1)
+        w = self.weights(material)
+        mean = np.sum(w*energies)/np.sum(w)
+        std = np.sqrt(np.sum(w*(energies - mean)**2)/np.sum(w))
+        return mean, std/mean
+
+    def effective_size(self, material=None):
+        '''Return the number of unweighted events the weighted sample is worth, (sum w)^2/sum w^2.'''
+        w = self.weights(material)
+        return np.sum(w)**2/np.sum(w**2)
@@ -1,21 +1,68 @@
+import contextlib
 import copy
+import os
+import pickle
+import random
+import time
 import numpy as np
 from collections import deque
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 import multiprocessing as mp
 
+from .output import OutputSpec
+from .particle import ParticlePool
+from .batched import _StepGrid, _shower_batched
+
+
+def _event_seed(seed, index):
+    '''Return the seed for the random module used by event number "index" of a run
+    started with "seed". Every event gets its own reproducible random stream, so the
+    result of a run does not depend on how the events are shared between processes.'''
+    return int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+
+
+def _batch_rng(seed, index):
+    '''Return the random generator used by the batched engine for event number "index" of a run started with "seed".'''
+    return np.random.default_rng([seed, index, 2])
+
+
+def _deadcell_mask(size, deadcellfraction, seed, index):
+    '''Return a boolean mask of the dead cells for event number "index" of a run started with "seed".'''
+    rng = np.random.default_rng([seed, index, 1])
+    return rng.random(size) < deadcellfraction
+
+
+def _primary(calorimeter, particle):
+    '''Return a copy of the ingoing particle to follow through the calorimeter.'''
+    primary = copy.copy(particle)
+    # The copy needs its own trace, otherwise the ingoing particle accumulates the trace of every event.
+    # Without tracing, the trace is not recorded at all.
+    primary.trace = list(particle.trace or []) if calorimeter._trace_enabled else None
+    return primary
+
+
+def _shower(calorimeter, particle, step_size, variance_reduction=None, pool=None):
+    '''Follow a single ingoing particle and all the particles it creates through
+    the calorimeter. Returns the number of steps taken.
+
+    With a ParticlePool, interacting particles are reused as one of their daughters, and
+    particles that are absorbed or leave the calorimeter are given back to the pool.'''
+    particles = deque([_primary(calorimeter, particle)])
+    steps = 0
 
-def _run_single_simulation(args):
-    '''Helper function for parallel simulation of individual particles.
-    Takes a tuple of (calorimeter, particle, step_size) and returns ionisations.'''
-    calorimeter, particle, step_size = args
-    
-    calorimeter.reset()
-    particles = deque([copy.copy(particle)])
-    
     while particles:
         p = particles.popleft()
-        newparticles = calorimeter.step(p, step_size)
+        z_before = p.z
+        energy = p.energy
+        newparticles = calorimeter.step(p, step_size, pool)
+        steps += 1
+        if variance_reduction is not None:
+            # an interaction (or absorption) never returns exactly one particle
+            if len(newparticles) != 1:
+                newparticles = variance_reduction.roulette(energy, newparticles)
+            newparticles = variance_reduction.split(z_before, newparticles)
+        if pool is not None and not newparticles:
+            pool.release(p)
         # Only add particles that are still in the calorimeter
         for np_p in newparticles:
             if np_p.z < calorimeter._zend:
@@ -23,62 +70,404 @@ def _run_single_simulation(args):
             elif calorimeter._trace_enabled:
                 # Record trace when particle exits calorimeter
                 calorimeter.record_trace(np_p)
+            elif pool is not None:
+                pool.release(np_p)
+
+    return steps
+
+
+def _shower_observed(calorimeter, particle, step_size, variance_reduction, observers):
+    '''The same as _shower, but calls the hooks of the observers. This is a separate
+    loop, so that a simulation without observers does not pay for the hooks. Particles are
+    not reused from a pool here, so the observers can keep the particles they are given.'''
+    particles = deque([_primary(calorimeter, particle)])
+    steps = 0
+
+    while particles:
+        p = particles.popleft()
+        z_before = p.z
+        volume = calorimeter.volume(p.z)
+        layer = volume.layer if volume is not None else None
+        newparticles = calorimeter.step(p, step_size)
+        steps += 1
+        for o in observers:
+            o.on_step(p, layer, step_size)
+        if len(newparticles) != 1 or newparticles[0] is not p:
+            if newparticles:
+                for o in observers:
+                    o.on_interaction(p, layer, newparticles)
+            else:
+                for o in observers:
+                    o.on_cutoff(p, layer)
+            if variance_reduction is not None:
+                newparticles = variance_reduction.roulette(p.energy, newparticles)
+        if variance_reduction is not None:
+            newparticles = variance_reduction.split(z_before, newparticles)
+        for np_p in newparticles:
+            if np_p.z < calorimeter._zend:
+                particles.append(np_p)
+            else:
+                for o in observers:
+                    o.on_exit(np_p)
+                if calorimeter._trace_enabled:
+                    calorimeter.record_trace(np_p)
+
+    return steps
+
+
+def _run_events(args):
+    '''Helper function for parallel simulation of a range of events.
+    Takes a tuple of (simulation, particle, deadcellfraction, seed, start, stop) and returns
+    a tuple of the ionisations of events start to stop, the number of steps taken,
+    the observers (fresh copies of the observers of the simulation) that watched these events
+    and the longitudinal profiles of the events (None unless the calorimeter records them).'''
+    simulation, particle, deadcellfraction, seed, start, stop = args
+    calorimeter = simulation._calorimeter
+    step_size = simulation._step_size
+    variance_reduction = simulation._variance_reduction
+    pool = simulation._pool
+    batch_size = simulation._batch_size
+    if batch_size is not None:
+        grid = _StepGrid(calorimeter, particle.z, step_size)
+    observers = [copy.deepcopy(o) for o in simulation._observers]
+    for o in observers:
+        o.reset()
+
+    profile = calorimeter._profile_bin_width is not None
+
+    ionisations = []
+    profiles = []
+    steps = 0
+    if not observers:
+        for index in range(start, stop):
+            random.seed(_event_seed(seed, index))
+            calorimeter.reset()
+            if batch_size is None:
+                steps += _shower(calorimeter, particle, step_size, variance_reduction, pool)
+            else:
+                steps += _shower_batched(calorimeter, grid, particle, batch_size, _batch_rng(seed, index))
+            event = calorimeter.ionisations()
+            event[_deadcell_mask(event.shape, deadcellfraction, seed, index)] = 0
+            ionisations.append(event)
+            if profile:
+                profiles.append(calorimeter.profile())
+    else:
+        for index in range(start, stop):
+            t0 = time.perf_counter()
+            random.seed(_event_seed(seed, index))
+            calorimeter.reset()
+            for o in observers:
+                o.on_event(index)
+            t1 = time.perf_counter()
+            if batch_size is None:
+                steps += _shower_observed(calorimeter, particle, step_size, variance_reduction, observers)
+            else:
+                steps += _shower_batched(calorimeter, grid, particle, batch_size, _batch_rng(seed, index), observers)
+            t2 = time.perf_counter()
+            event = calorimeter.ionisations()
+            event[_deadcell_mask(event.shape, deadcellfraction, seed, index)] = 0
+            ionisations.append(event)
+            if profile:
+                profiles.append(calorimeter.profile())
+            t3 = time.perf_counter()
+            for o in observers:
+                o.on_event_end(index)
+                o.on_phase('setup', t1-t0)
+                o.on_phase('transport', t2-t1)
+                o.on_phase('readout', t3-t2)
+
+    ionisations = np.array(ionisations).reshape(stop-start, -1)
+    profiles = np.array(profiles, dtype=np.float32).reshape(stop-start, -1) if profile else None
+    return ionisations, steps, observers, profiles
+
+
+# The (simulation, particle, deadcellfraction, seed) of the run in the worker processes, see _worker_pool
+_worker_state = None
+
+
+def _run_range(event_range):
+    '''Helper function for a worker of _worker_pool: run the events start to stop of the
+    run in _worker_state, see _run_events. Only the event range is sent with the task.'''
+    return _run_events(_worker_state + event_range)
+
+
+def _attach_worker_state(name, size):
+    '''Pool initializer that loads _worker_state from the shared memory block "name".'''
+    global _worker_state
+    block = shared_memory.SharedMemory(name)
+    try:
+        _worker_state = pickle.loads(block.buf[:size])
+    finally:
+        block.close()
 
-    return calorimeter.ionisations()
+
+@contextlib.contextmanager
+def _worker_pool(processes, state):
+    '''Return a Pool of worker processes that know "state", the tuple
+    (simulation, particle, deadcellfraction, seed) of a run, so the tasks given to
+    _run_range are just ranges of event indices and the calorimeter is not pickled for
+    every task.
+
+    When the workers are forked, they inherit the state from this process (copy-on-write),
+    so it is not pickled at all. Otherwise (the spawn and forkserver start methods), the state
+    is pickled once into a shared memory block that every worker loads when it starts.'''
+    global _worker_state
+    if mp.get_start_method() == 'fork':
+        _worker_state = state
+        try:
+            with Pool(processes) as pool:
+                yield pool
+        finally:
+            _worker_state = None
+    else:
+        payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        block = shared_memory.SharedMemory(create=True, size=len(payload))
+        try:
+            block.buf[:len(payload)] = payload
+            with Pool(processes, initializer=_attach_worker_state, initargs=(block.name, len(payload))) as pool:
+                yield pool
+        finally:
+            block.close()
+            block.unlink()
+
+
+def _event_ranges(number, tasks):
+    '''Split "number" events into at most "tasks" contiguous (start, stop) ranges.'''
+    bounds = np.linspace(0, number, min(number, tasks)+1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _configuration(simulation, particle, number, deadcellfraction, start, profile_bin_width, output):
+    '''Return a description of a run with plain values, used to check that a checkpoint
+    belongs to the run it is resumed with.'''
+    layers = [(v.z, v.layer._name, v.layer._material, v.layer._thickness, v.layer._yield)
+              for v in simulation._calorimeter._layers]
+    return {
+        'layers': layers,
+        'step_size': simulation._step_size,
+        'variance_reduction': repr(simulation._variance_reduction),
+        'batch_size': simulation._batch_size,
+        'particle': (type(particle).__name__, particle.z, particle.energy, particle.x, particle.y,
+                     particle.angle_x, particle.angle_y),
+        'number': number,
+        'deadcellfraction': deadcellfraction,
+        'start': start,
+        'profile_bin_width': profile_bin_width,
+        'output': repr(output),
+    }
+
+
+def _save_checkpoint(filename, checkpoint):
+    '''Write a checkpoint to a temporary file first, so an interruption while
+    writing never leaves a corrupt checkpoint behind.'''
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+
+def _load_checkpoint(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
 
 
 class Simulation:
     '''A simulation is defined by a calorimeter. Then individual simulation runs can be created by
-    running the same particle through the calorimter multiple times.'''
-    def __init__(self, calorimeter):
+    running the same particle through the calorimter multiple times.
+
+    Optionally, a VarianceReduction can be given to use weighted transport (Russian roulette
+    and splitting), which gives the same expected ionisation at a fraction of the cost.
+
+    Giving a batch_size (for example 4096) selects the batched engine, which moves batches of
+    particles to their next interaction with numpy instead of following every particle step by
+    step. It simulates the same showers (with different random numbers, so a seeded run gives
+    different events than the default engine) and is much faster for energetic particles. It
+    does not follow the transverse positions and does not support variance reduction, and of the
+    observer hooks it only calls on_event, on_event_end, on_phase and on_batch.'''
+    def __init__(self, calorimeter, variance_reduction=None, batch_size=None):
+        if batch_size is not None and variance_reduction is not None:
+            raise ValueError('The batched engine does not support variance reduction.')
+        if batch_size is not None and batch_size < 1:
+            raise ValueError('The batch size must be at least 1.')
         self._calorimeter = calorimeter
+        self._variance_reduction = variance_reduction
+        self._batch_size = batch_size
+        self._step_size = 0.1
+        self._observers = []
+        self._pool = ParticlePool()
+
+    def create_particle(self, cls, z, energy, x=0, y=0, angle_x=0, angle_y=0, trace=None, weight=1.0):
+        '''Return a particle of class cls (Electron, Photon or Muon), reusing a particle
+        given back to the pool of the simulation if there is one.'''
+        return self._pool.get(cls, z, energy, x, y, angle_x, angle_y, trace, weight)
+
+    def release_particle(self, particle):
+        '''Give a particle that is no longer needed back to the pool of the simulation.'''
+        self._pool.release(particle)
+
+    def add_observer(self, observer):
+        '''Register an Observer (for example Counters) that is told about every step,
+        interaction, exit and cutoff of the particles in the simulation.'''
+        self._observers.append(observer)
 
-    
-    def simulate(self, particle, number, deadcellfraction=0.0):
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+
+
+    def simulate(self, particle, number, deadcellfraction=0.0, seed=None, processes=None, start=0,
+                 checkpoint=None, checkpoint_interval=300, profile_bin_width=None, output=None):
         '''Run a individual simulation. The ingoing particle is simulated going
         through the calorimeter "number" times. A 2D array is returned with the
         first axis the ionisation in the individual layers and the second corresponding to each
         new particle.
-        
-        Uses multiprocessing to parallelize individual particle simulations across available CPU cores.'''
-        # Prepare arguments for parallel execution
-        args_list = [(copy.deepcopy(self._calorimeter), particle, 0.1) for _ in range(number)]
-        
+
+        Uses multiprocessing to parallelize individual particle simulations across available CPU cores.
+        The number of worker processes can be set with "processes" (default: all CPU cores).
+        Giving an integer "seed" makes the result reproducible, independent of the number of processes.
+        A long run can be split into parts with the same seed by giving the index of the first
+        event of each part as "start".
+
+        If a "checkpoint" filename is given, the completed events are saved to it together with
+        the seed and configuration of the run at most every "checkpoint_interval" seconds and at the
+        end of the run. If the file already exists, the events in it are not simulated again and
+        the run continues with the same random streams, so the result is identical to an
+        uninterrupted run. See also Simulation.resume.
+
+        If "profile_bin_width" is given, the longitudinal profile of the ionisation along z is
+        also recorded in bins of that width (see Calorimeter.profile_edges(bin_width) for the bin edges),
+        independent of the layers. A tuple (ionisations, profiles) is then returned, where
+        profiles is a 2D float32 array with one row per particle.
+
+        An OutputSpec can be given as "output" to store the ionisations as float32, or in a
+        memory-mapped .npy file on disk for samples that do not fit in memory. Each range of events
+        is written into the output as soon as it is simulated. With a file and a checkpoint, the
+        checkpoint only records how many events are complete and the file holds the ionisations.'''
+        if output is None:
+            output = OutputSpec()
+        configuration = _configuration(self, particle, number, deadcellfraction, start, profile_bin_width, output)
+        ndone = 0
+        done_profiles = []
+        saved = None
+        if checkpoint is not None and os.path.exists(checkpoint):
+            saved = _load_checkpoint(checkpoint)
+            if saved['configuration'] != configuration or (seed is not None and seed != saved['seed']):
+                raise ValueError('The checkpoint {} was written by a different simulation.'.format(checkpoint))
+            seed = saved['seed']
+            # in memory, the checkpoint holds the completed events themselves
+            ndone = len(saved['ionisations']) if output.path is None else saved['events']
+            done_profiles = [saved['profiles']] if profile_bin_width is not None and saved['profiles'] is not None else []
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+
+        nlayers = len(self._calorimeter.positions())
+        ionisations = output.allocate((number, nlayers), resume=saved is not None and output.path is not None)
+        if saved is not None and output.path is None:
+            ionisations[:ndone] = saved['ionisations']
+
+        # The workers get a copy of the calorimeter that records the profile
+        sim = self
+        if profile_bin_width is not None:
+            sim = copy.copy(self)
+            sim._calorimeter = copy.deepcopy(self._calorimeter)
+            sim._calorimeter.enable_profile(profile_bin_width)
+
         # Use all available CPU cores for parallel simulation
-        num_cores = mp.cpu_count()
-        
-        with Pool(num_cores) as pool:
-            ionisations = pool.map(_run_single_simulation, args_list)
+        num_cores = mp.cpu_count() if processes is None else processes
+
+        # Each task is a range of events, so the calorimeter is only sent a few times to each worker.
+        # Use smaller tasks when checkpointing, so that there is something to save regularly.
+        tasks = 4*num_cores if checkpoint is None else 64*num_cores
+        event_ranges = [(start+ndone+first, start+ndone+last) for first, last in _event_ranges(number-ndone, tasks)]
+
+        def all_profiles():
+            if done_profiles:
+                return np.concatenate(done_profiles, axis=0)
+            # no events were run, so there is nothing to concatenate
+            return np.zeros((0, len(sim._calorimeter.profile_edges(profile_bin_width))-1), dtype=np.float32)
+
+        def save():
+            if output.path is not None:
+                # the events must be on disk before the checkpoint counts them
+                ionisations.flush()
+            _save_checkpoint(checkpoint, {
+                'configuration': configuration,
+                'seed': seed,
+                'simulation': self,
+                'particle': particle,
+                'output': output,
+                'events': ndone,
+                'ionisations': ionisations[:ndone] if output.path is None else None,
+                'profiles': all_profiles() if profile_bin_width is not None else None,
+            })
+
+        start_time = time.perf_counter()
+        with _worker_pool(num_cores, (sim, particle, deadcellfraction, seed)) as pool:
+            last_save = time.monotonic()
+            try:
+                for events, steps, observers, profiles in pool.imap(_run_range, event_ranges):
+                    ionisations[ndone:ndone+len(events)] = events
+                    ndone += len(events)
+                    if profiles is not None:
+                        done_profiles.append(profiles)
+                    for mine, theirs in zip(self._observers, observers):
+                        mine.merge(theirs)
+                    if checkpoint is not None and time.monotonic() - last_save > checkpoint_interval:
+                        save()
+                        last_save = time.monotonic()
+            except KeyboardInterrupt:
+                if checkpoint is not None and ndone:
+                    save()
+                raise
+
+        if checkpoint is not None:
+            save()
+        elif output.path is not None:
+            ionisations.flush()
+        for o in self._observers:
+            o.on_phase('simulate', time.perf_counter()-start_time)
 
-        allionisations = np.stack(ionisations, axis=0)
-        mask = np.random.random(allionisations.shape) < deadcellfraction
-        allionisations[mask] = 0
-        return allionisations
+        if profile_bin_width is not None:
+            return ionisations, all_profiles()
+        return ionisations
 
-    def simulate_with_tracing(self, particle, deadcellfraction=0.0):
+    @staticmethod
+    def resume(checkpoint, processes=None, checkpoint_interval=300):
+        '''Continue the simulation saved in the file "checkpoint" by Simulation.simulate
+        and return the ionisations of all its events (and the profiles, if they were recorded).'''
+        saved = _load_checkpoint(checkpoint)
+        configuration = saved['configuration']
+        sim = saved['simulation']
+        return sim.simulate(saved['particle'], configuration['number'], configuration['deadcellfraction'],
+                            saved['seed'], processes, configuration['start'], checkpoint, checkpoint_interval,
+                            configuration['profile_bin_width'], saved['output'])
+
+    def simulate_with_tracing(self, particle, deadcellfraction=0.0, seed=None):
         '''Run a single simulation with particle trajectory tracing enabled.
         This records the path of all particles created during the shower.
         Note: This is computationally expensive and should only be used for
         a single ingoing particle (number=1).
-        
+
         Returns:
         --------
         tuple : (ionisations, calorimeter)
             ionisations: Array of ionisation deposited in each layer
             calorimeter: The calorimeter object containing the recorded particle traces
         '''
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        random.seed(_event_seed(seed, 0))
+
         # Create a fresh copy of the calorimeter
         cal = copy.deepcopy(self._calorimeter)
         cal.enable_tracing()
         cal.reset()
-        
-        particles = deque([copy.copy(particle)])
+
+        particles = deque([_primary(cal, particle)])
         all_particles = []
-        
+
         while particles:
             p = particles.popleft()
-            newparticles = cal.step(p, 0.1)
-            
+            newparticles = cal.step(p, self._step_size)
+
             # If no new particles created (energy below cutoff), record the current particle
             if not newparticles:
                 all_particles.append(p)
@@ -90,13 +479,12 @@ class Simulation:
                     else:
                         # Record particles that exit the calorimeter
                         all_particles.append(np_p)
-        
+
         # Record all final particles
         for p in all_particles:
             cal.record_trace(p)
-        
+
         ionisations = cal.ionisations()
-        mask = np.random.random(ionisations.shape) < deadcellfraction
-        ionisations[mask] = 0
-        
+        ionisations[_deadcell_mask(ionisations.shape, deadcellfraction, seed, 0)] = 0
+
         return ionisations, cal
@@ -0,0 +1,123 @@
+import numpy as np
+
+
+def _import_h5py():
+    # h5py is only needed to save or load traces, so simulations can run without it
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Saving and loading particle traces requires the h5py package (pip install h5py).')
+    return h5py
+
+
+def save_traces(filename, traces, chunk_size=65536):
+    '''Save particle traces to a compressed HDF5 file, which can be read back with TraceFile.
+
+    Arguments:
+        filename: the name of the file to write.
+        traces: the traces as returned by Calorimeter.get_particle_traces(), a list of
+                (particle, trace_list) tuples, or a Calorimeter with recorded traces.
+
+    The positions of all traces are stored one after the other as a float32 (n, 3) array of
+    (z, x, y) in the dataset "coordinates", where trace i is the rows offsets[i] to offsets[i+1].
+    The type, final energy and z range of each trace are stored as well, so a part of the
+    traces can be selected without reading the positions.
+    '''
+    h5py = _import_h5py()
+    if hasattr(traces, 'get_particle_traces'):
+        traces = traces.get_particle_traces()
+
+    lengths = np.array([len(trace) for particle, trace in traces], dtype=np.int64)
+    offsets = np.zeros(len(traces)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    coordinates = np.empty((offsets[-1], 3), dtype=np.float32)
+    for (particle, trace), first, last in zip(traces, offsets[:-1], offsets[1:]):
+        coordinates[first:last] = trace
+    bounds = np.array([(c[:, 0].min(), c[:, 0].max()) if len(c) else (np.nan, np.nan)
+                       for c in (np.split(coordinates, offsets[1:-1]) if len(traces) else [])], dtype=np.float32).reshape(-1, 2)
+
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('offsets', data=offsets)
+        if len(coordinates):
+            f.create_dataset('coordinates', data=coordinates, chunks=(min(chunk_size, len(coordinates)), 3),
+                             compression='gzip', shuffle=True)
+        else:
+            # a chunked dataset needs chunks of at least one row, so an empty one is not chunked
+            f.create_dataset('coordinates', data=coordinates)
+        f.create_dataset('types', data=np.array([particle.type for particle, trace in traces], dtype='S4'))
+        f.create_dataset('energies', data=np.array([particle.energy for particle, trace in traces], dtype=np.float32))
+        f.create_dataset('zmin', data=bounds[:, 0])
+        f.create_dataset('zmax', data=bounds[:, 1])
+
+
+class TraceFile:
+    '''Lazy reader for particle traces saved with save_traces. Only the small per-trace
+    information (offsets, types, energies and z ranges) is read when the file is opened.
+    The positions are read when they are asked for, and only the part of the file that
+    holds the selected traces is read.
+
+    A TraceFile can be given to Calorimeter.draw as "traces" to draw the saved traces
+    without simulating them again::
+
+        with TraceFile('traces.h5') as traces:
+            cal.draw(traces=traces, zlim=(0, 10))
+    '''
+
+    def __init__(self, filename):
+        h5py = _import_h5py()
+        self._file = h5py.File(filename, 'r')
+        self._offsets = self._file['offsets'][()]
+        self.types = self._file['types'][()].astype(str)
+        self.energies = self._file['energies'][()]
+        self.zmin = self._file['zmin'][()]
+        self.zmax = self._file['zmax'][()]
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, i):
+        '''Return the type and the (n, 3) float32 array of (z, x, y) positions of trace i.'''
+        return self.types[i], self._file['coordinates'][self._offsets[i]:self._offsets[i+1]]
+
+    def select(self, zmin=None, zmax=None, types=None):
+        '''Return the indices of the traces that are (partly) inside zmin <= z <= zmax
+        and have one of the given particle types (for example ('elec', 'muon')).'''
+        selected = np.ones(len(self), dtype=bool)
+        if zmin is not None:
+            selected &= self.zmax >= zmin
+        if zmax is not None:
+            selected &= self.zmin <= zmax
+        if types is not None:
+            selected &= np.isin(self.types, list(types))
+        return np.flatnonzero(selected)
+
+    def traces(self, zmin=None, zmax=None, types=None, clip=True):
+        '''Iterate over (type, positions) of the traces selected as in select(). The positions of
+        consecutive selected traces are read together, in a single read per run of traces.
+        Particles only move forward in z, so with clip=True the positions of each trace are cut
+        to the z range, keeping one position on either side so the lines reach the edges.'''
+        indices = self.select(zmin, zmax, types)
+        if len(indices) == 0:
+            return
+        # split the selection into runs of consecutive traces
+        runs = np.split(indices, np.flatnonzero(np.diff(indices) != 1) + 1)
+        coordinates = self._file['coordinates']
+        for run in runs:
+            first = self._offsets[run[0]]
+            block = coordinates[first:self._offsets[run[-1]+1]]
+            for i in run:
+                trace = block[self._offsets[i]-first:self._offsets[i+1]-first]
+                if clip:
+                    lo = max(np.searchsorted(trace[:, 0], zmin, 'left')-1, 0) if zmin is not None else 0
+                    hi = np.searchsorted(trace[:, 0], zmax, 'right')+1 if zmax is not None else len(trace)
+                    trace = trace[lo:hi]
+                yield self.types[i], trace
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
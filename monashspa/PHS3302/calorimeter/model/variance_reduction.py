@@ -0,0 +1,64 @@
+import copy
+import random
+
+
+class VarianceReduction:
+    '''Weighted transport to reduce the time spent on the tails of a shower.
+
+    Russian roulette: a particle created with an energy below roulette_energy (by a parent
+    above it) survives with probability survival_probability and then carries its weight divided
+    by that probability. Its daughters inherit the weight.
+    Low energy particles are the most numerous in a shower but each deposits little, so
+    fewer of them are followed.
+
+    Splitting: a particle crossing the plane z=split_z (for example into the last layers,
+    to study punch through) is replaced by split_factor copies, each with the weight divided
+    by split_factor. More particles are followed in a rarely reached region.
+
+    The ionisation in each layer is scaled by the weight of the particles, so the expected
+    ionisation is the same as without variance reduction.'''
+
+    def __init__(self, roulette_energy=0.0, survival_probability=0.5, split_z=None, split_factor=2):
+        if not 0 < survival_probability <= 1:
+            raise ValueError('The survival probability must be larger than 0 and at most 1.')
+        if split_factor < 1:
+            raise ValueError('The split factor must be at least 1.')
+        self.roulette_energy = roulette_energy
+        self.survival_probability = survival_probability
+        self.split_z = split_z
+        self.split_factor = int(split_factor)
+
+    def roulette(self, parent_energy, particles):
+        '''Play Russian roulette with the particles created by a parent with energy parent_energy
+        (before the interaction). Only particles that are the first in their line below
+        roulette_energy take part, so the weight is not increased again in every generation.
+        Returns the surviving particles.'''
+        if parent_energy < self.roulette_energy:
+            return particles
+        survivors = []
+        for p in particles:
+            if p.energy < self.roulette_energy:
+                if random.random() >= self.survival_probability:
+                    continue
+                p.weight /= self.survival_probability
+            survivors.append(p)
+        return survivors
+
+    def split(self, z_before, particles):
+        '''Split the particles that crossed the splitting plane in a step starting at z_before.'''
+        if self.split_z is None or self.split_factor == 1:
+            return particles
+        split = []
+        for p in particles:
+            if z_before < self.split_z <= p.z:
+                p.weight /= self.split_factor
+                for i in range(self.split_factor - 1):
+                    c = copy.copy(p)
+                    c.trace = list(p.trace) if p.trace is not None else None
+                    split.append(c)
+            split.append(p)
+        return split
+
+    def __repr__(self):
+        return 'VarianceReduction(roulette_energy={}, survival_probability={}, split_z={}, split_factor={})'.format(
+            self.roulette_energy, self.survival_probability, self.split_z, self.split_factor)
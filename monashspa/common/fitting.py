@@ -15,7 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with monashspa.  If not, see <http://www.gnu.org/licenses/>.
 
-import random
+import ast
+import builtins
+from collections import OrderedDict
+from copy import deepcopy
+import functools
+import hashlib
+import json
+import os
+import pickle
 import traceback
 
 import lmfit
@@ -26,7 +34,7 @@ from warnings import warn
 class MonashSPAFittingException(Exception):
     pass
 
-def model_fit(model, parameters, x, y, u_y=None, **kwargs):
+def model_fit(model, parameters, x, y, u_y=None, multistart=None, processes=1, seed=None, statistic='chisquare', **kwargs):
     """A wrapper for fitting to an arbitrary model using lmfit.
 
     This function automatically inverts the array of standard errors
@@ -49,6 +57,39 @@ def model_fit(model, parameters, x, y, u_y=None, **kwargs):
     Keyword Arguments:
         u_y: An optional argument for providing a 1D numpy array of uncertainty 
              values for the y data points
+
+        multistart: An optional number of starting points to fit from, for
+                    models where the fit often ends in the wrong minimum. The
+                    given parameters are the first starting point. The others
+                    are drawn from a Latin hypercube, uniformly between the
+                    bounds of each parameter, or within a factor of 10 of its
+                    initial value for parameters that are not bounded on both
+                    sides. The fits can be run in a pool of processes, and the
+                    fit with the lowest chi-square is returned. All minima
+                    found are in the :code:`multistart` attribute of the result,
+                    a :py:class:`pandas.DataFrame` sorted by chi-square.
+
+        processes: The number of processes for a multistart fit. Defaults to
+                   1. Use :code:`None` for the number of CPUs. On Windows
+                   and macOS, a script that uses more than one process must
+                   put its code under :code:`if __name__ == '__main__':`.
+
+        seed: An optional seed for drawing the starting points of a
+              multistart fit.
+
+        statistic: The statistic that is minimised. The default, 'chisquare',
+                   is the weighted sum of the squared residuals. Use 'poisson'
+                   when y is the number of counts in each bin of a histogram
+                   (see :py:func:`histogram`), which minimises the
+                   Baker-Cousins likelihood ratio
+                   :code:`2*sum(mu - y + y*log(y/mu))`. This does not bias
+                   the fit when there are few counts per bin. u_y cannot be
+                   given, as the uncertainties follow from the model. The
+                   :code:`chisqr` of the result is the likelihood ratio, which
+                   is distributed like a chi-square for a good fit, and the
+                   uncertainties are from the Poisson (Fisher) information.
+                   For models made with :code:`make_lmfit_model(...,
+                   jacobian=True)` the fit uses the analytic derivatives.
     
     Returns:
         A :py:class:`lmfit.model.ModelResult` object from the `lmfit`_ Python library
@@ -56,6 +97,14 @@ def model_fit(model, parameters, x, y, u_y=None, **kwargs):
     .. _`lmfit`: https://lmfit.github.io/lmfit-py/
     
     """
+    if statistic not in ('chisquare', 'poisson'):
+        raise MonashSPAFittingException('Unknown statistic "{}". Use "chisquare" or "poisson".'.format(statistic))
+    if statistic == 'poisson' and u_y is not None:
+        raise MonashSPAFittingException('A Poisson fit does not take u_y, the uncertainties of the counts follow from the model.')
+
+    if multistart is not None and multistart > 1:
+        return __multistart_fit(model, parameters, x, y, u_y, multistart, processes, seed, dict(kwargs, statistic=statistic))
+
     # invert u_y because lmfit wants weights not sigma
     if u_y is not None:
         if not isinstance(u_y, np.ndarray):
@@ -94,6 +143,15 @@ def model_fit(model, parameters, x, y, u_y=None, **kwargs):
     elif len(missing_vars) == 1:
         kwargs[missing_vars[0]] = x 
 
+    if statistic == 'poisson':
+        return __poisson_fit(model, parameters, y, kwargs)
+
+    # use the derivatives of models made with make_lmfit_model(..., jacobian=True)
+    jacobian = __model_jacobian(model, parameters, kwargs)
+    if jacobian is not None:
+        kwargs['fit_kws'] = dict(kwargs.get('fit_kws') or {})
+        kwargs['fit_kws'].setdefault('Dfun', jacobian)
+
     try:
         fit_result = model.fit(y, parameters, weights=u_y, **kwargs)
     except ValueError:
@@ -104,6 +162,399 @@ def model_fit(model, parameters, x, y, u_y=None, **kwargs):
 
     return fit_result
 
+def model_fit_many(model, parameters, xs, ys, u_ys=None, processes=1, **kwargs):
+    """Fit the same model to many datasets.
+
+    This is equivalent to calling :py:func:`model_fit` for every dataset,
+    but much faster when there are many datasets. If all datasets have the
+    same length, they are fitted together: the model is evaluated for all
+    datasets at once (so it must accept 2D arrays, as models made with
+    :py:func:`make_lmfit_model` do) and the independent fits are solved
+    together. Otherwise (or if some parameters have bounds or constraints,
+    or additional keyword arguments are given) the datasets are fitted with
+    :py:func:`model_fit` in a pool of processes.
+
+    Note: Any additional keyword arguments passed to this function
+          will be passed directly to :py:func:`model_fit`.
+
+    Arguments:
+        model: a reference to a `lmfit`_ model.
+
+        parameters: a reference to a :py:class:`lmfit.parameters.Parameters`
+                    object with the initial values for every fit
+
+        xs: A list of 1D numpy arrays of x data points (one per dataset), or
+            a single 1D numpy array used for every dataset
+
+        ys: A list of 1D numpy arrays of y data points (one per dataset)
+
+    Keyword Arguments:
+        u_ys: An optional list of 1D numpy arrays of uncertainty values for
+              the y data points (one per dataset), or a single 1D numpy array
+              used for every dataset
+
+        processes: The number of processes used to fit datasets of different
+                   lengths. Defaults to 1. Use :code:`None` for the number
+                   of CPUs. On Windows and macOS, a script that uses more
+                   than one process must put its code under
+                   :code:`if __name__ == '__main__':`. Models that cannot be
+                   sent to other processes are always fitted in this process.
+
+    Returns:
+        A tuple of a list of :py:class:`lmfit.model.ModelResult` objects (one
+        per dataset) and a :py:class:`pandas.DataFrame` with one row per dataset,
+        containing the parameters and uncertainties (as returned by
+        :py:func:`get_fit_parameters`) and the chi-square of every fit.
+
+    .. _`lmfit`: https://lmfit.github.io/lmfit-py/
+
+    """
+    import pandas
+
+    ys = [np.asarray(y, dtype=float) for y in ys]
+    if len(xs) and np.ndim(xs[0]) == 0:
+        xs = [np.asarray(xs, dtype=float)]*len(ys)
+    else:
+        xs = [np.asarray(x, dtype=float) for x in xs]
+    if u_ys is None:
+        u_ys = [None]*len(ys)
+    elif len(u_ys) and np.ndim(u_ys[0]) == 0:
+        u_ys = [np.asarray(u_ys, dtype=float)]*len(ys)
+    else:
+        u_ys = [np.asarray(u_y, dtype=float) for u_y in u_ys]
+    if not len(xs) == len(ys) == len(u_ys):
+        raise MonashSPAFittingException('The number of x, y and u_y datasets passed to model_fit_many are not the same.')
+
+    results = None
+    if not kwargs and __can_fit_stacked(model, parameters, xs, ys, u_ys):
+        results = __fit_stacked(model, parameters, xs, ys, u_ys)
+    if results is None:
+        results = __fit_pool(model, parameters, xs, ys, u_ys, processes, kwargs)
+
+    table = pandas.DataFrame([get_fit_parameters(result) for result in results])
+    table['chisqr'] = [result.chisqr for result in results]
+    table['redchi'] = [result.redchi for result in results]
+    table['success'] = [result.success for result in results]
+
+    return results, table
+
+def toy_study(model, true_params, x, u_y, n_toys, params=None, seed=None, processes=1, block_size=1000, progress=False):
+    """Fit a model to many pseudo-datasets generated from it.
+
+    Pseudo-datasets (toys) are generated by adding Gaussian noise with standard
+    deviation :code:`u_y` to the model evaluated for :code:`true_params`,
+    and every toy is fitted with the model. The distributions of the fitted
+    parameters, their pulls and the chi-squares show whether a fit is biased
+    and whether its uncertainties and p-values can be trusted: for an unbiased
+    fit with correct uncertainties, the pulls follow a standard normal
+    distribution and the p-values a uniform distribution.
+
+    All toys are generated as one array, and fitted together in blocks as in
+    :py:func:`model_fit_many`.
+
+    Arguments:
+        model: a reference to a `lmfit`_ model.
+
+        true_params: the parameter values to generate the toys with, as a
+                     :py:class:`lmfit.parameters.Parameters` object or a
+                     dictionary of values
+
+        x: A 1D numpy array of x data points
+
+        u_y: A 1D numpy array of uncertainty values for the y data points
+
+        n_toys: The number of toys
+
+    Keyword Arguments:
+        params: The initial parameters for the fits. Defaults to the true
+                parameters.
+
+        seed: An optional seed, to generate the same toys again.
+
+        processes: The number of processes, if the toys cannot be fitted
+                   together (see :py:func:`model_fit_many`). Defaults to 1.
+
+        block_size: The number of toys fitted together.
+
+        progress: Set to :code:`True` to print the progress after every
+                  block, or a function to call as
+                  :code:`progress(fitted, n_toys)`.
+
+    Returns:
+        A dictionary of 1D numpy arrays with one entry per toy: the fitted
+        value of every varying parameter (under its name), its uncertainty
+        (:code:`u_` + name) and its pull (:code:`pull_` + name, the difference
+        between the fitted and true value divided by the uncertainty),
+        and the :code:`chisqr`, :code:`p_value` and :code:`success` of every fit.
+
+    .. _`lmfit`: https://lmfit.github.io/lmfit-py/
+
+    """
+    from scipy import stats
+
+    if not isinstance(true_params, lmfit.Parameters):
+        true_params = model.make_params(**true_params)
+    if params is None:
+        params = true_params
+    x = np.asarray(x, dtype=float)
+    u_y = np.broadcast_to(np.asarray(u_y, dtype=float), x.shape)
+    var = model.independent_vars[0]
+
+    # all toys at once
+    rng = np.random.default_rng(seed)
+    y_true = np.broadcast_to(model.eval(params=true_params, **{var: x}), x.shape)
+    Y = y_true + rng.standard_normal((n_toys, len(x)))*u_y
+
+    var_names = [name for name, par in params.items() if par.vary]
+    values = np.full((n_toys, len(var_names)), np.nan)
+    errors = np.full((n_toys, len(var_names)), np.nan)
+    chisqr = np.full(n_toys, np.nan)
+    success = np.zeros(n_toys, dtype=bool)
+    nfree = len(x) - len(var_names)
+    stacked = __can_fit_stacked(model, params, [x], [x], [u_y])
+
+    for first in range(0, n_toys, block_size):
+        block = slice(first, min(first + block_size, n_toys))
+        solution = None
+        if stacked:
+            size = block.stop - block.start
+            solution = __solve_stacked(model, params, np.broadcast_to(x, (size, len(x))), Y[block],
+                                       np.broadcast_to(1.0/u_y, (size, len(x))))
+        if solution is not None:
+            names, P, covar, chisqr[block], nfev, success[block], max_nfev = solution
+            values[block] = P
+            errors[block] = np.sqrt(np.diagonal(covar, axis1=1, axis2=2))
+        else:
+            stacked = False
+            results, table = model_fit_many(model, params, x, Y[block], u_y, processes=processes)
+            for j, name in enumerate(var_names):
+                values[block, j] = table[name]
+                errors[block, j] = [np.nan if result.params[name].stderr is None else result.params[name].stderr for result in results]
+            chisqr[block] = table['chisqr']
+            success[block] = table['success']
+
+        if callable(progress):
+            progress(block.stop, n_toys)
+        elif progress:
+            print('Fitted {:d} of {:d} toys'.format(block.stop, n_toys))
+
+    results = {}
+    for j, name in enumerate(var_names):
+        results[name] = values[:, j]
+        results['u_'+name] = errors[:, j]
+        with np.errstate(all='ignore'):
+            results['pull_'+name] = (values[:, j] - true_params[name].value)/errors[:, j]
+    results['chisqr'] = chisqr
+    results['p_value'] = stats.chi2.sf(chisqr, nfree)
+    results['success'] = success
+    return results
+
+def unbinned_fit(model, parameters, data, limits=None, extended=True, grid_size=1024, chunk_size=2**20, method='nelder', **kwargs):
+    """Unbinned maximum-likelihood fit of a model to a sample of events.
+
+    Instead of fitting a histogram of the events, the likelihood of every
+    event is used, so no information is lost to the binning. The model
+    describes the density of events as a function of :code:`x` (for example
+    :code:`"N/tau*exp(-x/tau) + b"` for a lifetime with a flat background).
+    With an extended likelihood (the default), the integral of the model
+    over the fit range is the expected number of events, so its amplitude
+    parameters are event yields. Otherwise only the shape of the model is
+    fitted, and one amplitude parameter must be fixed.
+
+    The integral is calculated numerically on a grid of points in the fit
+    range, which is cached, and the log-likelihood of the events is summed in
+    chunks of :code:`chunk_size` events, so the data can be a
+    :py:class:`numpy.memmap` of a sample that does not fit in memory.
+
+    Note: Any additional keyword arguments passed to this function
+          will be passed directly to :py:func:`lmfit.minimize`.
+
+    Arguments:
+        model: a reference to a `lmfit`_ model with a single independent variable
+
+        parameters: a reference to a :py:class:`lmfit.parameters.Parameters`
+                    object for your model
+
+        data: A 1D numpy array of the x values of the events
+
+    Keyword Arguments:
+        limits: A tuple of the lower and upper limit of the fit range. Events
+                outside the range are ignored. Defaults to the range of the data.
+
+        extended: A Boolean to indicate whether to use the extended likelihood,
+                  which includes the number of events. Defaults to :code:`True`.
+
+        grid_size: The number of points used to integrate the model.
+
+        chunk_size: The number of events evaluated at once.
+
+        method: The minimisation method, passed to :py:func:`lmfit.minimize`.
+                The minimum it finds is then refined with Newton steps.
+                Defaults to :code:`"nelder"` (Nelder-Mead), which copes best
+                with parameters of very different sizes (like yields and
+                lifetimes).
+
+    Returns:
+        A :py:class:`lmfit.minimizer.MinimizerResult` object from the `lmfit`_
+        Python library, which can be passed to :py:func:`get_fit_parameters`.
+        The uncertainties are calculated from the second derivatives of the
+        negative log-likelihood, which is in the :code:`nll` attribute.
+
+    .. _`lmfit`: https://lmfit.github.io/lmfit-py/
+
+    """
+    if len(model.independent_vars) != 1:
+        raise MonashSPAFittingException('An unbinned fit needs a model with a single independent variable.')
+    var = model.independent_vars[0]
+    if limits is None:
+        limits = (min(np.min(data[i:i+chunk_size]) for i in range(0, len(data), chunk_size)),
+                  max(np.max(data[i:i+chunk_size]) for i in range(0, len(data), chunk_size)))
+    lower, upper = float(limits[0]), float(limits[1])
+    if not upper > lower:
+        raise MonashSPAFittingException('The upper limit of the fit range must be above the lower limit.')
+    nodes, weights = __integration_grid(lower, upper, grid_size)
+
+    def chunks():
+        for first in range(0, len(data), chunk_size):
+            chunk = np.asarray(data[first:first+chunk_size], dtype=float)
+            yield chunk[(chunk >= lower) & (chunk <= upper)]
+    n_events = sum(len(chunk) for chunk in chunks())
+    if n_events == 0:
+        raise MonashSPAFittingException('There are no events in the fit range.')
+
+    def nll(params):
+        with np.errstate(all='ignore'):
+            expected = np.sum(weights*model.eval(params, **{var: nodes}))
+            log_likelihood = sum(np.sum(np.log(model.eval(params, **{var: chunk}))) for chunk in chunks())
+        if extended:
+            value = expected - log_likelihood
+        else:
+            value = n_events*np.log(expected) - log_likelihood
+        # the density must be positive at every event
+        return value if np.isfinite(value) and expected > 0 else 1e300
+
+    result = lmfit.minimize(nll, parameters, method=method, **kwargs)
+    # polish the minimum, and find the uncertainties
+    result.params, result.covar = __nll_newton(nll, result.params, result.var_names)
+    result.nll = nll(result.params)
+    result.nevents = n_events
+    result.errorbars = False
+    if result.covar is not None:
+        result.errorbars = True
+        for i, name in enumerate(result.var_names):
+            par = result.params[name]
+            par.stderr = float(np.sqrt(result.covar[i, i]))
+            par.correl = {other: float(result.covar[i, j]/np.sqrt(result.covar[i, i]*result.covar[j, j]))
+                          for j, other in enumerate(result.var_names) if j != i}
+        result.params.update_constraints()
+    return result
+
+def bin_indices(data, bins=100, limits=None):
+    """Finds the histogram bin of every event in a sample.
+
+    The bin indices only need to be found once. A histogram, or a histogram
+    with wider bins, is then made from them with :py:func:`histogram`
+    without going through the values of the events again, so refitting
+    after rebinning is fast. For equally spaced bins the index is
+    calculated directly from the value, without searching the bin edges.
+    As for :py:func:`numpy.histogram`, every bin includes its lower edge,
+    and the last bin also includes its upper edge.
+
+    Arguments:
+        data: A 1D numpy array of the x values of the events
+
+    Keyword Arguments:
+        bins: The number of equally spaced bins, or a 1D numpy array of
+              increasing bin edges. Defaults to 100.
+
+        limits: A tuple of the lower and upper edge of the equally spaced
+                bins. Defaults to the range of the data.
+
+    Returns:
+        A tuple of a 1D numpy array with the bin index of each event (-1 for
+        events outside the bins or NaN values) and a 1D numpy array of the
+        bin edges.
+
+    """
+    data = np.asarray(data, dtype=float).ravel()
+    if np.ndim(bins) == 0:
+        if limits is None:
+            finite = data[np.isfinite(data)]
+            limits = (finite.min(), finite.max()) if len(finite) else (0.0, 1.0)
+        lower, upper = float(limits[0]), float(limits[1])
+        if lower == upper:
+            lower, upper = lower - 0.5, upper + 0.5
+        if not upper > lower:
+            raise MonashSPAFittingException('The upper limit of the bins must be above the lower limit.')
+        n_bins = int(bins)
+        edges = np.linspace(lower, upper, n_bins + 1)
+        with np.errstate(invalid='ignore'):
+            inside = (data >= lower) & (data <= upper)
+        indices = np.full(len(data), -1, dtype=np.intp)
+        values = data[inside]
+        found = np.minimum(((values - lower)*(n_bins/(upper - lower))).astype(np.intp), n_bins - 1)
+        # correct for rounding, so the bins agree exactly with the edges
+        found -= values < edges[found]
+        found += (values >= edges[found + 1]) & (found < n_bins - 1)
+        indices[inside] = found
+    else:
+        edges = np.asarray(bins, dtype=float)
+        if edges.ndim != 1 or len(edges) < 2 or np.any(np.diff(edges) <= 0):
+            raise MonashSPAFittingException('The bin edges must be a 1D array of at least two increasing values.')
+        n_bins = len(edges) - 1
+        indices = np.searchsorted(edges, data, side='right') - 1
+        indices[data == edges[-1]] = n_bins - 1
+        indices[(indices >= n_bins) | np.isnan(data)] = -1
+    return indices, edges
+
+def histogram(indices, edges, rebin=1, weights=None):
+    """Makes a histogram from the bin indices found by :py:func:`bin_indices`.
+
+    The counts are made with :py:func:`numpy.bincount`, and bins are merged
+    by dividing the bin indices, so a histogram with wider bins does not
+    need the values of the events::
+
+        indices, edges = bin_indices(times, bins=1000, limits=(0, 20))
+        for rebin in (1, 2, 5, 10):
+            counts, wide_edges = histogram(indices, edges, rebin)
+            centres = (wide_edges[1:] + wide_edges[:-1])/2
+            fit_result = model_fit(model, params, centres, counts, statistic='poisson')
+
+    Arguments:
+        indices: A 1D numpy array of the bin index of each event, as returned
+                 by :py:func:`bin_indices`. Negative indices are ignored.
+
+        edges: A 1D numpy array of the bin edges, as returned by
+               :py:func:`bin_indices`
+
+    Keyword Arguments:
+        rebin: The number of neighbouring bins merged into each bin of the
+               histogram. If it does not divide the number of bins, the last
+               bin holds the remaining bins.
+
+        weights: An optional 1D numpy array of the weight of each event
+
+    Returns:
+        A tuple of a 1D numpy array of the counts (the sum of the weights) in
+        each bin and a 1D numpy array of the bin edges.
+
+    """
+    indices = np.asarray(indices)
+    edges = np.asarray(edges, dtype=float)
+    rebin = int(rebin)
+    if rebin < 1:
+        raise MonashSPAFittingException('rebin must be a positive integer.')
+    n_bins = len(edges) - 1
+    valid = indices >= 0
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[valid]
+    counts = np.bincount(indices[valid]//rebin, weights, minlength=-(-n_bins//rebin))
+    if n_bins % rebin:
+        edges = np.concatenate([edges[::rebin], edges[-1:]])
+    else:
+        edges = edges[::rebin]
+    return counts, edges
+
 def linear_fit(x, y, u_y=None, slope_guess=None, intercept_guess=None):
     """ General purpose linear fit function.
 
@@ -112,8 +563,9 @@ def linear_fit(x, y, u_y=None, slope_guess=None, intercept_guess=None):
     It attempts to fit your data to a model define by:
         :math:`y=mx+c`
     where :math:`m = slope` and :math:`c = intercept`.
-    If guesses for the slope and intercept are not explicitly provided when
-    calling this function, they will be inferred from the provided data arrays.
+    The slope and intercept (and their uncertainties) are calculated exactly
+    from weighted sums of the data, so no iterative fit is needed. Any guesses
+    provided are only used as the initial values of the returned result.
 
     Arguments:
         x: A 1D numpy array of x data points
@@ -125,10 +577,12 @@ def linear_fit(x, y, u_y=None, slope_guess=None, intercept_guess=None):
              values for the y data points
 
         slope_guess: An optional argument for providing an initial guess for the
-                     value of the slope parameter
+                     value of the slope parameter (kept for compatibility, the
+                     result does not depend on it)
 
         intercept_guess: An optional argument for providing an initial guess for the
-                         value of the intercept parameter
+                         value of the intercept parameter (kept for compatibility,
+                         the result does not depend on it)
 
     Returns:
         A :py:class:`lmfit.model.ModelResult` object from the `lmfit`_ Python library
@@ -138,20 +592,364 @@ def linear_fit(x, y, u_y=None, slope_guess=None, intercept_guess=None):
     """
     # Create Model
     model = LinearModel()
-    guess_kwargs = {}
-    # Create parameter guesses
-    if slope_guess is not None:
-        guess_kwargs['slope'] = slope_guess
-    if intercept_guess is not None:
-        guess_kwargs['intercept'] = intercept_guess
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if u_y is not None:
+        u_y = np.asarray(u_y, dtype=float)
+
+    to_check = [x, y] if u_y is None else [x, y, u_y]
+    if not all(np.isfinite(arr).all() for arr in to_check) or len(x) != len(y) or (u_y is not None and len(u_y) != len(y)):
+        raise MonashSPAFittingException('The fit failed. This is usually because the data you are fitting to contains NaN values, or the x, y and u_y arrays do not have the same length.')
+    if u_y is not None and np.any(u_y <= 0):
+        raise MonashSPAFittingException("The call to 'linear_fit(...)' failed. The uncertainties u_y must all be larger than zero.")
+
+    # The slope and intercept are calculated exactly from weighted sums,
+    # with x measured from its weighted mean so the sums do not lose precision
+    w = np.ones_like(y) if u_y is None else 1.0/u_y**2
+    sum_w = w.sum()
+    x_mean = (w*x).sum()/sum_w
+    y_mean = (w*y).sum()/sum_w
+    dx = x - x_mean
+    sum_wdxdx = (w*dx*dx).sum()
+    if len(x) < 2 or not sum_wdxdx > 0:
+        raise MonashSPAFittingException("The call to 'linear_fit(...)' failed. At least two different x values are needed to fit a straight line.")
+    slope = (w*dx*(y-y_mean)).sum()/sum_wdxdx
+    intercept = y_mean - slope*x_mean
+    # covariance matrix of (slope, intercept), in units of the (weighted) residuals
+    covar = np.array([[1.0/sum_wdxdx, -x_mean/sum_wdxdx],
+                      [-x_mean/sum_wdxdx, 1.0/sum_w + x_mean**2/sum_wdxdx]])
+
+    initial_parameters = model.make_params(slope=slope if slope_guess is None else slope_guess,
+                                           intercept=intercept if intercept_guess is None else intercept_guess)
+    fit_result = __known_fit_result(model, initial_parameters, y, u_y, {'x': x}, {'slope': slope, 'intercept': intercept}, covar,
+                                    message='Fit computed exactly with weighted linear least squares.')
 
-    initial_parameters = model.guess(y, x=x, **guess_kwargs)
+    return fit_result
 
-    fit_result = model_fit(model, initial_parameters, x, y, u_y)
+def __can_fit_stacked(model, parameters, xs, ys, u_ys):
+    # The datasets can be fitted together if they have the same length and
+    # the fit has no bounds or constraints (which the stacked solver does not handle)
+    if isinstance(model, lmfit.model.CompositeModel) or len(model.independent_vars) != 1 or model.nan_policy == 'omit':
+        return False
+    if len(set(len(y) for y in ys)) != 1 or any(len(x) != len(y) for x, y in zip(xs, ys)):
+        return False
+    if any(u_y is not None and len(u_y) != len(y) for u_y, y in zip(u_ys, ys)):
+        return False
+    if (u_ys[0] is None) != all(u_y is None for u_y in u_ys):
+        return False
+    for par in parameters.values():
+        if par.expr is not None or (par.vary and (np.isfinite(par.min) or np.isfinite(par.max))):
+            return False
+    return True
+
+def __fit_stacked(model, parameters, xs, ys, u_ys):
+    # Fit datasets of the same length at once, see __solve_stacked. Returns
+    # None if they have to be fitted one by one instead.
+    X = np.array(xs)
+    Y = np.array(ys)
+    W = np.ones_like(Y) if u_ys[0] is None else 1.0/np.array(u_ys)
+    solution = __solve_stacked(model, parameters, X, Y, W)
+    if solution is None:
+        return None
+    var_names, P, covar, chisqr, nfev, success, max_nfev = solution
+
+    results = []
+    init_params = deepcopy(parameters)
+    var = model.independent_vars[0]
+    for i in range(len(Y)):
+        message = 'Fit succeeded.' if success[i] else 'Fit aborted: number of function evaluations > {}'.format(max_nfev)
+        results.append(__known_fit_result(model, parameters, ys[i], u_ys[i], {var: xs[i]}, dict(zip(var_names, P[i])),
+                                          covar[i] if np.isfinite(covar[i]).all() else None,
+                                          int(nfev[i]), bool(success[i]), message, init_params))
+    return results
 
-    if not fit_result.success:
-        raise MonashSPAFittingException("The call to 'linear_fit(...)' failed. Perhaps try specifying a good guess for the 'gradient_guess' and/or 'intercept_guess' keyword arguments? The error message returned by the fitting algorithm was: {error}".format(error = fit_result.message))
+def __solve_stacked(model, parameters, X, Y, W, ftol=1.5e-8, xtol=1.5e-8):
+    # Levenberg-Marquardt for all datasets (the rows of X, Y and the weights W)
+    # at once. The fits are independent, so the Jacobian of the combined problem
+    # is block diagonal and the damped normal equations are solved as a stack of
+    # small (nvarys x nvarys) systems, each dataset with its own damping.
+    # Returns the names of the varying parameters, their values, the unscaled
+    # covariance matrices (NaN where unknown), the chi-squares, the numbers of
+    # function evaluations and whether each fit succeeded. Returns None if the
+    # model does not evaluate all datasets at once.
+    var = model.independent_vars[0]
+    N, n = Y.shape
+    if not (np.isfinite(X).all() and np.isfinite(Y).all() and np.isfinite(W).all()):
+        return None
+
+    var_names = [name for name, par in parameters.items() if par.vary]
+    roots = [name[len(model.prefix):] if name.startswith(model.prefix) else name for name in var_names]
+    p = len(var_names)
+    base = model.make_funcargs(parameters, {var: X})
+    derivatives = getattr(model, '_monashspa_derivatives', None)
+
+    def arguments(P, rows):
+        args = dict(base)
+        args[var] = X[rows]
+        for j, root in enumerate(roots):
+            args[root] = P[:, j, np.newaxis]
+        return args
+
+    def residuals(P, rows):
+        with np.errstate(all='ignore'):
+            F = model.func(**arguments(P, rows))
+        return (Y[rows] - np.broadcast_to(F, (len(rows), n)))*W[rows]
+
+    def jacobian(P, rows, R):
+        J = np.empty((len(rows), n, p))
+        if derivatives is not None:
+            arg_names, fn = derivatives
+            args = arguments(P, rows)
+            with np.errstate(all='ignore'):
+                columns = dict(zip([name for name in arg_names if name != var], fn(*[args[name] for name in arg_names])))
+            for j, root in enumerate(roots):
+                J[:, :, j] = -np.broadcast_to(columns[root], (len(rows), n))*W[rows]
+            return J, 0
+        # forward differences, with the same step as leastsq
+        for j in range(p):
+            h = np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(P[:, j]), 1.0)
+            P_h = P.copy()
+            P_h[:, j] += h
+            J[:, :, j] = (residuals(P_h, rows) - R)/h[:, np.newaxis]
+        return J, p
+
+    P = np.tile([parameters[name].value for name in var_names], (N, 1)).astype(float)
+    try:
+        R = residuals(P, np.arange(N))
+    except Exception:
+        return None
+    chisqr = (R**2).sum(axis=1)
+    damping = np.full(N, 1e-3)
+    nfev = np.ones(N, dtype=int)
+    max_nfev = 2000*(p+1)
+    done = np.zeros(N, dtype=bool)
+    success = np.ones(N, dtype=bool)
+    diagonal = np.arange(p)
+
+    while not done.all():
+        rows = np.flatnonzero(~done)
+        J, evaluations = jacobian(P[rows], rows, R[rows])
+        nfev[rows] += evaluations
+        A = np.einsum('mki,mkj->mij', J, J)
+        g = np.einsum('mki,mk->mi', J, R[rows])
+        A_damped = A.copy()
+        A_damped[:, diagonal, diagonal] += damping[rows, np.newaxis]*np.maximum(A[:, diagonal, diagonal], 1e-300)
+        try:
+            step = np.linalg.solve(A_damped, -g[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('mij,mj->mi', np.linalg.pinv(A_damped), -g)
+
+        P_new = P[rows] + step
+        R_new = residuals(P_new, rows)
+        nfev[rows] += 1
+        chisqr_new = (R_new**2).sum(axis=1)
+        better = np.isfinite(chisqr_new) & (chisqr_new <= chisqr[rows])
+        converged = better & (chisqr[rows] - chisqr_new <= ftol*chisqr[rows]) & \
+            np.all(np.abs(step) <= xtol*(np.abs(P[rows]) + xtol), axis=1)
+
+        accepted = rows[better]
+        P[accepted] = P_new[better]
+        R[accepted] = R_new[better]
+        chisqr[accepted] = chisqr_new[better]
+        damping[rows] = np.where(better, np.maximum(damping[rows]/10, 1e-12), damping[rows]*10)
+
+        # a fit that cannot be improved by even the smallest step is at its minimum
+        done[rows[converged | (damping[rows] > 1e16)]] = True
+        failed = rows[~done[rows] & (nfev[rows] >= max_nfev)]
+        success[failed] = False
+        done[failed] = True
+
+    # covariance matrices from the Jacobian at the solution
+    rows = np.arange(N)
+    J, evaluations = jacobian(P, rows, R)
+    A = np.einsum('mki,mkj->mij', J, J)
+    try:
+        covar = np.linalg.inv(A)
+    except np.linalg.LinAlgError:
+        covar = np.full((N, p, p), np.nan)
+        for i in range(N):
+            try:
+                covar[i] = np.linalg.inv(A[i])
+            except np.linalg.LinAlgError:
+                pass
+
+    return var_names, P, covar, chisqr, nfev, success, max_nfev
+
+def __fit_dataset(task):
+    # Fit a single dataset in a worker process of model_fit_many or a multistart
+    # fit. Models made by make_lmfit_model cannot be pickled, so they are made
+    # again here. Returns what is needed to fill in the ModelResult in the main process.
+    model, definition, parameters, x, y, u_y, kwargs = task
+    if definition is not None:
+        model = __make_model(definition)
+    fit_result = model_fit(model, parameters, x, y, u_y, **kwargs)
+    covar = fit_result.covar
+    if covar is not None and fit_result.scale_covar:
+        covar = covar/fit_result.redchi
+    return (fit_result.params.valuesdict(), covar, fit_result.nfev, fit_result.success, fit_result.message,
+            fit_result.userkws, fit_result.chisqr)
+
+def __fit_start(task):
+    # A starting point of a multistart fit may fail, which only removes it from the minima
+    try:
+        return __fit_dataset(task)
+    except MonashSPAFittingException:
+        return None
+
+def __map(function, tasks, processes):
+    # call function for every task, in a pool of processes if there is more than one
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(tasks) == 1:
+        return [function(task) for task in tasks]
+    import multiprocessing
+    with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+        return pool.map(function, tasks, chunksize=max(1, len(tasks)//(4*processes)))
+
+def __model_definition(model):
+    # A description of a model that can be pickled, from which __make_model makes
+    # the model again in a worker process. Models made by make_lmfit_model (and
+    # composites of them) cannot be pickled, so they are described by their
+    # arguments. Returns None if the model cannot be sent to another process.
+    definition = getattr(model, '_monashspa_definition', None)
+    if definition is not None:
+        return ('expression', definition)
+    if isinstance(model, lmfit.model.CompositeModel):
+        left, right = __model_definition(model.left), __model_definition(model.right)
+        if left is None or right is None:
+            return None
+        definition = ('composite', left, right, model.op)
+    else:
+        definition = ('model', model)
+    try:
+        pickle.dumps(definition)
+    except Exception:
+        return None
+    return definition
+
+def __make_model(definition):
+    if definition[0] == 'expression':
+        expression, independent_vars, allow_constant_model, jacobian, kwargs = definition[1]
+        return make_lmfit_model(expression, independent_vars, allow_constant_model, jacobian, **kwargs)
+    if definition[0] == 'composite':
+        return lmfit.model.CompositeModel(__make_model(definition[1]), __make_model(definition[2]), definition[3])
+    return definition[1]
+
+def __fit_pool(model, parameters, xs, ys, u_ys, processes, kwargs):
+    definition = __model_definition(model)
+    if definition is None:
+        processes = 1
+    tasks = [(model if definition is None else None, definition, parameters, x, y, u_y, kwargs)
+             for x, y, u_y in zip(xs, ys, u_ys)]
+    fits = __map(__fit_dataset, tasks, processes)
+
+    results = []
+    init_params = deepcopy(parameters)
+    for (values, covar, nfev, success, message, userkws, chisqr), y, u_y in zip(fits, ys, u_ys):
+        values = {name: value for name, value in values.items() if parameters[name].vary}
+        results.append(__known_fit_result(model, parameters, y, u_y, userkws, values, covar, nfev, success, message, init_params,
+                                          kwargs.get('statistic', 'chisquare')))
+    return results
+
+def __starting_points(parameters, number, seed):
+    # The given parameters and number-1 other starting points from a Latin hypercube:
+    # uniform between the bounds of a parameter, or log-uniform within a factor of
+    # 10 of its initial value (keeping its sign) if it is not bounded on both sides
+    from scipy.stats import qmc
+
+    var_names = [name for name, par in parameters.items() if par.vary and par.expr is None]
+    starts = [deepcopy(parameters)]
+    if number <= 1 or not var_names:
+        return starts
+    sample = qmc.LatinHypercube(d=len(var_names), seed=seed).random(number-1)
+    for row in sample:
+        start = deepcopy(parameters)
+        for name, u in zip(var_names, row):
+            par = start[name]
+            if np.isfinite(par.min) and np.isfinite(par.max):
+                value = par.min + u*(par.max - par.min)
+            else:
+                hint = par.value if np.isfinite(par.value) and par.value != 0 else 1.0
+                value = np.clip(hint*10**(2*u - 1), par.min, par.max)
+            par.set(value=value)
+        starts.append(start)
+    return starts
+
+def __multistart_fit(model, parameters, x, y, u_y, multistart, processes, seed, kwargs):
+    y = np.asarray(y, dtype=float)
+    if u_y is not None:
+        u_y = np.asarray(u_y, dtype=float)
+    definition = __model_definition(model)
+    if definition is None:
+        processes = 1
+    starts = __starting_points(parameters, multistart, seed)
+    tasks = [(model if definition is None else None, definition, start, x, y, u_y, kwargs) for start in starts]
+    fits = __map(__fit_start, tasks, processes)
+
+    found = [(fit, start) for fit, start in zip(fits, starts) if fit is not None and np.isfinite(fit[6])]
+    if not found:
+        raise MonashSPAFittingException('The fit failed from all {:d} starting points. This is usually either because (a) the bounds or guesses for the model parameters do not include the best fit, (b) you did not correctly specify the independent variable in your model (by default it must be "x"), or (c) the data you are fitting to contains NaN values.'.format(len(starts)))
+    (values, covar, nfev, success, message, userkws, chisqr), start = min(found, key=lambda item: item[0][6])
+    fit_result = __known_fit_result(model, start, y, u_y, userkws,
+                                    {name: value for name, value in values.items() if parameters[name].vary},
+                                    covar, nfev, success, message, statistic=kwargs.get('statistic', 'chisquare'))
+
+    import pandas
+    minima = pandas.DataFrame([fit[0] for fit, start in found])
+    minima['chisqr'] = [fit[6] for fit, start in found]
+    minima['success'] = [fit[3] for fit, start in found]
+    fit_result.multistart = minima.sort_values('chisqr', ignore_index=True)
+    return fit_result
 
+def __known_fit_result(model, initial_parameters, y, u_y, userkws, values, covar, nfev=1, success=True, message=None,
+                       init_params=None, statistic='chisquare'):
+    # Fill in a ModelResult for a fit whose solution is already known, in the
+    # same way ModelResult.fit does after running the minimizer. covar is the
+    # unscaled covariance matrix of the varying parameters (or None if it is
+    # not known). Without u_y it is scaled by the reduced chi-square, as in model_fit,
+    # except for a Poisson fit, whose residuals are the deviance residuals.
+    # Copying Parameters is slow, so many results can share one copy of the
+    # initial parameters as init_params.
+    poisson = statistic == 'poisson'
+    weights = None if u_y is None else 1.0/u_y
+    fit_result = lmfit.model.ModelResult(model, initial_parameters, scale_covar=u_y is None and not poisson, fcn_kws=userkws)
+    fit_result.data = y
+    fit_result.weights = weights
+    fit_result.init_params = deepcopy(initial_parameters) if init_params is None else init_params
+    fit_result.userargs = (y, weights)
+    fit_result.init_fit = model.eval(params=initial_parameters, **userkws)
+
+    result = fit_result.prepare_fit(initial_parameters)
+    for name, value in values.items():
+        result.params[name].value = value
+    result.params.update_constraints()
+    if poisson:
+        result.residual = __deviance_residuals(y, np.broadcast_to(model.eval(params=result.params, **userkws), np.shape(y)))
+    else:
+        result.residual = model._residual(result.params, y, weights, **userkws)
+    result.nfev = nfev
+    result.success = success
+    result.aborted = False
+    result.message = message
+    result._calculate_statistics()
+    result.covar = None if covar is None else np.array(covar, dtype=float)
+    if covar is not None:
+        fit_result._calculate_uncertainties_correlations()
+    else:
+        result.errorbars = False
+    fit_result.unprepare_fit()
+
+    for attr in dir(result):
+        if not attr.startswith('_'):
+            try:
+                setattr(fit_result, attr, getattr(result, attr))
+            except AttributeError:
+                pass
+    fit_result.init_values = model._make_all_args(fit_result.init_params)
+    fit_result.best_values = model._make_all_args(result.params)
+    fit_result.best_fit = model.eval(params=result.params, **userkws)
+    if len(y) > 1:
+        fit_result.rsquared = 1.0 - ((y - fit_result.best_fit)**2).sum()/max(np.finfo(float).tiny, ((y - y.mean())**2).sum())
     return fit_result
 
 def get_fit_parameters(fit_result):
@@ -197,41 +995,45 @@ def get_fit_parameters(fit_result):
             results['u_'+param_name] = np.nan
     return results
 
-# From https://bitbucket.org/labscript_suite/runmanager
-# Code written by Philip Starkey and he has relicensed and contributed
-# it as part of this Library
-class __TraceDictionary(dict):
+__unique_fn_id = 1
 
-    def __init__(self, *args, **kwargs):
-        self.trace_data = None
-        self.all_accessed_vars = None
-        dict.__init__(self, *args, **kwargs)
+# Cache of the compiled model functions of make_lmfit_model, see set_model_cache
+__model_cache = OrderedDict()
+__model_cache_size = 128
+__model_cache_path = None
 
-    def start_trace(self):
-        self.trace_data = []
-        self.all_accessed_vars = []
+def set_model_cache(maxsize=128, path=None):
+    """Configure the cache of models created by :py:func:`make_lmfit_model`.
 
-    def __getitem__(self, key):
-        # only trace things that don't exist
-        try:
-            dict.__getitem__(self, key)
-            self.all_accessed_vars.append(key)
-        except Exception:
-            if self.trace_data is not None:
-                if key not in self.trace_data:
-                    self.trace_data.append(key)
-        return dict.__getitem__(self, key)
-
-    def stop_trace(self):
-        trace_data = self.trace_data
-        all_accessed_vars = self.all_accessed_vars
-        self.trace_data = None
-        self.all_accessed_vars = None
-        return trace_data, all_accessed_vars
+    Creating a model from an expression requires finding the parameter
+    names and compiling a function, which is slow when the same expression
+    is used thousands of times (for example when grading or batch fitting).
+    The compiled functions of the most recently used expressions are
+    therefore kept in memory, and every call returns a new
+    :py:class:`lmfit.model.Model` that uses the cached function.
 
-__unique_fn_id = 1
+    Keyword Arguments:
+        maxsize: The number of expressions kept in memory. Set to 0 to
+                 disable the cache.
+
+        path: An optional directory to also store the parameter names
+              found for each expression in, so that other processes (or
+              later sessions) do not need to find them again.
+    """
+    global __model_cache_size, __model_cache_path
+    __model_cache_size = maxsize
+    __model_cache_path = path
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+    while len(__model_cache) > max(maxsize, 0):
+        __model_cache.popitem(last=False)
 
-def make_lmfit_model(expression, independent_vars=None, allow_constant_model=False, **kwargs):
+def clear_model_cache():
+    """Remove all models from the in-memory cache of :py:func:`make_lmfit_model`"""
+    __model_cache.clear()
+
+
+def make_lmfit_model(expression, independent_vars=None, allow_constant_model=False, jacobian=False, **kwargs):
     """A convenience function for creating a lmfit Model from an equation in a string
 
     This function takes an expression containing the right hand side of an
@@ -248,7 +1050,10 @@ def make_lmfit_model(expression, independent_vars=None, allow_constant_model=Fal
     For example, this is also a valid expression: :code:`"sin(x)+c"`.
 
     The expression must always be valid Python code, and must be able to 
-    be evaluated with every parameter set to a random floating point number.
+    be evaluated with every parameter set to a floating point number.
+    The parameters are the names in the expression that are not numpy,
+    scipy.special or Python builtin names, in the order they first appear
+    (after the independent variables).
 
     The independent variable is assumed to be :code:`x` unless otherwise
     specified. All other variables are assumed to be parameters you wish
@@ -258,6 +1063,13 @@ def make_lmfit_model(expression, independent_vars=None, allow_constant_model=Fal
     :py:meth:`lmfit.model.Model.make_params`, or 
     :py:meth:`lmfit.parameter.Parameters.add`.
 
+    Models are cached by expression and arguments (see
+    :py:func:`set_model_cache`), so creating the same model again is fast.
+
+    If the data is far from the scale of the hints (for example lifetimes
+    in picoseconds), use the :code:`guess` method of the returned model to
+    find starting values, for example :code:`params = model.guess(y, x=x)`.
+
     Note: Additional keyword arguments are passed directly to 
     :py:class:`lmfit.model.Model`.
 
@@ -286,6 +1098,14 @@ def make_lmfit_model(expression, independent_vars=None, allow_constant_model=Fal
                               also set this to :code:`True` to suppress the 
                               Exception and restore the default lmfit behaviour.
 
+        jacobian: A Boolean to indicate whether to differentiate the expression
+                  with respect to each parameter using sympy. The derivatives
+                  are then used by :py:func:`model_fit` instead of numerical
+                  derivatives, which needs fewer evaluations of the model and
+                  often converges better. Defaults to :code:`False`. An
+                  exception is raised if sympy cannot differentiate the
+                  expression.
+
     Returns:
         A :py:class:`lmfit.model.Model` object to be used for fitting with
         the lmfit library.
@@ -294,8 +1114,6 @@ def make_lmfit_model(expression, independent_vars=None, allow_constant_model=Fal
     
     """
 
-    global __unique_fn_id
-
     # assume "x" if not specified
     if independent_vars is None:
         independent_vars = ["x"]
@@ -303,124 +1121,560 @@ def make_lmfit_model(expression, independent_vars=None, allow_constant_model=Fal
     elif not isinstance(independent_vars, list):
         independent_vars = list(independent_vars)
 
-    # detect the parameter names in the expression if they are not provided
-    sandbox = __TraceDictionary()
-    # provide some basic numpy functionality
-    __model_sandbox_imports(sandbox)
-
     # warn if the independent vars are named after things that already exist in sandbox
     for param in independent_vars:
-        if param in sandbox:
+        if param in __sandbox_namespace():
             warn('\nYour independent variable "{}" shares a name with an item in the numpy or scipy libraries. This may cause unexpected behaviour. Please use something unique, such as "x".\n\n'.format(param))
 
-    # keep a list of parameters we should randomise every iteration 
-    # (to prevent things like divide by 0 exceptions!)
-    params_to_randomise = []
-    params_to_randomise.extend(independent_vars)
-
-    keep_trying = 5
-    success = False
-    while not success:
-        # set random values for each parameter we know about so far
-        for param in params_to_randomise:
-            r = random.random()*10
-            if random.random() < 0.05:
-                r += random.random()*1000
-            sandbox[param] = r
-
-        # attempt to evaluate the expression
-        sandbox.start_trace()
-        try:
-            code = compile(expression, '<string>', 'eval')
-            eval(code, sandbox)
-        except TypeError:
-            params, _ = sandbox.stop_trace()
-
-            problem_param = None
-            if params_to_randomise is not None:
-                if params_to_randomise[-1] not in independent_vars:
-                    problem_param = params_to_randomise[-1]
-            if problem_param is None:
-                for param in params:
-                    if param not in params_to_randomise:
-                        problem_param = param
-            if problem_param is None:
-                problem_param = "[Could not determine the parameter name]"
-
-            raise RuntimeError('Error occurred while evaluating the model function. The problem is likely with the use of "{var}" which is either an unknown function or a parameter that cannot be set to a floating point number.'.format(var=problem_param))
-        except Exception:
-            # An exception was raised! This is either because:
-            #   We found a new parameter name (great!)
-            #   The expression has an error (Bad!)
-            #
-            # So we get the params found in this evaluation, and
-            # see if any are new
-            params, _ = sandbox.stop_trace()
-            original_length = len(params_to_randomise)
-            for param in params:
-                if param not in params_to_randomise:
-                    params_to_randomise.append(param)
-
-            # decide whether we keep going or not depending on whether
-            # we found a new parameter
-            if len(params_to_randomise) == original_length:
-                keep_trying -= 1
-            else:
-                keep_trying += 1
+    key = repr((expression, independent_vars, allow_constant_model, jacobian, sorted(kwargs.items())))
+    if key in __model_cache:
+        __model_cache.move_to_end(key)
+        model_fn, params, derivatives = __model_cache[key]
+    else:
+        params = __load_cached_parameters(key, expression, independent_vars)
+        if params is None:
+            params = __find_parameters(expression, independent_vars, allow_constant_model)
+            __save_cached_parameters(key, params)
+        model_fn = __compile_model_function(expression, params, kwargs.get('prefix'))
+        derivatives = None
+        if jacobian:
+            derivatives = (params, __make_derivatives(expression, params, independent_vars, model_fn))
+        if __model_cache_size > 0:
+            __model_cache[key] = (model_fn, params, derivatives)
+            if len(__model_cache) > __model_cache_size:
+                __model_cache.popitem(last=False)
+
+    model = lmfit.models.Model(model_fn, independent_vars=independent_vars, **kwargs)
+    model._monashspa_derivatives = derivatives
+    # used by model_fit_many to make the model again in other processes
+    model._monashspa_definition = (expression, independent_vars, allow_constant_model, jacobian, kwargs)
 
-            if keep_trying <= 0:
-                raise
+    def guess(data, x=None, u_y=None, candidates=4096, rounds=4, seed=None, **kws):
+        """Guess starting values for the parameters of the model.
+
+        Batches of candidate parameters are drawn from a quasi-random
+        sequence (between the bounds set with
+        :py:meth:`lmfit.model.Model.set_param_hint`, or over a wide range
+        of magnitudes for parameters without bounds) and the model is
+        evaluated for all candidates of a batch at once. The candidates
+        with the lowest chi-square are returned as a
+        :py:class:`lmfit.parameter.Parameters` object, ready to be passed
+        to :py:func:`model_fit`. Each batch after the first searches closer
+        to the best candidate so far.
+
+        Arguments:
+            data: A 1D numpy array of y data points
+
+        Keyword Arguments:
+            x: A 1D numpy array of x data points
+
+            u_y: An optional 1D numpy array of uncertainty values for the y
+                 data points
+
+            candidates: The number of candidates in each batch
+
+            rounds: The number of batches
+
+            seed: An optional seed for drawing the candidates
+
+        Any other keyword arguments give the values of the other independent
+        variables.
+        """
+        return __guess_parameters(model, model_fn, params, independent_vars, data, x, u_y, candidates, rounds, seed, kws)
+    model.guess = guess
+
+    # set default parameter hints that are not just -Inf
+    for param in params:
+        if param not in independent_vars:
+            model.set_param_hint(param, value=1)
+
+    return model
+
+def __find_parameters(expression, independent_vars, allow_constant_model):
+    # detect the parameter names in the expression from its syntax tree:
+    # every name that is not a numpy/scipy.special/builtin name (or a name
+    # bound inside the expression, like a lambda argument) is a parameter
+    tree = ast.parse(expression, '<string>', 'eval')
+    sandbox = __sandbox_namespace()
+
+    used_vars = []
+    bound_vars = set()
+    called_vars = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                used_vars.append(node)
             else:
-                continue
-        
-        # if we get to here, everything evaluated!
-        success = True
-        params, all_params = sandbox.stop_trace()
-        for param in params:
-            if param not in params_to_randomise:
-                params_to_randomise.append(param)
-
-        # check if all of the independent variables are used as a parameter
-        for param in independent_vars:
-            if param not in all_params:
-                if not allow_constant_model:
-                    raise MonashSPAFittingException('You have not used the independent variable "{param}" in your model "{model}". Have you accidentally used a different variable name for your independent variable? This may produce unexpected results. Please update your model so that is is defined as a function of "{param}". If you are certain your model is correct, then you can suppress this exception by passing the optional argument "allow_constant_model=True" to the call to make_lmfit_model().'.format(param=param, model=expression))
-    
-    # params_to_randomise now contains everything we need!
+                bound_vars.add(node.id)
+        elif isinstance(node, ast.arg):
+            bound_vars.add(node.arg)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            called_vars.add(node.func.id)
+    # ast.walk is breadth first, so sort by position to get the order of appearance
+    used_vars.sort(key=lambda node: (node.lineno, node.col_offset))
+    used_vars = [node.id for node in used_vars]
+
+    # check if all of the independent variables are used as a parameter
+    for param in independent_vars:
+        if param not in used_vars and not allow_constant_model:
+            raise MonashSPAFittingException('You have not used the independent variable "{param}" in your model "{model}". Have you accidentally used a different variable name for your independent variable? This may produce unexpected results. Please update your model so that is is defined as a function of "{param}". If you are certain your model is correct, then you can suppress this exception by passing the optional argument "allow_constant_model=True" to the call to make_lmfit_model().'.format(param=param, model=expression))
+
+    params = list(independent_vars)
+    for name in used_vars:
+        if name in params or name in bound_vars or name in sandbox or hasattr(builtins, name):
+            continue
+        params.append(name)
+
+    # a parameter that is called is an unknown function, and a function that
+    # is not called was probably meant to be a parameter
+    problem_param = None
+    for name in params:
+        if name in called_vars:
+            problem_param = name
+            break
+    else:
+        for name in used_vars:
+            if name not in params and name not in called_vars and name not in bound_vars and callable(sandbox.get(name)):
+                problem_param = name
+                break
+
+    # confirm with a single evaluation. Parameters are numpy floats so that a
+    # singularity (like 1/x at x=0) gives inf or nan rather than an exception
+    for i, param in enumerate(params):
+        sandbox[param] = np.float64(1.0 + 0.1*i)
+    try:
+        with np.errstate(all='ignore'):
+            eval(compile(tree, '<string>', 'eval'), sandbox)
+    except TypeError:
+        if problem_param is None:
+            problem_param = "[Could not determine the parameter name]"
+        raise RuntimeError('Error occurred while evaluating the model function. The problem is likely with the use of "{var}" which is either an unknown function or a parameter that cannot be set to a floating point number.'.format(var=problem_param))
+
+    return params
+
+def __compile_model_function(expression, params, prefix=None):
+    global __unique_fn_id
 
     # provide a nice model function name
     # use prefix if it is provided to lmfit, or a unique incrementing name
-    if 'prefix' in kwargs:
-        fn_name = kwargs['prefix']
+    if prefix is not None:
+        fn_name = prefix
     else:
         fn_name = "custom_model_function_{:d}".format(__unique_fn_id)
         __unique_fn_id += 1
 
     # construct the function code in a string
     code_str = "def {:s}(".format(fn_name)
-    for i, param in enumerate(params_to_randomise):
+    for i, param in enumerate(params):
         code_str += param
-        if i < len(params_to_randomise)-1:
+        if i < len(params)-1:
             code_str += ", "
     code_str += "): return {expression}".format(expression=expression)
 
     # create fresh sandbox with standard imports
-    sandbox = {}
-    __model_sandbox_imports(sandbox)
+    sandbox = __sandbox_namespace()
     # compile our function code
     code = compile(code_str, 'model.py', 'exec')
     # execute it in the sandbox
     exec(code, sandbox, sandbox)
-    # extract the model function and create the model
-    model_fn = sandbox[fn_name]
-    model = lmfit.models.Model(model_fn, independent_vars=independent_vars, **kwargs)
+    # extract the model function
+    return sandbox[fn_name]
+
+# numpy names that are called something else in sympy
+__sympy_names = {
+    'arcsin': 'asin', 'arccos': 'acos', 'arctan': 'atan', 'arctan2': 'atan2',
+    'arcsinh': 'asinh', 'arccosh': 'acosh', 'arctanh': 'atanh',
+    'abs': 'Abs', 'absolute': 'Abs', 'e': 'E', 'power': 'Pow',
+}
+
+class __StripModulePrefix(ast.NodeTransformer):
+    # turn np.exp, numpy.exp and scipy.special.erf into exp and erf
+    def visit_Attribute(self, node):
+        base = node.value
+        if isinstance(base, ast.Name) and base.id in ('np', 'numpy'):
+            return ast.copy_location(ast.Name(id=node.attr, ctx=node.ctx), node)
+        if (isinstance(base, ast.Attribute) and base.attr == 'special'
+                and isinstance(base.value, ast.Name) and base.value.id == 'scipy'):
+            return ast.copy_location(ast.Name(id=node.attr, ctx=node.ctx), node)
+        return self.generic_visit(node)
+
+def __make_derivatives(expression, params, independent_vars, model_fn):
+    # differentiate the expression with respect to every parameter using sympy
+    import sympy
+    from sympy.core.function import AppliedUndef
+    from sympy.parsing.sympy_parser import parse_expr
+
+    error = 'The expression "{model}" cannot be differentiated symbolically{reason}. Use make_lmfit_model(..., jacobian=False) to fit with numerical derivatives instead.'
+    tree = __StripModulePrefix().visit(ast.parse(expression, '<string>', 'eval'))
+    symbols = [sympy.Symbol(param, real=True) for param in params]
+    local_dict = {name: getattr(sympy, sympy_name) for name, sympy_name in __sympy_names.items()}
+    local_dict.update(zip(params, symbols))
+    try:
+        expr = parse_expr(ast.unparse(tree), local_dict=local_dict)
+        derivatives = [sympy.diff(expr, symbol) for symbol, param in zip(symbols, params) if param not in independent_vars]
+    except Exception as e:
+        raise MonashSPAFittingException(error.format(model=expression, reason=' ({})'.format(e)))
+    unknown = expr.atoms(AppliedUndef) | (expr.free_symbols - set(symbols))
+    if unknown:
+        raise MonashSPAFittingException(error.format(model=expression, reason=' (sympy does not know "{}")'.format(', '.join(sorted(map(str, unknown))))))
+
+    # common subexpressions of the derivatives are only evaluated once
+    fn = sympy.lambdify(symbols, [expr] + derivatives, modules=['numpy', 'scipy'], cse=True)
+
+    # sympy and numpy do not always agree on what a function means (for example
+    # sinc), so check that sympy evaluates the expression the same way
+    values = [np.linspace(0.55, 2.35, 7) if param in independent_vars else 1.0 + 0.1*i for i, param in enumerate(params)]
+    with np.errstate(all='ignore'):
+        try:
+            expected = model_fn(*values)
+            result = fn(*values)[0]
+        except Exception as e:
+            raise MonashSPAFittingException(error.format(model=expression, reason=' ({})'.format(e)))
+    if not np.allclose(expected, result, rtol=1e-10, atol=0, equal_nan=True):
+        raise MonashSPAFittingException(error.format(model=expression, reason=' (sympy and numpy do not agree on its value)'))
+
+    def model_derivatives(*args):
+        return fn(*args)[1:]
+    return model_derivatives
+
+def __model_jacobian(model, parameters, kwargs):
+    # returns the Jacobian function of the residual of a model made with
+    # make_lmfit_model(..., jacobian=True), or None to use numerical derivatives
+    derivatives = getattr(model, '_monashspa_derivatives', None)
+    if derivatives is None or kwargs.get('method', 'leastsq') not in ('leastsq', 'least_squares'):
+        return None
+    # constraints and omitted NaN data would need to be taken into account
+    if any(par.expr is not None for par in parameters.values()):
+        return None
+    if kwargs.get('nan_policy', model.nan_policy) == 'omit':
+        return None
+
+    arg_names, derivatives = derivatives
+    param_names = [name for name in arg_names if name not in model.independent_vars]
+
+    def jacobian(params, data, weights, **kws):
+        values = model.make_funcargs(params, kws)
+        with np.errstate(all='ignore'):
+            columns = dict(zip(param_names, derivatives(*[values[name] for name in arg_names])))
+        var_names = [name for name, par in params.items() if par.vary]
+        jac = np.zeros((np.size(data), len(var_names)))
+        for i, name in enumerate(var_names):
+            root = name[len(model.prefix):] if name.startswith(model.prefix) else name
+            if root in columns:
+                # the residual is (data-model)*weights
+                jac[:, i] = -np.broadcast_to(columns[root], np.shape(data)).ravel()
+        if weights is not None:
+            jac *= np.ravel(weights)[:, np.newaxis]
+        return jac
+    return jacobian
+
+def __guess_parameters(model, model_fn, params, independent_vars, data, x, u_y, candidates, rounds, seed, kwargs):
+    # Screen batches of candidate parameter vectors with a single evaluation of
+    # the model function each, with the candidates along a leading axis, and
+    # return the parameters with the lowest weighted sum of squared residuals.
+    from scipy.stats import qmc
+
+    data = np.asarray(data, dtype=float).ravel()
+    weights = np.ones_like(data) if u_y is None else 1.0/np.asarray(u_y, dtype=float).ravel()
+    values = {}
+    for var in independent_vars:
+        if var in kwargs:
+            values[var] = np.asarray(kwargs[var], dtype=float)
+        elif x is not None:
+            values[var] = np.asarray(x, dtype=float)
+            x = None
+        else:
+            raise MonashSPAFittingException('You have not passed in all of your independent variables as keyword arguments')
+
+    # The parameters that are not fixed by their hints are screened. Parameters
+    # that are not bounded on both sides are drawn log-uniformly over a range of
+    # magnitudes that covers the scales of the data, with either sign.
+    hints = [model.param_hints.get(param, {}) for param in params if param not in independent_vars]
+    names = [param for param in params if param not in independent_vars]
+    free = [j for j, hint in enumerate(hints) if hint.get('vary', True) and 'expr' not in hint]
+    lower = np.array([hints[j].get('min', -np.inf) for j in free])
+    upper = np.array([hints[j].get('max', np.inf) for j in free])
+    bounded = np.isfinite(lower) & np.isfinite(upper)
+    scales = [1.0]
+    for arr in list(values.values()) + [data]:
+        finite = np.abs(arr[np.isfinite(arr) & (arr != 0)])
+        if len(finite):
+            scales.extend([np.max(finite), 1.0/np.max(finite)])
+    log_lo, log_hi = np.log10(min(scales)) - 3, np.log10(max(scales)) + 3
+
+    best = np.array([hint.get('value', 1.0) for hint in hints], dtype=float)
+    best[~np.isfinite(best)] = 1.0
+    best_chisqr = np.inf
+    sampler = qmc.Halton(d=max(len(free), 1), seed=seed)
+    # evaluate at most about 2**22 model values at once
+    chunk = max(1, 2**22//max(data.size, 1))
+
+    for r in range(rounds):
+        u = sampler.random(candidates)[:, :len(free)]
+        candidate = np.tile(best, (candidates+1, 1))
+        trial = np.empty((candidates, len(free)))
+        if r == 0:
+            trial[:, bounded] = lower[bounded] + u[:, bounded]*(upper - lower)[bounded]
+            sign = np.where(lower >= 0, 1.0, np.where(upper <= 0, -1.0, np.where(u < 0.5, -1.0, 1.0)))
+            t = np.where((lower >= 0) | (upper <= 0), u, np.abs(2*u - 1))
+            unbounded = sign*10**(log_lo + t*(log_hi - log_lo))
+        else:
+            # zoom in on the best candidate so far
+            centre = best[free]
+            trial[:, bounded] = centre[bounded] + (u[:, bounded] - 0.5)*(upper - lower)[bounded]/4**r
+            magnitude = np.log10(np.maximum(np.abs(centre), 10**log_lo))
+            unbounded = np.where(centre < 0, -1.0, 1.0)*10**(magnitude + (u - 0.5)*(log_hi - log_lo)/4**r)
+        trial[:, ~bounded] = unbounded[:, ~bounded]
+        candidate[1:, free] = np.clip(trial, lower, upper)
+
+        for first in range(0, len(candidate), chunk):
+            batch = candidate[first:first+chunk]
+            args = dict(values)
+            args.update({name: batch[:, j, np.newaxis] for j, name in enumerate(names)})
+            with np.errstate(all='ignore'):
+                residual = (data - np.broadcast_to(model_fn(**args), (len(batch), data.size)))*weights
+                chisqr = np.sum(residual**2, axis=1)
+            chisqr[~np.isfinite(chisqr)] = np.inf
+            i = np.argmin(chisqr)
+            if chisqr[i] < best_chisqr:
+                best_chisqr = chisqr[i]
+                best = batch[i].copy()
+
+    if not np.isfinite(best_chisqr):
+        raise MonashSPAFittingException('Could not guess the parameters of the model, as it could not be evaluated for any of the candidate parameters.')
+    parameters = model.make_params()
+    for name, value in zip(names, best):
+        parameters[model.prefix + name].set(value=value)
+    return parameters
+
+@functools.lru_cache(maxsize=32)
+def __integration_grid(lower, upper, size):
+    # nodes and weights of composite 8 point Gauss-Legendre integration from
+    # lower to upper, with (about) size nodes in total
+    order = 8
+    panels = max(1, size//order)
+    x, w = np.polynomial.legendre.leggauss(order)
+    edges = np.linspace(lower, upper, panels+1)
+    half_width = 0.5*np.diff(edges)
+    centres = 0.5*(edges[1:] + edges[:-1])
+    nodes = (centres[:, np.newaxis] + half_width[:, np.newaxis]*x).ravel()
+    weights = (half_width[:, np.newaxis]*w).ravel()
+    nodes.flags.writeable = False
+    weights.flags.writeable = False
+    return nodes, weights
+
+def __nll_newton(nll, params, var_names, iterations=10):
+    # Newton steps to the minimum of the negative log-likelihood, with its
+    # gradient and second derivatives from central differences. The inverse
+    # of the second derivatives at the minimum is the covariance matrix of the
+    # varying parameters. A first pass over the diagonal gives the scale of
+    # each parameter, so the steps are about a tenth of its uncertainty.
+    # Returns the parameters at the minimum and the covariance matrix (or
+    # None if it cannot be calculated).
+    params = deepcopy(params)
+    best = np.array([params[name].value for name in var_names], dtype=float)
+    lower = np.array([params[name].min for name in var_names], dtype=float)
+    upper = np.array([params[name].max for name in var_names], dtype=float)
+    n = len(best)
+    identity = np.eye(n)
+
+    def f(values):
+        for name, value in zip(var_names, values):
+            params[name].value = float(value)
+        params.update_constraints()
+        return nll(params)
+
+    f0 = f(best)
+    steps = 1e-4*np.maximum(np.abs(best), 1e-8)
+    for i in range(n):
+        curvature = (f(best + steps[i]*identity[i]) - 2*f0 + f(best - steps[i]*identity[i]))/steps[i]**2
+        if curvature > 0:
+            steps[i] = 0.1/np.sqrt(curvature)
+
+    covar = None
+    for iteration in range(iterations):
+        gradient = np.empty(n)
+        hessian = np.empty((n, n))
+        for i in range(n):
+            step_i = steps[i]*identity[i]
+            f_plus, f_minus = f(best + step_i), f(best - step_i)
+            gradient[i] = (f_plus - f_minus)/(2*steps[i])
+            hessian[i, i] = (f_plus - 2*f0 + f_minus)/steps[i]**2
+            for j in range(i):
+                step_j = steps[j]*identity[j]
+                hessian[i, j] = hessian[j, i] = (f(best + step_i + step_j) - f(best + step_i - step_j)
+                                                 - f(best - step_i + step_j) + f(best - step_i - step_j))/(4*steps[i]*steps[j])
+        try:
+            covar = np.linalg.inv(hessian)
+        except np.linalg.LinAlgError:
+            covar = None
+            break
+        if not (np.all(np.isfinite(covar)) and np.all(np.diag(covar) > 0)):
+            covar = None
+            break
+        # stop once the step would decrease the negative log-likelihood by less than 1e-6
+        step = -covar.dot(gradient)
+        if -0.5*gradient.dot(step) < 1e-6:
+            break
+        # halve the step until it decreases the negative log-likelihood
+        for halving in range(20):
+            trial = np.clip(best + step, lower, upper)
+            f_trial = f(trial)
+            if f_trial < f0:
+                break
+            step /= 2
+        else:
+            break
+        best, f0 = trial, f_trial
+        steps = np.minimum(steps, 0.1*np.sqrt(np.diag(covar)))
+
+    f(best)
+    return params, covar
+
+def __poisson_fit(model, parameters, y, kwargs):
+    # Fit counts by minimising the Baker-Cousins likelihood ratio. The fit
+    # minimises the sum of squares of the deviance residuals, which is the
+    # likelihood ratio, so leastsq can be used. The derivative of a deviance
+    # residual with respect to the expected counts is known, so the Jacobian is
+    # analytic for models made with make_lmfit_model(..., jacobian=True).
+    y = np.asarray(y, dtype=float)
+    if not np.all(np.isfinite(y)) or np.any(y < 0):
+        raise MonashSPAFittingException('A Poisson fit needs the number of counts in each bin, which cannot be negative or NaN.')
+    userkws = dict(kwargs)
+    method = userkws.pop('method', 'leastsq')
+    fit_kws = dict(userkws.pop('fit_kws', None) or {})
+    minimizer_kws = {name: userkws.pop(name) for name in ('max_nfev', 'nan_policy', 'iter_cb') if name in userkws}
+    userkws.pop('scale_covar', None)
+
+    def expected_counts(params):
+        return np.broadcast_to(model.eval(params=params, **userkws), y.shape)
+
+    def residual(params):
+        return __deviance_residuals(y, expected_counts(params))
+
+    model_jacobian = __model_jacobian(model, parameters, dict(userkws, method=method, **minimizer_kws))
+    if model_jacobian is not None:
+        def jacobian(params):
+            expected = expected_counts(params)
+            slope = __deviance_slope(y, expected, __deviance_residuals(y, expected))
+            # model_jacobian is the derivative of (data-model), so it has the opposite sign
+            return -slope[:, np.newaxis]*model_jacobian(params, y, None, **userkws)
+        fit_kws.setdefault('Dfun', jacobian)
 
-    # set default parameter hints that are not just -Inf
-    for param in params_to_randomise:
-        if param not in independent_vars:
-            model.set_param_hint(param, value=1)
+    try:
+        out = lmfit.minimize(residual, parameters, method=method, scale_covar=False, **minimizer_kws, **fit_kws)
+    except ValueError:
+        msg = traceback.format_exc()
+        msg += '\n'
+        msg += 'The fit failed. This is usually either because (a) you did not provide sufficient guesses for the model parameters, (b) the model predicts negative or NaN counts, or (c) you did not correctly specify the independent variable in your model (by default it must be "x").'
+        raise MonashSPAFittingException(msg)
+
+    var_names = [name for name, par in out.params.items() if par.vary]
+    covar = __poisson_covariance(model, out.params, var_names, y, expected_counts, model_jacobian, userkws)
+    return __known_fit_result(model, parameters, y, None, userkws, {name: out.params[name].value for name in var_names},
+                              covar, out.nfev, out.success, out.message, statistic='poisson')
+
+def __deviance_residuals(counts, expected):
+    # The signed square roots of the terms of the Baker-Cousins likelihood ratio
+    # 2*sum(mu - n + n*log(n/mu)), whose sum of squares is the likelihood ratio.
+    # Expected counts at or below zero get the term of a tiny mu plus 2*|mu|.
+    mu = np.maximum(expected, np.finfo(float).tiny)
+    terms = 2*(mu - counts + counts*np.log(np.where(counts > 0, counts, 1.0)/mu)) + 2*np.maximum(-expected, 0.0)
+    return np.where(counts > expected, 1.0, -1.0)*np.sqrt(np.maximum(terms, 0.0))
+
+def __deviance_slope(counts, expected, residuals):
+    # the derivative of the deviance residuals with respect to the expected
+    # counts, which is -1/sqrt(n) where a residual is zero
+    mu = np.maximum(expected, np.finfo(float).tiny)
+    slope = np.where(expected > 0, 1.0 - counts/mu, -1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(residuals != 0, slope/residuals, -1.0/np.sqrt(np.maximum(counts, 1.0)))
+
+def __poisson_covariance(model, params, var_names, y, expected_counts, model_jacobian, userkws):
+    # The covariance matrix of a Poisson fit, the inverse of the Fisher information
+    # sum(dmu/dp_i*dmu/dp_j/mu). The derivatives of the expected counts are
+    # analytic if model_jacobian is given, and central differences otherwise.
+    if not var_names:
+        return None
+    expected = expected_counts(params)
+    if model_jacobian is not None:
+        derivatives = -model_jacobian(params, y, None, **userkws)
+    else:
+        params = deepcopy(params)
+        derivatives = np.empty((len(y), len(var_names)))
+        for i, name in enumerate(var_names):
+            par = params[name]
+            value = par.value
+            step = 1e-6*abs(value) if value != 0 else 1e-8
+            par.value = value + step
+            params.update_constraints()
+            upper, f_upper = par.value, expected_counts(params).copy()
+            par.value = value - step
+            params.update_constraints()
+            lower, f_lower = par.value, expected_counts(params).copy()
+            par.value = value
+            params.update_constraints()
+            derivatives[:, i] = (f_upper - f_lower)/(upper - lower) if upper > lower else 0.0
+    positive = expected > 0
+    information = (derivatives[positive]/expected[positive, np.newaxis]).T.dot(derivatives[positive])
+    try:
+        covar = np.linalg.inv(information)
+    except np.linalg.LinAlgError:
+        return None
+    if not (np.all(np.isfinite(covar)) and np.all(np.diag(covar) > 0)):
+        return None
+    return covar
+
+def __cache_filename(key):
+    return os.path.join(__model_cache_path, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+def __load_cached_parameters(key, expression, independent_vars):
+    if __model_cache_path is None:
+        return None
+    try:
+        with open(__cache_filename(key)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # guard against hash collisions
+    if not isinstance(entry, dict) or entry.get('key') != key:
+        return None
+    # a stale or edited file must not give the model the wrong parameters, so the
+    # names must be the independent variables followed by other names in the expression
+    params = entry.get('parameters')
+    if not isinstance(params, list) or not all(isinstance(name, str) and name.isidentifier() for name in params):
+        return None
+    try:
+        names = {node.id for node in ast.walk(ast.parse(expression, '<string>', 'eval')) if isinstance(node, ast.Name)}
+    except SyntaxError:
+        return None
+    if params[:len(independent_vars)] != independent_vars or len(set(params)) != len(params) or not set(params) <= names:
+        return None
+    return params
+
+def __save_cached_parameters(key, params):
+    if __model_cache_path is None:
+        return
+    filename = __cache_filename(key)
+    # write to a temporary file first, so other processes never read a partial file
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w') as f:
+            json.dump({'key': key, 'parameters': params}, f)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        warn('Could not write to the model cache in {}'.format(__model_cache_path))
+
+__sandbox = None
+
+def __sandbox_namespace():
+    # The numpy and scipy.special imports are done once, and a copy is returned
+    global __sandbox
+    if __sandbox is None:
+        __sandbox = {}
+        __model_sandbox_imports(__sandbox)
+    return dict(__sandbox)
 
-    return model
 
 def __model_sandbox_imports(sandbox):
     # scipy functions
@@ -0,0 +1,453 @@
+# Copyright 2019 School of Physics & Astronomy, Monash University
+#
+# This file is part of monashspa.
+#
+# monashspa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# monashspa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with monashspa.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+def make_calorimeter():
+    import monashspa.PHS3302.calorimeter.model as model
+
+    cal = model.Calorimeter()
+    lead = model.Layer('lead', 2.0, 0.5, 0.0)
+    scintillator = model.Layer('Scin', 0.01, 0.5, 1.0)
+    for i in range(10):
+        cal.add_layers([lead, scintillator])
+    return cal
+
+def test_seeded_simulation():
+    """Test that a seeded simulation does not depend on the number of processes"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+
+    sim = model.Simulation(make_calorimeter())
+    result1 = sim.simulate(model.Electron(0.0, 1.0), 6, deadcellfraction=0.1, seed=3, processes=1)
+    result2 = sim.simulate(model.Electron(0.0, 1.0), 6, deadcellfraction=0.1, seed=3, processes=2)
+
+    success = result1.shape == (6, 10) and np.array_equal(result1, result2)
+    if not success:
+        print(' '*8 + 'Results of the two simulations differ.')
+        print(' '*(8+4) + 'One process: {}'.format(result1))
+        print(' '*(8+4) + 'Two processes: {}'.format(result2))
+
+    return success
+
+def test_checkpoint_resume():
+    """Test that resuming a simulation from a checkpoint gives the same result as an uninterrupted run"""
+
+    ### Get results ###
+    import os
+    import pickle
+    import tempfile
+    import monashspa.PHS3302.calorimeter.model as model
+
+    sim = model.Simulation(make_calorimeter())
+    expected_result = sim.simulate(model.Electron(0.0, 1.0), 8, deadcellfraction=0.1, seed=5, processes=1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint = os.path.join(tmpdir, 'checkpoint.pkl')
+        sim.simulate(model.Electron(0.0, 1.0), 8, deadcellfraction=0.1, seed=5, processes=1, checkpoint=checkpoint)
+        # pretend the run was interrupted after the first 3 events
+        with open(checkpoint, 'rb') as f:
+            saved = pickle.load(f)
+        saved['ionisations'] = saved['ionisations'][:3]
+        with open(checkpoint, 'wb') as f:
+            pickle.dump(saved, f)
+
+        result = model.Simulation.resume(checkpoint, processes=1)
+
+    success = np.array_equal(result, expected_result)
+    if not success:
+        print(' '*8 + 'Resumed simulation differs from uninterrupted simulation.')
+        print(' '*(8+4) + 'Expected value: {}'.format(expected_result))
+        print(' '*(8+4) + 'Actual value: {}'.format(result))
+
+    return success
+
+def test_distributed_simulation():
+    """Test that a distributed simulation with workers on localhost gives the same result as simulate"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+    from monashspa.PHS3302.calorimeter.distributed import run_coordinator
+
+    sim = model.Simulation(make_calorimeter())
+    expected_result = sim.simulate(model.Electron(0.0, 1.0), 8, deadcellfraction=0.1, seed=7, processes=1)
+    result = run_coordinator(sim, model.Electron(0.0, 1.0), 8, deadcellfraction=0.1, seed=7,
+                             address=('127.0.0.1', 0), authkey=b'monashspa tests', task_size=3, local_workers=2)
+
+    success = np.array_equal(result, expected_result)
+    if not success:
+        print(' '*8 + 'Distributed simulation differs from simulate.')
+        print(' '*(8+4) + 'Expected value: {}'.format(expected_result))
+        print(' '*(8+4) + 'Actual value: {}'.format(result))
+
+    return success
+
+def test_counters():
+    """Test that the profiling counters record the simulation without changing it"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+
+    sim = model.Simulation(make_calorimeter())
+    expected_result = sim.simulate(model.Electron(0.0, 1.0), 5, seed=9, processes=1)
+    counters = model.Counters()
+    sim.add_observer(counters)
+    result = sim.simulate(model.Electron(0.0, 1.0), 5, seed=9, processes=2)
+
+    success = np.array_equal(result, expected_result)
+    if len(counters.particles_per_event) != 5 or counters.steps['lead'] == 0 or counters.interactions['elec'] == 0:
+        success = False
+    if sum(counters.particles_per_event) != 2*sum(counters.interactions.values()):
+        success = False
+    if not success:
+        print(' '*8 + 'Counters are not consistent with the simulation.')
+        print(counters)
+
+    return success
+
+def test_compose_events():
+    """Test composing multi-particle events from single-particle samples"""
+
+    ### Get results ###
+    from monashspa.PHS3302.calorimeter.model import compose_events
+
+    electrons = np.array([[1.0, 2.0, 3.0]])
+    muons = np.array([[0.5, 0.5, 0.5]])
+    result = compose_events({'e': electrons, 'mu': muons}, {'e': 1, 'mu': np.array([0, 2, 1, 0])}, 4, seed=1)
+
+    ### Expected results ###
+    expected_result = np.array([[1.0, 2.0, 3.0], [2.0, 3.0, 4.0], [1.5, 2.5, 3.5], [1.0, 2.0, 3.0]])
+
+    success = np.allclose(result, expected_result)
+    if not success:
+        print(' '*8 + 'Values are not within tolerance.')
+        print(' '*(8+4) + 'Expected value: {}'.format(expected_result))
+        print(' '*(8+4) + 'Actual value: {}'.format(result))
+
+    return success
+
+def test_resolution_uncertainty():
+    """Test the bootstrap uncertainty of the resolution against the large-N approximation"""
+
+    ### Get results ###
+    from monashspa.PHS3302.calorimeter.model import resolution_with_uncertainty
+
+    energies = np.random.default_rng(1).normal([[10.0], [20.0]], [[1.0], [1.0]], (2, 4000))
+    resolution, u_resolution = resolution_with_uncertainty(energies, n_boot=500, seed=2)
+    analytic_resolution, analytic_u_resolution = resolution_with_uncertainty(energies, method='analytic')
+
+    ### Expected results ###
+    expected_result = np.array([0.1, 0.05])
+
+    success = (np.allclose(resolution, expected_result, rtol=0.05) and np.array_equal(resolution, analytic_resolution)
+               and np.allclose(u_resolution, analytic_u_resolution, rtol=0.2))
+    if not success:
+        print(' '*8 + 'Values are not within tolerance.')
+        print(' '*(8+4) + 'Expected value: {} +/- {}'.format(expected_result, analytic_u_resolution))
+        print(' '*(8+4) + 'Actual value: {} +/- {}'.format(resolution, u_resolution))
+
+    return success
+
+def test_memmap_output():
+    """Test that a float32 memory-mapped output and the chunk-wise helpers agree with the default output"""
+
+    ### Get results ###
+    import os
+    import tempfile
+    import monashspa.PHS3302.calorimeter.model as model
+
+    sim = model.Simulation(make_calorimeter())
+    ionisations = sim.simulate(model.Electron(0.0, 1.0), 8, seed=5, processes=1)
+    expected_result = model.resolution(ionisations)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = model.OutputSpec(np.float32, os.path.join(tmpdir, 'ionisations.npy'))
+        sim.simulate(model.Electron(0.0, 1.0), 8, seed=5, processes=1, output=output)
+        stored = np.load(output.path, mmap_mode='r')
+        result = model.resolution(stored, chunk_size=3)
+        success = (stored.dtype == np.float32 and np.allclose(stored, ionisations, rtol=1e-6)
+                   and np.allclose(model.energy_sums(stored, chunk_size=3), ionisations.sum(axis=1), rtol=1e-6))
+        del stored
+
+    success = success and np.isclose(result, expected_result, rtol=1e-6)
+    if not success:
+        print(' '*8 + 'Values are not within tolerance.')
+        print(' '*(8+4) + 'Expected value: {}'.format(expected_result))
+        print(' '*(8+4) + 'Actual value: {}'.format(result))
+
+    return success
+
+def test_trace_file():
+    """Test saving particle traces and reading a part of them back lazily"""
+
+    ### Get results ###
+    import os
+    import tempfile
+    import monashspa.PHS3302.calorimeter.model as model
+
+    sim = model.Simulation(make_calorimeter())
+    ionisations, cal = sim.simulate_with_tracing(model.Electron(0.0, 1.0), seed=2)
+    expected_result = [(particle.type, np.array(trace, dtype=np.float32)) for particle, trace in cal.get_particle_traces()]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'traces.h5')
+        cal.save_traces(filename)
+        with model.TraceFile(filename) as traces:
+            result = list(traces.traces())
+            clipped = list(traces.traces(2.0, 4.0))
+        # a file without traces can be written and read back as well
+        model.save_traces(filename, [])
+        with model.TraceFile(filename) as traces:
+            empty = (len(traces), list(traces.traces()), traces.zmin.shape, traces.zmax.shape)
+
+    success = (len(result) == len(expected_result) and len(result) > 0
+               and all(t1 == t2 and np.array_equal(c1, c2) for (t1, c1), (t2, c2) in zip(result, expected_result))
+               and all(c[0, 0] <= 2.0 and np.all(c[1:-1, 0] >= 2.0) and np.all(c[1:-1, 0] <= 4.0)
+                       for t, c in clipped)
+               and empty == (0, [], (0,), (0,)))
+    if not success:
+        print(' '*8 + 'Traces read from the file differ from the recorded traces.')
+        print(' '*(8+4) + 'Expected value: {} traces'.format(len(expected_result)))
+        print(' '*(8+4) + 'Actual value: {} traces'.format(len(result)))
+
+    return success
+
+def test_batched_engine():
+    """Test that the batched engine gives the same ionisation as the default engine"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+
+    sim = model.Simulation(make_calorimeter())
+    batched = model.Simulation(make_calorimeter(), batch_size=64)
+    muons = batched.simulate(model.Muon(0.0, 1.0), 5, seed=1, processes=1)
+    expected_muons = sim.simulate(model.Muon(0.0, 1.0), 5, seed=1, processes=1)
+    expected_result = sim.simulate(model.Electron(0.0, 1.0), 200, seed=1, processes=1).sum(axis=1)
+    result = batched.simulate(model.Electron(0.0, 1.0), 200, seed=1, processes=1).sum(axis=1)
+
+    # the showers differ event by event, so compare the mean within 4 standard errors
+    u = np.sqrt((np.var(expected_result) + np.var(result))/200)
+    success = np.allclose(muons, expected_muons) and abs(np.mean(result) - np.mean(expected_result)) < 4*u
+    if not success:
+        print(' '*8 + 'Values are not within tolerance.')
+        print(' '*(8+4) + 'Expected value: {} +/- {}'.format(np.mean(expected_result), u))
+        print(' '*(8+4) + 'Actual value: {}'.format(np.mean(result)))
+
+    return success
+
+def test_sensitivity_scan():
+    """Test the reweighting of a simulated sample to a different material and yield"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+
+    scan = model.SensitivityScan(model.Simulation(make_calorimeter()))
+    ionisations = scan.run(model.Electron(0.0, 1.0), 100, seed=1, processes=1)
+    nominal = scan.weights({'lead': 2.0})
+    weights = scan.weights({'lead': 2.04})
+    vacuum = scan.weights({'lead': 0.0})
+    scaled = scan.scaled_ionisations({'Scin': 1.1})
+
+    # the weights have an expectation value of 1
+    u = np.std(weights)/np.sqrt(len(weights))
+    success = (np.all(nominal == 1.0) and abs(np.mean(weights) - 1.0) < 4*u
+               and np.all(np.isfinite(vacuum)) and np.allclose(scaled, 1.1*ionisations))
+    if not success:
+        print(' '*8 + 'Values are not within tolerance.')
+        print(' '*(8+4) + 'Expected value: mean weight 1 +/- {}'.format(u))
+        print(' '*(8+4) + 'Actual value: mean weight {}'.format(np.mean(weights)))
+
+    return success
+
+def test_campaign_resume():
+    """Test that resuming an interrupted campaign gives the same result as an uninterrupted campaign"""
+
+    ### Get results ###
+    import json
+    import os
+    import tempfile
+    import h5py
+    import monashspa.PHS3302.calorimeter.model as model
+    from monashspa.PHS3302.calorimeter.campaign import load_config, run_campaign
+
+    sim = model.Simulation(make_calorimeter())
+    expected_result = sim.simulate(model.Electron(0.0, 1.0), 8, seed=4, processes=1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'campaign.json')
+        with open(filename, 'w') as f:
+            json.dump({'output': os.path.join(tmpdir, 'campaign.h5'), 'processes': 2, 'chunk': 3,
+                       'geometry': [{'repeat': 10, 'layers': [{'name': 'lead', 'material': 2.0, 'thickness': 0.5, 'response': 0.0},
+                                                              {'name': 'Scin', 'material': 0.01, 'thickness': 0.5, 'response': 1.0}]}],
+                       'jobs': [{'particle': 'electron', 'energy': 1.0, 'number': 8, 'seed': 4},
+                                {'particle': 'muon', 'energy': 1.0, 'number': 4, 'seed': 5}]}, f)
+        config = load_config(filename)
+        complete = run_campaign(config, verbose=False)
+        with h5py.File(config['output'], 'r') as f:
+            uninterrupted = {name: f['jobs/' + name][()] for name in f['jobs']}
+
+        # pretend the campaign was interrupted while writing the second chunk of the first job
+        with h5py.File(config['output'], 'a') as f:
+            f['jobs/electron_1.0_4'].attrs['events'] = 3
+            del f['jobs/muon_1.0_5']
+        resumed = run_campaign(config, resume=True, verbose=False)
+        with h5py.File(config['output'], 'r') as f:
+            result = {name: f['jobs/' + name][()] for name in f['jobs']}
+
+    success = (complete and resumed and sorted(result) == sorted(uninterrupted)
+               and all(np.array_equal(result[name], uninterrupted[name]) for name in result)
+               and np.array_equal(result['electron_1.0_4'], expected_result))
+    if not success:
+        print(' '*8 + 'Resumed campaign differs from uninterrupted campaign.')
+        print(' '*(8+4) + 'Expected value: {}'.format(uninterrupted))
+        print(' '*(8+4) + 'Actual value: {}'.format(result))
+
+    return success
+
+def test_variance_reduction():
+    """Test that Russian roulette and splitting give the same mean ionisation as the analogue simulation"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+
+    cal = make_calorimeter()
+    # the splitting plane must be inside the calorimeter, particles never cross one beyond the back
+    variance_reduction = model.VarianceReduction(roulette_energy=0.1, survival_probability=0.5, split_z=3.0, split_factor=3)
+    expected_result = model.Simulation(cal).simulate(model.Electron(0.0, 1.0), 150, seed=1, processes=1)
+    result = model.Simulation(cal, variance_reduction=variance_reduction).simulate(model.Electron(0.0, 1.0), 150, seed=1, processes=1)
+
+    # compare the mean of the total ionisation and of the layers behind the splitting plane within 4 standard errors
+    success = variance_reduction.split_z < cal._zend
+    for columns in (slice(None), np.array(cal.positions()) > variance_reduction.split_z):
+        expected_sums, sums = expected_result[:, columns].sum(axis=1), result[:, columns].sum(axis=1)
+        u = np.sqrt((np.var(expected_sums) + np.var(sums))/150)
+        if not abs(np.mean(sums) - np.mean(expected_sums)) < 4*u:
+            success = False
+            print(' '*8 + 'Values are not within tolerance.')
+            print(' '*(8+4) + 'Expected value: {} +/- {}'.format(np.mean(expected_sums), u))
+            print(' '*(8+4) + 'Actual value: {}'.format(np.mean(sums)))
+
+    return success
+
+def test_profile_total():
+    """Test that the longitudinal profile adds up to the total ionisation of each event"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+
+    success = True
+    # the last bin ends at the back of the calorimeter, where the last steps of the particles leave it
+    for sim in (model.Simulation(make_calorimeter()), model.Simulation(make_calorimeter(), batch_size=64)):
+        ionisations, profiles = sim.simulate(model.Muon(0.0, 1.0), 2, seed=1, processes=1, profile_bin_width=0.5)
+        expected_result = np.concatenate([ionisations, sim.simulate(model.Electron(0.0, 1.0), 20, seed=1, processes=1)]).sum(axis=1)
+        result = np.concatenate([profiles, sim.simulate(model.Electron(0.0, 1.0), 20, seed=1, processes=1,
+                                                        profile_bin_width=0.5)[1]]).sum(axis=1)
+        if profiles.shape[1] != len(make_calorimeter().profile_edges(0.5)) - 1 or not np.allclose(result, expected_result, rtol=1e-5):
+            success = False
+            print(' '*8 + 'Values are not within tolerance.')
+            print(' '*(8+4) + 'Expected value: {}'.format(expected_result))
+            print(' '*(8+4) + 'Actual value: {}'.format(result))
+
+    # a run without events gives an empty profile with the same bins
+    ionisations, profiles = model.Simulation(make_calorimeter()).simulate(model.Electron(0.0, 1.0), 0, processes=1, profile_bin_width=0.5)
+    if profiles.shape != (0, len(make_calorimeter().profile_edges(0.5)) - 1):
+        success = False
+        print(' '*8 + 'The profile of a run without events has shape {}.'.format(profiles.shape))
+
+    return success
+
+def test_particle_pool():
+    """Test that reusing particles from a pool gives the same seeded result as creating new particles"""
+
+    ### Get results ###
+    import monashspa.PHS3302.calorimeter.model as model
+    from monashspa.PHS3302.calorimeter.model.particle import ParticlePool
+
+    success = True
+    for variance_reduction in (None, model.VarianceReduction(roulette_energy=0.1, split_z=3.0)):
+        sims = [model.Simulation(make_calorimeter(), variance_reduction) for i in range(3)]
+        # the default pool, a pool that keeps a single free particle and no pool at all
+        sims[1]._pool = ParticlePool(size=1)
+        sims[2]._pool = None
+        expected_result = sims[2].simulate(model.Electron(0.0, 1.0), 10, seed=6, processes=1)
+        for sim in sims[:2]:
+            result = sim.simulate(model.Electron(0.0, 1.0), 10, seed=6, processes=1)
+            if not np.array_equal(result, expected_result):
+                success = False
+                print(' '*8 + 'Simulation with a particle pool differs from simulation without.')
+                print(' '*(8+4) + 'Expected value: {}'.format(expected_result))
+                print(' '*(8+4) + 'Actual value: {}'.format(result))
+
+    return success
+
+def test_worker_pool_start_methods():
+    """Test that the worker pool gives the same result as a serial run with the fork and spawn start methods"""
+
+    ### Get results ###
+    import multiprocessing as mp
+    import monashspa.PHS3302.calorimeter.model as model
+    from monashspa.PHS3302.calorimeter.model.simulation import _run_events
+
+    sim = model.Simulation(make_calorimeter())
+    expected_result = _run_events((sim, model.Electron(0.0, 1.0), 0.1, 8, 0, 7))[0]
+
+    success = True
+    start_method = mp.get_start_method()
+    try:
+        for method in ('fork', 'spawn'):
+            if method not in mp.get_all_start_methods():
+                continue
+            # the worker state is inherited by forked workers and loaded from shared memory by spawned workers
+            mp.set_start_method(method, force=True)
+            result = sim.simulate(model.Electron(0.0, 1.0), 7, deadcellfraction=0.1, seed=8, processes=2)
+            if not np.array_equal(result, expected_result):
+                success = False
+                print(' '*8 + 'Result with the {} start method differs from the serial result.'.format(method))
+                print(' '*(8+4) + 'Expected value: {}'.format(expected_result))
+                print(' '*(8+4) + 'Actual value: {}'.format(result))
+    finally:
+        mp.set_start_method(start_method, force=True)
+
+    return success
+
+def do_tests():
+    tests = [test_seeded_simulation, test_checkpoint_resume, test_distributed_simulation, test_counters,
+             test_compose_events, test_resolution_uncertainty, test_memmap_output,
+             test_trace_file, test_batched_engine, test_sensitivity_scan, test_campaign_resume,
+             test_variance_reduction, test_profile_total,
+             test_particle_pool, test_worker_pool_start_methods]
+    failed_tests = []
+    print('Running PHS3302 calorimeter tests...')
+
+    for testfn in tests:
+        print('    Running test "{test_name}":'.format(test_name=testfn.__doc__))
+        result = testfn()
+        print('        Result: {result}'.format(result='success' if result else 'failure'))
+
+        if not result:
+            failed_tests.append(testfn)
+
+    if failed_tests:
+        print('')
+        print('    There were {num_failures:d} failed PHS3302 calorimeter tests'.format(num_failures=len(failed_tests)))
+    print('')
+
+    return failed_tests
+
+if __name__ == "__main__":
+    do_tests()
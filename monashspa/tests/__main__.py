@@ -56,6 +56,9 @@ if __name__ == "__main__":
     from monashspa.tests.PHS3000 import optical_tweezers
     failed_tests.extend(optical_tweezers.do_tests())
 
+    from monashspa.tests.PHS3302 import calorimeter
+    failed_tests.extend(calorimeter.do_tests())
+
     print()
     print("Tests complete.")
     if failed_tests:
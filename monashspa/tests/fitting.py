@@ -170,8 +170,300 @@ def test_failed_fit_2():
     
     return success
 
+def test_model_cache():
+    """A test that a cached model gives the same fit as a newly created model"""
+    ### Get results ###
+    import json
+    import os
+    import tempfile
+    import monashspa.PHS2061 as spa
+    from monashspa.common.fitting import set_model_cache, clear_model_cache
+
+    # load the data
+    data = spa.fitting_tutorial.data
+    # slice the data into columns
+    t = data[:,0]
+    A = data[:,1]
+    u_A = data[:,2]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        set_model_cache(path=tmpdir)
+        try:
+            models = [spa.make_lmfit_model("A_0*exp(-l*x)") for i in range(2)]
+            # the third model is made from the parameter names stored on disk
+            clear_model_cache()
+            models.append(spa.make_lmfit_model("A_0*exp(-l*x)"))
+            stored = os.listdir(tmpdir)
+            # a file with parameter names that are not in the expression is ignored
+            with open(os.path.join(tmpdir, stored[0])) as f:
+                entry = json.load(f)
+            entry['parameters'] = ['x', 'A', 'lam']
+            with open(os.path.join(tmpdir, stored[0]), 'w') as f:
+                json.dump(entry, f)
+            clear_model_cache()
+            edited_model = spa.make_lmfit_model("A_0*exp(-l*x)")
+        finally:
+            set_model_cache()
+    for model in models:
+        params = model.make_params(A_0=30, l=.005)
+        results.append(spa.get_fit_parameters(spa.model_fit(model, params, x=t, y=A, u_y=u_A)))
+
+    ### Check results ###
+    success = (models[0] is not models[1] and models[0].func is models[1].func and len(stored) == 1
+               and results[0] == results[1] == results[2] and edited_model.param_names == ['A_0', 'l'])
+
+    return success
+
+def test_parameter_discovery():
+    """A test that the parameters of a model are found in order, also for singular expressions"""
+    ### Get results ###
+    import monashspa.PHS2061 as spa
+    from monashspa.common.fitting import clear_model_cache
+
+    names = []
+    for i in range(2):
+        clear_model_cache()
+        names.append(spa.make_lmfit_model("amp*sin(w*x + phi)/(x - x0) + np.log(x)*c").param_names)
+    # "sinc" is a numpy function, so it must not become a parameter
+    singular = spa.make_lmfit_model("a/x + b/(x - 1) + sinc(x)*c").param_names
+
+    ### Check results ###
+    success = (names[0] == names[1] == ['amp', 'w', 'phi', 'x0', 'c']
+               and singular == ['a', 'b', 'c'])
+
+    return success
+
+def test_analytic_jacobian():
+    """A test that a fit with the symbolic derivatives of the model matches a fit with numerical derivatives"""
+    ### Get results ###
+    import monashspa.PHS2061 as spa
+
+    # load the data
+    data = spa.fitting_tutorial.data
+    # slice the data into columns
+    t = data[:,0]
+    A = data[:,1]
+    u_A = data[:,2]
+
+    results = []
+    for jacobian in [False, True]:
+        model = spa.make_lmfit_model("A_0*np.exp(-l*x)", jacobian=jacobian)
+        params = model.make_params(A_0=30, l=.005)
+        results.append(spa.model_fit(model, params, x=t, y=A, u_y=u_A))
+    numerical, analytic = [spa.get_fit_parameters(result) for result in results]
+
+    ### Check results ###
+    success = results[1].nfev < results[0].nfev
+    for name in ['A_0', 'l']:
+        success = success and np.isclose(analytic[name], numerical[name], rtol=1e-6)
+        success = success and np.isclose(analytic['u_'+name], numerical['u_'+name], rtol=1e-4)
+
+    return success
+
+def test_linear_fit_matches_model_fit():
+    """A test that the exact linear fit matches an iterative fit of a straight line"""
+    ### Get results ###
+    from lmfit.models import LinearModel
+    from monashspa.common.fitting import linear_fit, model_fit, get_fit_parameters, MonashSPAFittingException
+
+    x = np.linspace(0, 10, 50)
+    y = 3.2*x - 1.5 + np.sin(7*x)
+    u_y = 0.5 + 0.1*x
+
+    success = True
+    for uncertainties in [None, u_y]:
+        exact = linear_fit(x, y, u_y=uncertainties)
+        model = LinearModel()
+        iterative = model_fit(model, model.guess(y, x=x), x, y, u_y=uncertainties)
+
+        ### Check results ###
+        for name, value in get_fit_parameters(iterative).items():
+            success = success and np.isclose(get_fit_parameters(exact)[name], value, rtol=1e-6)
+        success = success and np.isclose(exact.chisqr, iterative.chisqr, rtol=1e-9) and exact.nvarys == 2 and exact.ndata == 50
+        success = success and np.allclose(exact.eval_uncertainty(), iterative.eval_uncertainty(), rtol=1e-5)
+        success = success and 'slope' in exact.fit_report()
+
+    # uncertainties of zero are reported as such, not as a problem with the x values
+    try:
+        linear_fit(x, y, u_y=np.zeros_like(x))
+        success = False
+    except MonashSPAFittingException as e:
+        success = success and 'u_y' in str(e)
+
+    return success
+
+def test_model_fit_many():
+    """A test that fitting many datasets at once gives the same results as fitting them one by one"""
+    ### Get results ###
+    from monashspa.common.fitting import make_lmfit_model, model_fit, model_fit_many, get_fit_parameters
+
+    model = make_lmfit_model("A_0*exp(-l*x) + c")
+    params = model.make_params(A_0=1, l=0.5, c=0)
+    x = np.linspace(0, 10, 60)
+    ys = [A_0*np.exp(-l*x) + 0.05*np.sin(3*x + A_0) for A_0, l in [(2, 0.1), (3, 0.2), (4, 0.3), (5, 0.15)]]
+    u_y = np.full(len(x), 0.05)
+
+    # datasets of the same length are fitted together, others in a pool of processes
+    stacked, table = model_fit_many(model, params, x, ys, u_y)
+    ragged, _ = model_fit_many(model, params, [x, x[:50]], [ys[0], ys[1][:50]], [u_y, u_y[:50]], processes=2)
+    single = [model_fit(model, params, x, y, u_y) for y in ys] + [model_fit(model, params, x[:50], ys[1][:50], u_y[:50])]
+
+    ### Check results ###
+    success = len(table) == 4 and table['success'].all()
+    for result, expected in zip(stacked + ragged[1:], single):
+        result, expected = get_fit_parameters(result), get_fit_parameters(expected)
+        for name, value in expected.items():
+            if not np.isclose(result[name], value, rtol=1e-4, atol=1e-6):
+                print('        {}: {} is not {}'.format(name, result[name], value))
+                success = False
+    success = success and np.isclose(table['A_0'][1], get_fit_parameters(stacked[1])['A_0'])
+
+    return success
+
+def test_multistart_fit():
+    """A test that a multistart fit finds the best minimum when the initial guess does not"""
+    ### Get results ###
+    from monashspa.common.fitting import make_lmfit_model, model_fit
+
+    x = np.linspace(0, 10, 200)
+    y = 2*np.sin(3.1*x + 0.3) + 0.1*np.cos(17*x)
+    u_y = np.full(len(x), 0.1)
+    model = make_lmfit_model("A*sin(w*x + phi)")
+    params = model.make_params(A=1, w=1, phi=0)
+    params['w'].set(min=0.5, max=5)
+    params['phi'].set(min=-np.pi, max=np.pi)
+
+    single = model_fit(model, params, x, y, u_y=u_y)
+    multistart = model_fit(model, params, x, y, u_y=u_y, multistart=16, seed=1, processes=2)
+
+    ### Check results ###
+    success = multistart.chisqr < single.chisqr and np.isclose(multistart.params['w'].value, 3.1, rtol=1e-3)
+    success = success and multistart.chisqr == multistart.multistart['chisqr'].min() and len(multistart.multistart) <= 16
+    success = success and multistart.params['w'].stderr is not None
+
+    return success
+
+def test_model_guess():
+    """A test that the guess method of a model finds starting values for data far from the default hints"""
+    ### Get results ###
+    from monashspa.common.fitting import make_lmfit_model, model_fit, get_fit_parameters
+
+    # a lifetime in picoseconds
+    t = np.linspace(0, 20e-12, 100)
+    y = 500*np.exp(-t/2.3e-12) + 20 + 2*np.sin(1e13*t)
+    u_y = np.full(len(t), 2.0)
+    model = make_lmfit_model("A*exp(-x/tau) + c")
+
+    params = model.guess(y, x=t, u_y=u_y, seed=1)
+    results = get_fit_parameters(model_fit(model, params, t, y, u_y=u_y))
+
+    ### Check results ###
+    success = np.isclose(params['tau'].value, 2.3e-12, rtol=0.2)
+    success = success and np.isclose(results['tau'], 2.3e-12, rtol=0.01) and np.isclose(results['A'], 500, rtol=0.01)
+
+    return success
+
+def test_toy_study():
+    """A test that the pulls of a toy study of an unbiased fit follow a standard normal distribution"""
+    ### Get results ###
+    from monashspa.common.fitting import make_lmfit_model, toy_study
+
+    x = np.arange(-5.0, 5.0, 0.8)
+    u_y = 0.8 + x*x/15.
+    model = make_lmfit_model("a*x + b")
+    results = toy_study(model, {'a': 1.5, 'b': 0.0}, x, u_y, 2000, seed=1, block_size=500)
+    repeated = toy_study(model, {'a': 1.5, 'b': 0.0}, x, u_y, 2000, seed=1)
+
+    ### Check results ###
+    success = results['success'].all() and np.array_equal(results['a'], repeated['a'])
+    for name in ['pull_a', 'pull_b']:
+        # the mean and standard deviation of 2000 pulls are known to about 0.02 and 0.016
+        success = success and abs(np.mean(results[name])) < 0.08 and abs(np.std(results[name]) - 1) < 0.06
+    success = success and abs(np.mean(results['p_value']) - 0.5) < 0.03
+
+    return success
+
+def test_unbinned_fit():
+    """A test of an unbinned extended maximum-likelihood fit of a lifetime with a flat background"""
+    ### Get results ###
+    from monashspa.common.fitting import make_lmfit_model, unbinned_fit, get_fit_parameters
+
+    rng = np.random.default_rng(7)
+    events = np.concatenate([rng.exponential(0.41, 16000), rng.uniform(0, 4, 4000)])
+    model = make_lmfit_model("N/tau*exp(-x/tau)/(1 - exp(-4/tau)) + B/4")
+    params = model.make_params(N=5000, tau=1, B=5000)
+    results = get_fit_parameters(unbinned_fit(model, params, events, limits=(0, 4), chunk_size=4096))
+
+    ### Check results ###
+    # in an extended fit with yields as parameters, the yields add up to the number of events
+    success = np.isclose(results['N'] + results['B'], np.sum(events <= 4), rtol=1e-4)
+    success = success and abs(results['tau'] - 0.41) < 4*results['u_tau'] and 0 < results['u_tau'] < 0.01
+    success = success and np.isclose(results['u_N'], np.sqrt(results['N']), rtol=0.2)
+
+    return success
+
+def test_poisson_fit():
+    """A test of a binned Poisson-likelihood fit of a lifetime, with the histogram rebinned from bin indices"""
+    ### Get results ###
+    from monashspa.common.fitting import make_lmfit_model, model_fit, bin_indices, histogram, get_fit_parameters
+
+    rng = np.random.default_rng(3)
+    events = rng.exponential(2.5, 400)
+    indices, edges = bin_indices(events, bins=400, limits=(0, 10))
+    counts, wide_edges = histogram(indices, edges, rebin=4)
+    x = (wide_edges[1:] + wide_edges[:-1])/2
+    model = make_lmfit_model("N*exp(-x/tau)", jacobian=True)
+    fit_result = model_fit(model, model.make_params(N=5, tau=1), x, counts, statistic='poisson')
+    results = get_fit_parameters(fit_result)
+
+    ### Check results ###
+    # the histogram made from the bin indices is the same as numpy makes from the events
+    success = np.array_equal(counts, np.histogram(events, bins=100, range=(0, 10))[0])
+    success = success and abs(results['tau'] - 2.5) < 3*results['u_tau']
+    # the likelihood ratio is about the number of degrees of freedom for a good fit
+    success = success and fit_result.chisqr < fit_result.nfree + 5*np.sqrt(2*fit_result.nfree)
+    # with a free normalisation, the expected counts add up to the number of events
+    success = success and np.isclose(np.sum(fit_result.best_fit), np.sum(counts), rtol=1e-6)
+
+    return success
+
+def test_composite_model_pool():
+    """A test of fitting a product of models from make_lmfit_model in a pool of processes"""
+    ### Get results ###
+    import monashspa.PHS2061 as spa
+    from monashspa.common.fitting import model_fit_many, toy_study
+
+    data = spa.fitting_tutorial.data
+    t = data[:,0]
+    A = data[:,1]
+    u_A = data[:,2]
+
+    # a composite model is always fitted with model_fit, and its parts cannot be pickled
+    model = spa.make_lmfit_model("exp(-l*x)")*spa.make_lmfit_model("A_0", allow_constant_model=True)
+    params = model.make_params(A_0=30, l=.005)
+    expected = spa.get_fit_parameters(spa.model_fit(model, params, x=t, y=A, u_y=u_A))
+    results, table = model_fit_many(model, params, t, [A, A], u_A, processes=2)
+    results.append(spa.model_fit(model, params, x=t, y=A, u_y=u_A, multistart=3, seed=1, processes=2))
+    toys = toy_study(model, params, t, u_A, 4, seed=1, processes=2)
+
+    ### Check results ###
+    success = len(table) == 2 and table['success'].all() and toys['success'].all()
+    for result in results:
+        result = spa.get_fit_parameters(result)
+        for name, value in expected.items():
+            if not np.isclose(result[name], value, rtol=1e-4):
+                print('        {}: {} is not {}'.format(name, result[name], value))
+                success = False
+
+    return success
+
 def do_tests():
-    tests = [test_basic_linear_fit, test_linear_fit_with_uncertainties, test_failed_fit_1, test_bypass_failed_fit_1, test_failed_fit_2]
+    tests = [test_basic_linear_fit, test_linear_fit_with_uncertainties, test_failed_fit_1, test_bypass_failed_fit_1, test_failed_fit_2,
+             test_model_cache, test_parameter_discovery, test_analytic_jacobian,
+             test_linear_fit_matches_model_fit, test_model_fit_many,
+             test_multistart_fit, test_model_guess, test_toy_study,
+             test_unbinned_fit, test_poisson_fit, test_composite_model_pool]
     failed_tests = []
     print('Running common fitting tests...')
 